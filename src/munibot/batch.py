@@ -0,0 +1,309 @@
+import asyncio
+import io
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from .config import config, get_logger
+from .image import render_image
+from .timings import Timings
+
+DEFAULT_THREADS = 4
+
+
+def read_ids_file(path):
+    """
+    Returns the feature ids listed in a text file, one per line. Empty lines
+    and lines starting with "#" are ignored.
+    """
+    with open(path) as f:
+        return [
+            line.strip()
+            for line in f
+            if line.strip() and not line.strip().startswith("#")
+        ]
+
+
+def fetch_inputs(profile, id_, timings=None):
+    """
+    Requests the boundaries and the base image of a feature.
+
+    Returns a tuple with the boundaries (a GeoJSON-like dict) and the bytes
+    of the base image, which can be sent to another process.
+    """
+    timings = timings or Timings()
+
+    with timings.stage("boundaries"):
+        extent, boundaries = profile.load_boundaries(id_)
+
+    with timings.stage("imagery"):
+        base_image = profile.get_base_image(extent)
+
+    return _to_picklable(boundaries, base_image)
+
+
+def _to_picklable(boundaries, base_image):
+
+    import shapely.geometry
+
+    if hasattr(base_image, "seek"):
+        base_image.seek(0)
+    data = base_image.read()
+    if hasattr(base_image, "close"):
+        base_image.close()
+
+    boundaries = shapely.geometry.mapping(shapely.geometry.shape(boundaries))
+
+    return boundaries, data
+
+
+def _init_worker(worker_config):
+
+    config.clear()
+    config.update(worker_config)
+
+
+def _fetch(profile, id_):
+
+    timings = Timings()
+
+    boundaries, base_image = fetch_inputs(profile, id_, timings)
+
+    return boundaries, base_image, timings.stages
+
+
+def _render(boundaries, base_image, nodata_value, output):
+
+    start = time.perf_counter()
+    timings = Timings()
+
+    final_image = render_image(
+        io.BytesIO(base_image), boundaries, nodata_value, timings=timings
+    )
+
+    with open(output, "wb") as f:
+        f.write(final_image.getbuffer())
+
+    return time.perf_counter() - start, timings.stages
+
+
+class Progress:
+    """
+    Keeps track of the images created in a batch run, printing the progress
+    and building the final summary.
+
+    The time spent in each stage is written to the timings log once the
+    image of a feature is created.
+    """
+
+    def __init__(self, total, profile_id=None):
+        self.total = total
+        self.profile_id = profile_id
+        self.fetched = self.created = self.failed = 0
+        self.fetch_time = self.render_time = 0
+        self.start = time.perf_counter()
+        self.log = get_logger(__name__)
+        self.timings = {}
+
+    def fetch_done(self, id_, stages):
+        self.fetched += 1
+        self.fetch_time += sum(stages.values())
+        self.timings[id_] = Timings(self.profile_id, id_, "batch")
+        self.timings[id_].update(stages)
+
+    def render_done(self, id_, duration, stages=None):
+        self.created += 1
+        self.render_time += duration
+        timings = self.timings.pop(id_, None) or Timings(
+            self.profile_id, id_, "batch"
+        )
+        timings.update(stages or {})
+        timings.log()
+        print(
+            f"[{self.created + self.failed}/{self.total}] {id_} "
+            f"created in {duration:0.2f}s"
+        )
+
+    def error(self, id_, error):
+        self.failed += 1
+        self.timings.pop(id_, None)
+        self.log.warning(f"Could not create image for feature {id_}: {error}")
+        print(f"[{self.created + self.failed}/{self.total}] {id_} failed: {error}")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+
+        return {
+            "total": self.total,
+            "fetched": self.fetched,
+            "created": self.created,
+            "failed": self.failed,
+            "elapsed": elapsed,
+            "fetch_time": self.fetch_time,
+            "render_time": self.render_time,
+            "per_minute": self.created * 60 / elapsed if elapsed else 0,
+        }
+
+
+def _get_render_pool(processes):
+
+    # Workers are started while the fetcher threads are running, so they are
+    # not forked from this process, as they could inherit locks held by them
+    return ProcessPoolExecutor(
+        processes,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=(dict(config),),
+    )
+
+
+def _get_window(processes, threads):
+
+    # Features being fetched or rendered at the same time. Fetched images
+    # are kept in memory until rendered, so this is bounded by the render
+    # pool rather than by the number of features
+    return max(threads, (processes or os.cpu_count() or 1) * 2)
+
+
+def create_images(profile, ids, output_dir=".", processes=None, threads=None):
+    """
+    Creates the images for many features of a profile.
+
+    The boundaries and base images (network-bound) are requested in a pool
+    of ``threads`` threads, and the images rendered (CPU-bound) in a pool of
+    ``processes`` processes (defaults to the number of CPUs). Images are saved
+    in ``output_dir`` as ``<id>.jpg``.
+
+    New features are only fetched as the previous ones are rendered, so no
+    more than twice the number of processes (or ``threads``, if higher) are
+    in progress at the same time.
+
+    Returns a dict with a summary of the run.
+    """
+    threads = threads or DEFAULT_THREADS
+    nodata_value = getattr(profile, "image_nodata_value", 0)
+    window = _get_window(processes, threads)
+
+    progress = Progress(len(ids), profile.id)
+    ids = iter(ids)
+
+    with ThreadPoolExecutor(threads) as fetchers, _get_render_pool(
+        processes
+    ) as renderers:
+
+        # Maps each pending future to its feature id and stage. Each feature
+        # in progress has one
+        pending = {}
+
+        def fill_window():
+            for id_ in itertools.islice(ids, window - len(pending)):
+                pending[fetchers.submit(_fetch, profile, id_)] = (id_, "fetch")
+
+        fill_window()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                id_, stage = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    progress.error(id_, e)
+                    continue
+
+                if stage == "fetch":
+                    boundaries, base_image, stages = result
+                    progress.fetch_done(id_, stages)
+                    output = os.path.join(output_dir, f"{id_}.jpg")
+                    render = renderers.submit(
+                        _render, boundaries, base_image, nodata_value, output
+                    )
+                    pending[render] = (id_, "render")
+                else:
+                    progress.render_done(id_, *result)
+
+            fill_window()
+
+    return progress.summary()
+
+
+async def acreate_images(profile, ids, output_dir=".", processes=None, threads=None):
+    """
+    Async version of ``create_images``, driven by an asyncio event loop.
+
+    Boundaries and base images are requested with the profile async hooks
+    (``aload_boundaries`` and ``aget_base_image``), with up to ``threads``
+    features being requested at the same time, while the images already
+    requested are rendered in a pool of ``processes`` processes. As in
+    ``create_images``, the number of features in progress is bounded by a
+    fixed number of workers.
+
+    Returns a dict with a summary of the run.
+    """
+    loop = asyncio.get_running_loop()
+
+    threads = threads or DEFAULT_THREADS
+    semaphore = asyncio.Semaphore(threads)
+    nodata_value = getattr(profile, "image_nodata_value", 0)
+    window = _get_window(processes, threads)
+
+    progress = Progress(len(ids), profile.id)
+    ids = iter(ids)
+
+    with _get_render_pool(processes) as renderers:
+
+        async def create(id_):
+            try:
+                async with semaphore:
+                    timings = Timings()
+                    with timings.stage("boundaries"):
+                        extent, boundaries = await profile.aload_boundaries(id_)
+                    with timings.stage("imagery"):
+                        base_image = await profile.aget_base_image(extent)
+                    boundaries, base_image = _to_picklable(boundaries, base_image)
+                    progress.fetch_done(id_, timings.stages)
+
+                output = os.path.join(output_dir, f"{id_}.jpg")
+                duration, stages = await loop.run_in_executor(
+                    renderers, _render, boundaries, base_image, nodata_value, output
+                )
+                progress.render_done(id_, duration, stages)
+            except Exception as e:
+                progress.error(id_, e)
+
+        async def worker():
+            # The iterator is shared by all the workers
+            for id_ in ids:
+                await create(id_)
+
+        await asyncio.gather(*[worker() for _ in range(window)])
+
+    return progress.summary()
+
+
+def print_summary(summary):
+    """
+    Prints the summary returned by ``create_images``.
+    """
+    print(
+        "{created} images created, {failed} failed, in {elapsed:0.1f}s "
+        "({per_minute:0.1f} images/min)".format(**summary)
+    )
+    if summary["fetched"]:
+        print(
+            "Average fetch time {:0.2f}s".format(
+                summary["fetch_time"] / summary["fetched"]
+            )
+        )
+    if summary["created"]:
+        print(
+            "Average render time {:0.2f}s".format(
+                summary["render_time"] / summary["created"]
+            )
+        )
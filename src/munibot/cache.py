@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from .config import config
+from .instrumentation import count
+from .db import get_connection
+
+BOUNDARIES_TABLE = "boundaries_cache"
+
+DEFAULT_IMAGES_MAX_SIZE = 500
+
+# Cache databases where the tables have been created already
+_initialized = set()
+
+
+def _get_cache_config():
+
+    return config.get("cache", {})
+
+
+def get_cache_path():
+    """
+    Returns the path of the SQLite database used to cache the boundaries.
+
+    This is the ``path`` option of the ``[cache]`` section, falling back to
+    the main ``[db]`` database. Returns None if neither is defined.
+    """
+    cache_config = _get_cache_config()
+
+    return cache_config.get("path") or config.get("db", {}).get("path")
+
+
+def boundaries_cache_enabled():
+    """
+    Returns True if the boundaries cache is enabled, which is the default if
+    a cache database is available. It can be disabled setting
+    ``boundaries=false`` in the ``[cache]`` section.
+    """
+    enabled = _get_cache_config().get("boundaries", "true")
+
+    return enabled.lower() in ("true", "yes", "on", "1") and bool(get_cache_path())
+
+
+def _get_db():
+
+    path = get_cache_path()
+    db = get_connection(path)
+
+    if path in _initialized:
+        return db
+
+    db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {BOUNDARIES_TABLE} (
+            profile TEXT NOT NULL,
+            id TEXT NOT NULL,
+            extent TEXT NOT NULL,
+            geometry TEXT NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (profile, id)
+        )
+        """
+    )
+    _initialized.add(path)
+
+    return db
+
+
+def get_boundaries(profile_id, id_):
+    """
+    Returns the cached boundaries for a feature, as a tuple with the extent and
+    the GeoJSON geometry, or None if they are not cached or have expired.
+
+    Cached entries older than the ``boundaries_ttl`` option of the ``[cache]``
+    section (in seconds) are considered expired. If not set or 0 (the default)
+    entries never expire.
+    """
+    ttl = int(_get_cache_config().get("boundaries_ttl", 0))
+
+    db = _get_db()
+
+    row = db.execute(
+        f"""
+        SELECT extent, geometry, created
+        FROM {BOUNDARIES_TABLE}
+        WHERE profile = ? AND id = ?
+        """,
+        (profile_id, str(id_)),
+    ).fetchone()
+
+    if not row:
+        count("cache.boundaries.miss")
+        return None
+
+    extent, geometry, created = row
+    if ttl and time.time() - created > ttl:
+        count("cache.boundaries.miss")
+        return None
+
+    count("cache.boundaries.hit")
+
+    return tuple(json.loads(extent)), json.loads(geometry)
+
+
+def set_boundaries(profile_id, id_, extent, geometry):
+    """
+    Stores the extent and geometry of a feature in the cache.
+    """
+    import shapely.geometry
+
+    geometry = shapely.geometry.mapping(shapely.geometry.shape(geometry))
+
+    db = _get_db()
+
+    db.execute(
+        f"""
+        INSERT OR REPLACE INTO {BOUNDARIES_TABLE} (profile, id, extent, geometry, created)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (
+            profile_id,
+            str(id_),
+            json.dumps(list(extent)),
+            json.dumps(geometry),
+            time.time(),
+        ),
+    )
+
+    db.commit()
+
+
+def clear_boundaries(profile_id, id_=None):
+    """
+    Removes the cached boundaries of a profile. If ``id_`` is provided only the
+    ones for that feature are removed.
+    """
+    db = _get_db()
+
+    if id_ is None:
+        db.execute(f"DELETE FROM {BOUNDARIES_TABLE} WHERE profile = ?", (profile_id,))
+    else:
+        db.execute(
+            f"DELETE FROM {BOUNDARIES_TABLE} WHERE profile = ? AND id = ?",
+            (profile_id, str(id_)),
+        )
+
+    db.commit()
+
+
+def images_cache_enabled():
+    """
+    Returns True if the base images cache is enabled, which happens when the
+    ``images_dir`` option of the ``[cache]`` section is set.
+    """
+    return bool(_get_cache_config().get("images_dir"))
+
+
+def get_image_key(url, layer, crs, bbox, size, format, **kwargs):
+    """
+    Returns the cache key for a WMS image, a hash of all the parameters that
+    affect the returned image.
+    """
+    params = {
+        "url": url,
+        "layer": layer,
+        "crs": crs,
+        "bbox": [float(c) for c in bbox],
+        "size": [float(c) for c in size],
+        "format": format,
+        **kwargs,
+    }
+
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+def _get_image_path(key):
+
+    return os.path.join(_get_cache_config()["images_dir"], key)
+
+
+def get_image(key):
+    """
+    Returns the bytes of the cached image with the provided key, or None if
+    it is not cached.
+    """
+    path = _get_image_path(key)
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        count("cache.images.miss")
+        return None
+
+    count("cache.images.hit")
+
+    # Mark it as recently used
+    os.utime(path)
+
+    return data
+
+
+def set_image(key, data):
+    """
+    Stores the bytes of an image in the cache with the provided key.
+
+    If the cache grows past the ``images_max_size`` option of the ``[cache]``
+    section (in megabytes, defaults to 500), the least recently used images
+    are removed.
+    """
+    images_dir = _get_cache_config()["images_dir"]
+    os.makedirs(images_dir, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=images_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, _get_image_path(key))
+
+    _evict_images(images_dir)
+
+
+def _evict_images(images_dir):
+
+    max_size = (
+        float(_get_cache_config().get("images_max_size", DEFAULT_IMAGES_MAX_SIZE))
+        * 1024
+        * 1024
+    )
+
+    entries = []
+    total = 0
+    for entry in os.scandir(images_dir):
+        if not entry.is_file() or entry.name.endswith(".tmp"):
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
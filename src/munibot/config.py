@@ -3,7 +3,7 @@ import os
 import logging
 import importlib
 import inspect
-from pathlib import Path
+from collections.abc import Mapping
 
 from importlib.metadata import entry_points
 
@@ -25,54 +25,123 @@ otherwise pass the location with the "--config" parameter""".strip()
         config[section] = dict(cp[section])
 
 
-def load_profiles():
-    from munibot.profiles.base import BaseProfile
+"""
+Profiles included in this package, with the location of the profile class and
+its description, so they can be listed without importing them.
+"""
+BUILTIN_PROFILES = {
+    "cat": ("munibot.profiles.cat:MuniBotCat", "Municipis Catalunya (Ortofoto ICGC)"),
+    "es": ("munibot.profiles.es:MuniBotEs", "Municipios España (Ortofoto PNOA)"),
+    "fr": (
+        "munibot.profiles.fr:CommuneBotFr",
+        "Communes de France (Orthophoto IGN)",
+    ),
+    "us": (
+        "munibot.profiles.us:CountyBotUS",
+        "US Counties Bot (Orthoimagery The National Map)",
+    ),
+}
 
-    profiles = {}
 
-    # Load profiles included in this package
-    profiles_dir = Path(__file__).parent / "profiles"
+def _import_class(location):
 
-    for profile_file in profiles_dir.glob("*.py"):
-        if profile_file.name in ("__init__.py", "base.py"):
-            continue
+    module_name, class_name = location.split(":")
 
-        module_name = profile_file.stem
+    return getattr(importlib.import_module(module_name), class_name)
 
-        module = importlib.import_module(f"munibot.profiles.{module_name}")
 
-        # Find all classes in the module that inherit from BaseProfile
-        for name, obj in inspect.getmembers(module, inspect.isclass):
-            if issubclass(obj, BaseProfile) and obj is not BaseProfile:
-                profiles[module_name] = obj
-                break
+class Profiles(Mapping):
+    """
+    Dict-like object with the available profile classes, keyed by profile id.
 
-    external_profiles = {
-        profile.name: profile.load()
-        for profile in entry_points(group="munibot_profiles")
-    }
-    if external_profiles:
-        for profile, class_ in external_profiles.items():
-            if profile not in profiles:
-                profiles[profile] = class_
+    Profile classes are only imported when accessed, so commands that use a
+    single profile don't need to import the modules (and dependencies) of
+    the rest.
+    """
 
-    return profiles
+    def __init__(self, builtin, external):
+        # Values are either profile classes, "module:Class" strings or
+        # entry points not loaded yet
+        self._profiles = {}
+        self._descs = {}
+        for name, (location, desc) in builtin.items():
+            self._profiles[name] = location
+            self._descs[name] = desc
+        for entry_point in external:
+            self._profiles.setdefault(entry_point.name, entry_point)
 
+    def __getitem__(self, name):
 
-def get_logger(name):
+        profile = self._profiles[name]
+        if isinstance(profile, str):
+            profile = self._profiles[name] = _import_class(profile)
+        elif not inspect.isclass(profile):
+            profile = self._profiles[name] = profile.load()
+
+        return profile
+
+    def __contains__(self, name):
+        return name in self._profiles
+
+    def __iter__(self):
+        return iter(self._profiles)
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def get_desc(self, name):
+        """
+        Returns the description of a profile, without importing it if it's
+        one of the profiles included in this package.
+        """
+        if name in self._descs:
+            return self._descs[name]
+
+        return self[name].desc
+
+
+def load_profiles():
+
+    return Profiles(BUILTIN_PROFILES, entry_points(group="munibot_profiles"))
 
+
+DEFAULT_LOG_FORMAT = "%(asctime)s %(levelname)-5.5s [%(name)s] %(message)s"
+
+# Handlers added by get_logger, keyed by top level logger name, with the
+# logging config used to create them
+_log_handlers = {}
+
+
+def get_logger(name):
+    """
+    Returns a logger configured with the options of the ``[logging]`` section.
+
+    The handler is added once per process to the top level logger (e.g.
+    ``munibot`` for ``munibot.image``), and child loggers propagate to it, so
+    calling this function many times does not duplicate log lines. It is
+    replaced if the configuration changes.
+    """
     logger = logging.getLogger(name)
-    if "logging" in config:
-        level = config["logging"].get("level", "WARNING")
-        level = getattr(logging, level.upper(), 30)
-        logger.setLevel(level)
-        handler = logging.StreamHandler()
-        handler.setLevel(level)
-        formatter = logging.Formatter(
-            config["logging"].get(
-                "format", "%(asctime)s %(levelname)-5.5s [%(name)s] %(message)s"
-            )
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+    if "logging" not in config:
+        return logger
+
+    top_logger = logging.getLogger(name.split(".")[0])
+    options = dict(config["logging"])
+
+    handler, handler_options = _log_handlers.get(top_logger.name, (None, None))
+    if handler_options == options:
+        return logger
+    if handler:
+        top_logger.removeHandler(handler)
+
+    level = options.get("level", "WARNING")
+    level = getattr(logging, level.upper(), 30)
+    top_logger.setLevel(level)
+    handler = logging.StreamHandler()
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(options.get("format", DEFAULT_LOG_FORMAT)))
+    top_logger.addHandler(handler)
+
+    _log_handlers[top_logger.name] = (handler, options)
+
     return logger
@@ -0,0 +1,516 @@
+import atexit
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from .config import config
+
+_local = threading.local()
+
+_connections = []
+
+_lock = threading.Lock()
+
+# Increased when all connections are closed, so threads open new ones
+_generation = 0
+
+
+def get_db_path():
+    """
+    Returns the path of the main munibot database (``path`` option of the
+    ``[db]`` section).
+    """
+    return config["db"]["path"]
+
+
+def get_connection(path=None):
+    """
+    Returns a connection to a SQLite database, by default the main munibot
+    database.
+
+    Connections are created once per thread and reused afterwards, so the
+    statements prepared by the sqlite3 module are reused as well. They are
+    opened in WAL mode, which allows reading while other connections write,
+    and closed when the process exits.
+    """
+    path = path or get_db_path()
+
+    # Connections can't be shared with forked processes
+    key = (os.getpid(), _generation)
+    if getattr(_local, "key", None) != key:
+        _local.key = key
+        _local.connections = {}
+
+    connection = _local.connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(
+            path, cached_statements=256, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+
+        _local.connections[path] = connection
+        with _lock:
+            _connections.append(connection)
+
+    return connection
+
+
+def close_connections():
+    """
+    Closes all the connections opened by this process, in any thread.
+    """
+    global _generation
+
+    with _lock:
+        for connection in _connections:
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+        _generation += 1
+
+
+atexit.register(close_connections)
+
+
+QUEUE_TABLE = "munibot_queue"
+
+
+def _create_queue(db):
+
+    db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {QUEUE_TABLE} (
+            profile TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            PRIMARY KEY (profile, position)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def _get_indexes(table, id_column, posted_column, columns=None):
+
+    indexes = {
+        f"{table}_{id_column}": f"{table} ({id_column})",
+        # Used to look for features not posted yet
+        f"{table}_{posted_column}_unposted": (
+            f"{table} ({id_column}) WHERE {posted_column} IS NULL"
+        ),
+        # Used to dump the features already posted
+        f"{table}_{posted_column}_posted": (
+            f"{table} ({posted_column}) WHERE {posted_column} IS NOT NULL"
+        ),
+    }
+    for column in columns or []:
+        indexes[f"{table}_{column}"] = f"{table} ({column})"
+
+    return indexes
+
+
+def _create_indexes(db, indexes):
+
+    for name, definition in indexes.items():
+        db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+
+
+def _get_ids_sql(table, id_column, posted_column, where=None, unposted=False):
+
+    conditions = []
+    if where:
+        conditions.append(f"({where})")
+    if unposted:
+        conditions.append(f"{posted_column} IS NULL")
+
+    sql = f"SELECT {id_column} FROM {table}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+
+    return sql
+
+
+def get_ids(table, id_column, posted_column, where=None, unposted=False):
+    """
+    Returns the ids of the features in a table of the munibot database.
+
+    :param where: extra SQL condition to filter the features
+    :param unposted: only return the features that have not been posted yet,
+        ie those where ``posted_column`` is NULL
+    """
+    sql = _get_ids_sql(table, id_column, posted_column, where, unposted)
+
+    return [row[0] for row in get_connection().execute(sql)]
+
+
+def sample_ids(queue, table, id_column, posted_column, where=None, count=1):
+    """
+    Returns up to ``count`` random ids of features that have not been posted
+    yet.
+
+    Instead of sorting the whole table randomly on each call, the unposted
+    ids are shuffled once and stored in a queue table, and the next ones
+    are read from the head of the queue, skipping the ones posted since.
+    The ids returned are removed from the queue, so a feature that can not
+    be posted (e.g. because a service always fails for it) does not block
+    the following ones. The queue is filled again with all the unposted ids,
+    shuffled, when it runs out of ids.
+
+    The queue is read and updated in a single write transaction, so
+    concurrent calls never return the same ids. The queue table and the
+    indexes are created by ``init_db`` (``munibot db init``).
+
+    :param queue: name of the queue, generally the profile id
+    :param table: table with the features
+    :param id_column: column with the feature id
+    :param posted_column: column that is NULL if the feature has not been
+        posted yet
+    :param where: extra SQL condition to filter the features
+    """
+    db = get_connection()
+
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            ids = _read_queue(db, queue, table, id_column, posted_column, count)
+        except sqlite3.OperationalError as e:
+            if QUEUE_TABLE not in str(e):
+                raise
+            raise RuntimeError(
+                f"The {QUEUE_TABLE} table is missing, run `munibot db init` first"
+            ) from e
+        if len(ids) < count:
+            _fill_queue(db, queue, table, id_column, posted_column, where)
+            ids = _read_queue(db, queue, table, id_column, posted_column, count)
+
+    return ids
+
+
+def _get_queue_sql(table, id_column, posted_column):
+
+    # CROSS JOIN makes SQLite walk the queue in order, looking up each id
+    return f"""
+        SELECT q.position, q.id
+        FROM {QUEUE_TABLE} q
+        CROSS JOIN {table} t ON t.{id_column} = q.id
+        WHERE q.profile = ?
+            AND t.{posted_column} IS NULL
+        ORDER BY q.position
+        LIMIT ?
+        """
+
+
+def _read_queue(db, queue, table, id_column, posted_column, count):
+
+    rows = db.execute(
+        _get_queue_sql(table, id_column, posted_column), (queue, count)
+    ).fetchall()
+
+    if rows:
+        # Remove the ids returned and the ones before them that have been
+        # posted
+        db.execute(
+            f"DELETE FROM {QUEUE_TABLE} WHERE profile = ? AND position <= ?",
+            (queue, rows[-1][0]),
+        )
+
+    return [row[1] for row in rows]
+
+
+def _fill_queue(db, queue, table, id_column, posted_column, where=None):
+
+    ids = get_ids(table, id_column, posted_column, where=where, unposted=True)
+    random.shuffle(ids)
+
+    db.execute(f"DELETE FROM {QUEUE_TABLE} WHERE profile = ?", (queue,))
+    db.executemany(
+        f"INSERT INTO {QUEUE_TABLE} (profile, position, id) VALUES (?, ?, ?)",
+        ((queue, position, id_) for position, id_ in enumerate(ids)),
+    )
+
+
+def _posted_after(posted_column):
+
+    # Mastodon status ids grow over time, so the posts sent after another one
+    # have a higher id
+    return f"CAST({posted_column} AS INTEGER) > ?"
+
+
+def _get_posts_sql(table, key_column, posted_column, where=None, since=False):
+
+    conditions = [f"{posted_column} IS NOT NULL"]
+    if where:
+        conditions.append(f"({where})")
+    if since:
+        conditions.append(_posted_after(posted_column))
+
+    return (
+        f"SELECT {key_column}, {posted_column} FROM {table} "
+        f"WHERE {' AND '.join(conditions)}"
+    )
+
+
+def iter_posts(table, key_column, posted_column, where=None, since=None):
+    """
+    Returns an iterator with tuples of the feature id (from ``key_column``)
+    and the post id of the features that have been posted.
+
+    Rows are fetched from the database as the iterator is consumed, so
+    memory use does not grow with the number of posts.
+
+    :param since: only return the posts with an id higher than this one
+    """
+    sql = _get_posts_sql(table, key_column, posted_column, where, since is not None)
+    params = [int(since)] if since is not None else []
+
+    yield from get_connection().execute(sql, params)
+
+
+def get_row_count(table):
+    """
+    Returns the number of rows of a table according to the statistics stored
+    by the last ``ANALYZE`` (run by ``munibot db``), or None if there are no
+    statistics for it.
+
+    This avoids scanning the whole table, but the value is not updated when
+    rows are added or removed until ``ANALYZE`` is run again.
+    """
+    db = get_connection()
+    try:
+        stats = db.execute(
+            "SELECT idx, stat FROM sqlite_stat1 WHERE tbl = ?", (table,)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # ANALYZE was never run
+        return None
+
+    # Partial indexes only count some of the rows
+    partial = {
+        row[1] for row in db.execute(f"PRAGMA index_list({table})") if row[4]
+    }
+
+    for index, stat in stats:
+        if index not in partial:
+            return int(stat.split()[0])
+
+    return None
+
+
+def count_posts(table, posted_column, where=None):
+    """
+    Returns a tuple with the number of features in the table and the number
+    of them that have been posted.
+
+    If there is no extra filter the number of features is taken from the
+    table statistics if available (see ``get_row_count``). The posted ones
+    are counted using the partial index created by ``munibot db``.
+    """
+    db = get_connection()
+
+    total = None if where else get_row_count(table)
+    if total is None:
+        sql = f"SELECT COUNT(*) FROM {table}"
+        if where:
+            sql += f" WHERE {where}"
+        total = db.execute(sql).fetchone()[0]
+
+    sql = f"SELECT COUNT(*) FROM {table} WHERE {posted_column} IS NOT NULL"
+    if where:
+        sql += f" AND ({where})"
+    posted = db.execute(sql).fetchone()[0]
+
+    return total, posted
+
+
+WATERMARKS_TABLE = "munibot_watermarks"
+
+
+def _create_watermarks(db):
+
+    db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {WATERMARKS_TABLE} (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated REAL NOT NULL
+        )
+        """
+    )
+
+
+def get_watermark(name):
+    """
+    Returns the last value stored with ``set_watermark`` for ``name``, or
+    None if there is none.
+    """
+    db = get_connection()
+    _create_watermarks(db)
+
+    row = db.execute(
+        f"SELECT value FROM {WATERMARKS_TABLE} WHERE name = ?", (name,)
+    ).fetchone()
+
+    return row[0] if row else None
+
+
+def set_watermark(name, value):
+    """
+    Stores a value to keep track of the progress of an incremental process,
+    like the id of the last post dumped.
+    """
+    db = get_connection()
+    with db:
+        _create_watermarks(db)
+        db.execute(
+            f"INSERT OR REPLACE INTO {WATERMARKS_TABLE} (name, value, updated) "
+            "VALUES (?, ?, ?)",
+            (name, str(value), time.time()),
+        )
+
+
+def get_tables(profiles):
+    """
+    Returns the tables of the munibot database needed by the provided
+    profiles (the ones that define ``db_table``).
+
+    The result is a dict with the table names as keys and dicts with the
+    ``columns`` (a dict of column names and SQLite types) and the
+    ``indexes`` (a dict of index names and definitions) as values.
+    """
+    tables = {}
+    for profile in profiles:
+        if not profile.db_table:
+            continue
+        table = tables.setdefault(
+            profile.db_table, {"columns": {}, "indexes": {}}
+        )
+        table["columns"].setdefault(profile.db_id_column, "TEXT")
+        for column, type_ in profile.db_columns.items():
+            table["columns"].setdefault(column, type_)
+        table["columns"].setdefault(profile.db_posted_column, "TEXT")
+
+        table["indexes"].update(
+            _get_indexes(
+                profile.db_table,
+                profile.db_id_column,
+                profile.db_posted_column,
+                profile.db_indexes,
+            )
+        )
+
+    return tables
+
+
+def _get_columns(db, table):
+
+    return [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+
+
+def init_db(profiles, create=True):
+    """
+    Creates or upgrades the tables of the munibot database needed by the
+    provided profiles.
+
+    Missing columns are added to the existing tables, and the indexes used by
+    the profiles are created. Finally the database statistics are updated
+    with ``ANALYZE`` so SQLite can choose the best indexes.
+
+    :param create: create the tables that don't exist yet. If False, they are
+        skipped.
+
+    :returns: a dict with the table names as keys and the action performed
+        ("created", "upgraded", "up to date" or "missing") as values
+    """
+    db = get_connection()
+
+    result = {}
+    with db:
+        _create_queue(db)
+
+        for name, table in get_tables(profiles).items():
+            existing = _get_columns(db, name)
+            if not existing:
+                if not create:
+                    result[name] = "missing"
+                    continue
+                columns = ", ".join(
+                    f"{column} {type_}" for column, type_ in table["columns"].items()
+                )
+                db.execute(f"CREATE TABLE {name} ({columns})")
+                result[name] = "created"
+            else:
+                # Column names are case insensitive in SQLite
+                existing = [column.lower() for column in existing]
+                missing = [
+                    column
+                    for column in table["columns"]
+                    if column.lower() not in existing
+                ]
+                for column in missing:
+                    db.execute(
+                        f"ALTER TABLE {name} "
+                        f"ADD COLUMN {column} {table['columns'][column]}"
+                    )
+                result[name] = "upgraded" if missing else "up to date"
+
+            _create_indexes(db, table["indexes"])
+
+        db.execute("ANALYZE")
+
+    return result
+
+
+def get_query_plans(profile):
+    """
+    Returns the query plans of the queries run on the munibot database by
+    the hooks of a profile that defines ``db_table``, to check that they
+    use the right indexes.
+
+    :returns: a list of tuples with the hook names and the query plan, as a
+        list of the steps reported by SQLite
+    """
+    table = profile.db_table
+    id_column = profile.db_id_column
+    posted_column = profile.db_posted_column
+    where = profile.db_filter
+
+    queries = [
+        (
+            "get_text, get_lon_lat, after_post",
+            f"SELECT * FROM {table} WHERE {id_column} = ?",
+            ("",),
+        ),
+        (
+            "get_next_id, get_next_ids",
+            _get_queue_sql(table, id_column, posted_column),
+            (profile.id, 1),
+        ),
+        (
+            "get_ids",
+            _get_ids_sql(table, id_column, posted_column, where, unposted=True),
+            (),
+        ),
+        (
+            "get_posts",
+            _get_posts_sql(
+                table,
+                profile.db_dump_column or id_column,
+                posted_column,
+                where,
+            ),
+            (),
+        ),
+    ]
+
+    db = get_connection()
+
+    return [
+        (
+            hooks,
+            [row[-1] for row in db.execute(f"EXPLAIN QUERY PLAN {sql}", params)],
+        )
+        for hooks, sql, params in queries
+    ]
@@ -0,0 +1,181 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import config, get_logger
+from .db import get_watermark, set_watermark
+
+DUMP_FILE_PREFIX = "\nwindow.MunibotPosts = "
+
+DUMP_FILE_SUFFIX = "\n\n"
+
+
+def _get_watermark_name(profile):
+
+    return f"dump:{profile.id}"
+
+
+def _as_int(value):
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def write_dump(out, host, account, posts, total, posted, since=None):
+    """
+    Writes the JS file used by the map app to the ``out`` file-like object.
+
+    ``posts`` is an iterable of (feature id, post id) tuples, which is
+    encoded and written one item at a time, so it is never loaded fully in
+    memory.
+
+    Returns the highest numeric post id written, or None if there were none.
+    """
+    encode = json.JSONEncoder(ensure_ascii=True).encode
+
+    out.write(DUMP_FILE_PREFIX)
+    out.write(
+        '{"mastodon": {'
+        f'"host": {encode(host)}, "account": {encode(account)}, "posts": {{'
+    )
+
+    last_post = None
+    for index, (id_, post_id) in enumerate(posts):
+        if index:
+            out.write(", ")
+        out.write(f"{encode(str(id_))}: {encode(post_id)}")
+
+        post_number = _as_int(post_id)
+        if post_number is not None:
+            last_post = max(post_number, last_post or post_number)
+
+    out.write(f'}}, "total": {total}, "posted": {posted}')
+    if since is not None:
+        out.write(f', "since": {encode(str(since))}')
+    out.write("}}")
+    out.write(DUMP_FILE_SUFFIX)
+
+    return last_post
+
+
+def dump_posts(profile, output=None, incremental=False):
+    """
+    Writes the posts sent by a profile to a JS file that can be used in the
+    map app, or to the standard output if ``output`` is not provided.
+
+    The posts are streamed from the profile ``get_posts`` hook to the output.
+    If ``incremental`` is True only the posts sent after the last incremental
+    dump are included (the ``since`` key of the output contains the previous
+    post id), and the id of the last post dumped is stored in the munibot
+    database for the next one. Full dumps don't change it.
+
+    Profiles that only implement ``posts_dump`` are supported, but not in
+    incremental mode.
+
+    Returns the number of posts written.
+    """
+    profile_config = config[f"profile:{profile.id}"]
+
+    since = get_watermark(_get_watermark_name(profile)) if incremental else None
+
+    try:
+        total, posted = profile.get_counts()
+        posts = profile.get_posts(since=since)
+    except NotImplementedError:
+        if incremental:
+            raise ValueError(
+                f"Profile {profile.id} does not support incremental dumps"
+            )
+        total, posts_dict = profile.posts_dump()
+        posted = len(posts_dict)
+        posts = posts_dict.items()
+
+    written = 0
+
+    def counted(posts):
+        nonlocal written
+        for post in posts:
+            written += 1
+            yield post
+
+    args = (
+        profile_config["mastodon_api_base_url"],
+        profile_config["mastodon_account_name"],
+        counted(posts),
+        total,
+        posted,
+        since,
+    )
+
+    if output:
+        # Written to a temporary file first, so the map app never reads a
+        # partial dump
+        tmp_output = f"{output}.tmp"
+        with open(tmp_output, "w") as f:
+            last_post = write_dump(f, *args)
+        os.replace(tmp_output, output)
+    else:
+        last_post = write_dump(sys.stdout, *args)
+
+    previous = _as_int(since)
+    if (
+        incremental
+        and last_post is not None
+        and (previous is None or last_post > previous)
+    ):
+        set_watermark(_get_watermark_name(profile), last_post)
+
+    return written
+
+
+def get_dump_path(profile, output_dir=".", since=None):
+    """
+    Returns the path of the dump file of a profile when dumping many profiles
+    at once: ``<profile id>.js``, or ``<profile id>.since-<since>.js`` for
+    incremental dumps that only include the posts sent after ``since``, so
+    they don't replace the full dump used by the map app.
+    """
+    if since is not None:
+        return os.path.join(output_dir, f"{profile.id}.since-{since}.js")
+
+    return os.path.join(output_dir, f"{profile.id}.js")
+
+
+def dump_profiles(profiles, output_dir=".", incremental=False, threads=None):
+    """
+    Writes the dump files of many profiles in a single run, to the paths
+    returned by ``get_dump_path`` in ``output_dir``.
+
+    Profiles are dumped one after the other, sharing the same database
+    connection. If ``threads`` is higher than one, the files are written in
+    a pool of threads instead, each one with its own connection.
+
+    Returns a dict with the number of posts written for each profile id, or
+    the exception raised if the dump failed.
+    """
+    log = get_logger(__name__)
+
+    def dump(profile):
+        try:
+            since = (
+                get_watermark(_get_watermark_name(profile)) if incremental else None
+            )
+            written = dump_posts(
+                profile, get_dump_path(profile, output_dir, since), incremental
+            )
+            log.info(f"Dumped {written} posts of profile {profile.id}")
+            return written
+        except Exception as e:
+            log.error(f"Could not dump profile {profile.id}: {e}")
+            return e
+
+    if threads and threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(dump, profiles))
+    else:
+        results = [dump(profile) for profile in profiles]
+
+    return {profile.id: result for profile, result in zip(profiles, results)}
@@ -0,0 +1,474 @@
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+DEFAULT_PORT = 8765
+
+"""
+Areas (minx, miny, maxx, maxy) where the fake features are placed for each
+kind of endpoint, roughly matching the countries of the built-in profiles.
+"""
+REGIONS = {
+    "wfs": (-6.0, 37.0, 3.0, 43.0),
+    "apicarto": (-1.0, 43.5, 6.0, 49.5),
+    "arcgis": (-110.0, 30.0, -80.0, 45.0),
+}
+
+# Radius of the fake features, in degrees
+FEATURE_RADIUS = 0.03
+
+WMS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Service>
+    <Name>WMS</Name>
+    <Title>munibot fake WMS</Title>
+  </Service>
+  <Capability>
+    <Request>
+      <GetCapabilities>
+        <Format>text/xml</Format>
+        <DCPType><HTTP><Get>
+          <OnlineResource xlink:type="simple" xlink:href="{url}"/>
+        </Get></HTTP></DCPType>
+      </GetCapabilities>
+      <GetMap>
+        <Format>image/tiff</Format>
+        <Format>image/geotiff</Format>
+        <Format>image/jpeg</Format>
+        <Format>image/png</Format>
+        <DCPType><HTTP><Get>
+          <OnlineResource xlink:type="simple" xlink:href="{url}"/>
+        </Get></HTTP></DCPType>
+      </GetMap>
+    </Request>
+    <Exception>
+      <Format>XML</Format>
+    </Exception>
+    <Layer>
+      <Title>Fake layers</Title>
+      <CRS>EPSG:4258</CRS>
+      <CRS>EPSG:4326</CRS>
+      <CRS>CRS:84</CRS>
+      <Layer queryable="0">
+        <Name>{layer}</Name>
+        <Title>Fake orthophoto</Title>
+        <EX_GeographicBoundingBox>
+          <westBoundLongitude>-180</westBoundLongitude>
+          <eastBoundLongitude>180</eastBoundLongitude>
+          <southBoundLatitude>-90</southBoundLatitude>
+          <northBoundLatitude>90</northBoundLatitude>
+        </EX_GeographicBoundingBox>
+      </Layer>
+    </Layer>
+  </Capability>
+</WMS_Capabilities>
+"""
+
+WFS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:WFS_Capabilities version="2.0.0"
+    xmlns:wfs="http://www.opengis.net/wfs/2.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <ows:ServiceIdentification>
+    <ows:Title>munibot fake WFS</ows:Title>
+    <ows:ServiceType>WFS</ows:ServiceType>
+    <ows:ServiceTypeVersion>2.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetCapabilities">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{url}"/></ows:HTTP></ows:DCP>
+    </ows:Operation>
+    <ows:Operation name="GetFeature">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{url}"/></ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <wfs:FeatureTypeList>
+    <wfs:FeatureType>
+      <wfs:Name>au:AdministrativeUnit</wfs:Name>
+      <wfs:Title>Fake administrative units</wfs:Title>
+      <wfs:DefaultCRS>urn:ogc:def:crs:EPSG::4258</wfs:DefaultCRS>
+      <ows:WGS84BoundingBox>
+        <ows:LowerCorner>-180 -90</ows:LowerCorner>
+        <ows:UpperCorner>180 90</ows:UpperCorner>
+      </ows:WGS84BoundingBox>
+    </wfs:FeatureType>
+  </wfs:FeatureTypeList>
+</wfs:WFS_Capabilities>
+"""
+
+WFS_FEATURE = """<?xml version="1.0" encoding="UTF-8"?>
+<au:AdministrativeUnit gml:id="{gml_id}"
+    xmlns:au="http://inspire.ec.europa.eu/schemas/au/4.0"
+    xmlns:gml="http://www.opengis.net/gml/3.2">
+  <au:geometry>
+    <gml:MultiSurface gml:id="{gml_id}_geometry" srsName="urn:ogc:def:crs:EPSG::4258">
+      <gml:surfaceMember>
+        <gml:Polygon gml:id="{gml_id}_polygon">
+          <gml:exterior>
+            <gml:LinearRing>
+              <gml:posList>{pos_list}</gml:posList>
+            </gml:LinearRing>
+          </gml:exterior>
+        </gml:Polygon>
+      </gml:surfaceMember>
+    </gml:MultiSurface>
+  </au:geometry>
+</au:AdministrativeUnit>
+"""
+
+
+def _seed(value):
+
+    return int(hashlib.sha256(str(value).encode("utf8")).hexdigest()[:8], 16)
+
+
+def fake_feature(id_, region, vertices=200):
+    """
+    Returns a GeoJSON-like Polygon for a feature id, always the same for the
+    same id and region. It has a jagged outline with ``vertices`` vertices.
+    """
+    rng = random.Random(_seed(id_))
+    minx, miny, maxx, maxy = region
+    center = (rng.uniform(minx, maxx), rng.uniform(miny, maxy))
+
+    ring = []
+    for index in range(vertices):
+        angle = 2 * math.pi * index / vertices
+        radius = FEATURE_RADIUS * rng.uniform(0.8, 1.2)
+        ring.append(
+            [
+                round(center[0] + radius * math.cos(angle), 6),
+                round(center[1] + radius * math.sin(angle), 6),
+            ]
+        )
+    ring.append(ring[0])
+
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def _bounds(geometry):
+
+    xs = [x for x, _ in geometry["coordinates"][0]]
+    ys = [y for _, y in geometry["coordinates"][0]]
+
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+class FakeServer:
+    """
+    HTTP server that stands in for the services used by the built-in
+    profiles, so they can be run (and load tested) offline.
+
+    It serves WMS GetCapabilities and GetMap requests (images are read from
+    the ``raster`` file if provided, or generated), WFS 2.0.0
+    GetCapabilities and GetFeatureById requests, apicarto-like commune
+    requests and ArcGIS-like ``query`` requests. Features are generated from
+    their id, so any id is valid.
+
+    The original host is expected as the first part of the path, e.g.
+    ``http://localhost:8765/apicarto.ign.fr/api/cadastre/commune``, which is
+    what the shared session does when the ``fake_server`` option of the
+    ``[services]`` section is set.
+
+    :param latency: seconds to wait before answering each request
+    :param latency_jitter: maximum random seconds added to ``latency``
+    :param failure_rate: fraction (0-1) of requests answered with a
+        ``failure_status`` error
+    :param seed: seed for the latency and failures, to make runs repeatable
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=DEFAULT_PORT,
+        latency=0,
+        latency_jitter=0,
+        failure_rate=0,
+        failure_status=503,
+        raster=None,
+        vertices=200,
+        seed=None,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.raster = raster
+        self.vertices = vertices
+
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._thread = None
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake_server = self
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def should_fail(self):
+        return self.failure_rate and self._random.random() < self.failure_rate
+
+    def wait(self):
+        delay = self.latency + self._random.uniform(0, self.latency_jitter)
+        if delay:
+            time.sleep(delay)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """
+        Starts the server in a background thread.
+        """
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True, name="munibot-fake-server"
+        )
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Responses
+
+    def get_map(self, params):
+        """
+        Returns the content type and bytes of the image for a WMS GetMap
+        request.
+        """
+        from owslib.crs import Crs
+
+        bbox = [float(c) for c in params["bbox"].split(",")]
+        crs = params.get("crs") or params.get("srs") or "EPSG:4326"
+        if params.get("version") == "1.3.0" and Crs(crs).axisorder == "yx":
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        width = int(float(params["width"]))
+        height = int(float(params["height"]))
+        image_format = params.get("format", "image/tiff")
+
+        array = self._read_image(bbox, width, height)
+
+        if "tiff" in image_format:
+            return "image/tiff", self._to_geotiff(array, bbox, crs)
+
+        from PIL import Image
+
+        pil_format = "PNG" if "png" in image_format else "JPEG"
+        out = io.BytesIO()
+        Image.fromarray(array.transpose(1, 2, 0)).save(out, format=pil_format)
+
+        return f"image/{pil_format.lower()}", out.getvalue()
+
+    def _read_image(self, bbox, width, height):
+
+        import numpy
+
+        if self.raster:
+            import rasterio
+            import rasterio.windows
+
+            with rasterio.open(self.raster) as src:
+                window = rasterio.windows.from_bounds(*bbox, transform=src.transform)
+                array = src.read(
+                    indexes=[1, 2, 3] if src.count >= 3 else [1, 1, 1],
+                    window=window,
+                    out_shape=(3, height, width),
+                    boundless=True,
+                    fill_value=0,
+                )
+            return array.astype(numpy.uint8)
+
+        # A pattern that depends on the coordinates, so overlapping requests
+        # get consistent images
+        xs = numpy.linspace(bbox[0], bbox[2], width)
+        ys = numpy.linspace(bbox[3], bbox[1], height)
+        x, y = numpy.meshgrid(xs, ys)
+        bands = [
+            128 + 100 * numpy.sin(x * 200),
+            128 + 100 * numpy.cos(y * 200),
+            128 + 100 * numpy.sin((x + y) * 100),
+        ]
+
+        return numpy.stack(bands).astype(numpy.uint8)
+
+    def _to_geotiff(self, array, bbox, crs):
+
+        import rasterio
+        import rasterio.transform
+
+        if crs.upper() == "CRS:84":
+            crs = "EPSG:4326"
+
+        bands, height, width = array.shape
+        with rasterio.MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff",
+                width=width,
+                height=height,
+                count=bands,
+                dtype="uint8",
+                crs=crs,
+                transform=rasterio.transform.from_bounds(*bbox, width, height),
+            ) as dst:
+                dst.write(array)
+            return memfile.read()
+
+    def get_wfs_feature(self, id_):
+
+        geometry = fake_feature(id_, REGIONS["wfs"], self.vertices)
+
+        # EPSG:4258 coordinates are in latitude, longitude order
+        pos_list = " ".join(f"{y} {x}" for x, y in geometry["coordinates"][0])
+        gml_id = re.sub(r"\W", "_", id_)
+
+        return WFS_FEATURE.format(gml_id=gml_id, pos_list=pos_list)
+
+    def get_apicarto_commune(self, code_insee):
+
+        geometry = {
+            "type": "MultiPolygon",
+            "coordinates": [
+                fake_feature(code_insee, REGIONS["apicarto"], self.vertices)[
+                    "coordinates"
+                ]
+            ],
+        }
+        bbox = _bounds({"coordinates": geometry["coordinates"][0]})
+
+        return {
+            "type": "FeatureCollection",
+            "bbox": bbox,
+            "features": [
+                {
+                    "type": "Feature",
+                    "id": code_insee,
+                    "geometry": geometry,
+                    "bbox": bbox,
+                    "properties": {"code_insee": code_insee},
+                }
+            ],
+        }
+
+    def get_arcgis_query(self, params):
+
+        match = re.search(r"=\s*'([^']*)'", params.get("where", ""))
+        if not match:
+            return {"error": {"code": 400, "message": "Invalid where clause"}}
+        id_ = match.group(1)
+
+        geometry = fake_feature(id_, REGIONS["arcgis"], self.vertices)
+        bbox = _bounds(geometry)
+
+        if params.get("returnExtentOnly") == "true":
+            return {"extent": {"bbox": bbox}}
+
+        return {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "id": 1,
+                    "geometry": geometry,
+                    "properties": {"STCO_FIPSCODE": id_},
+                }
+            ],
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+
+        fake = self.server.fake_server
+
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        # OGC parameter names are case insensitive
+        ogc_params = {key.lower(): value for key, value in params.items()}
+
+        if parts.path == "/_stats":
+            return self._send(200, "application/json", json.dumps(fake.stats))
+
+        fake.count("requests")
+        fake.wait()
+
+        if fake.should_fail():
+            fake.count("failures")
+            return self._send(fake.failure_status, "text/plain", "Injected failure")
+
+        # The original URL, used in the capabilities documents
+        url = f"https:/{parts.path}?"
+
+        service = ogc_params.get("service", "").upper()
+        request = ogc_params.get("request", "")
+
+        if service == "WMS" and request == "GetCapabilities":
+            fake.count("wms_capabilities")
+            return self._send(
+                200, "text/xml", WMS_CAPABILITIES.format(url=url, layer="0")
+            )
+        if service == "WMS" and request == "GetMap":
+            fake.count("wms_getmap")
+            content_type, data = fake.get_map(ogc_params)
+            return self._send(200, content_type, data)
+        if service == "WFS" and request == "GetCapabilities":
+            fake.count("wfs_capabilities")
+            return self._send(200, "text/xml", WFS_CAPABILITIES.format(url=url))
+        if service == "WFS" and request == "GetFeature":
+            fake.count("wfs_getfeature")
+            id_ = ogc_params.get("id", "")
+            return self._send(200, "text/xml", fake.get_wfs_feature(id_))
+        if parts.path.endswith("/api/cadastre/commune"):
+            fake.count("apicarto")
+            data = fake.get_apicarto_commune(params.get("code_insee", ""))
+            return self._send(200, "application/json", json.dumps(data))
+        if parts.path.endswith("/query"):
+            fake.count("arcgis_query")
+            data = fake.get_arcgis_query(params)
+            return self._send(200, "application/json", json.dumps(data))
+
+        fake.count("not_found")
+        self._send(404, "text/plain", "Not found")
+
+    def _send(self, status, content_type, body):
+
+        if isinstance(body, str):
+            body = body.encode("utf8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
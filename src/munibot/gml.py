@@ -0,0 +1,134 @@
+import io
+import xml.etree.ElementTree as ET
+
+GML_NS = "http://www.opengis.net/gml/3.2"
+
+_MULTI_TAGS = {f"{{{GML_NS}}}MultiSurface", f"{{{GML_NS}}}MultiPolygon"}
+
+_POLYGON_TAGS = {f"{{{GML_NS}}}Polygon", f"{{{GML_NS}}}PolygonPatch"}
+
+_POS_TAGS = {f"{{{GML_NS}}}posList", f"{{{GML_NS}}}pos"}
+
+_RING_TAGS = {
+    f"{{{GML_NS}}}exterior",
+    f"{{{GML_NS}}}interior",
+    f"{{{GML_NS}}}outerBoundaryIs",
+    f"{{{GML_NS}}}innerBoundaryIs",
+}
+
+
+def _is_lat_lon(srs_name):
+    """
+    Returns True if the coordinates of the provided CRS are in latitude,
+    longitude order. As in GDAL, only CRSs defined as URNs or OGC URLs follow
+    the EPSG axis order, the rest are considered to be longitude, latitude.
+    """
+    from owslib.crs import Crs
+
+    if not srs_name or not srs_name.startswith(
+        ("urn:", "http://www.opengis.net/def/crs")
+    ):
+        return False
+
+    return Crs(srs_name).axisorder == "yx"
+
+
+def parse_geometry(content, container_tag=None):
+    """
+    Parses the first GML 3.2 polygonal geometry (Polygon, Surface,
+    MultiSurface or MultiPolygon) of a GML document, like a WFS GetFeature
+    response.
+
+    The document is parsed incrementally, reading the coordinates of each
+    ring straight into arrays, so there is no need to serialize the geometry
+    again and read it with OGR.
+
+    Coordinates in latitude, longitude order (e.g. ``EPSG::4258`` URNs) are
+    swapped, so the returned geometry is always in longitude, latitude order
+    like the ones returned by fiona.
+
+    :param content: the GML document
+    :type content: bytes or file-like object
+    :param container_tag: if provided, only geometries inside elements with
+        this tag (e.g. ``{http://inspire.ec.europa.eu/schemas/au/4.0}geometry``)
+        are considered
+    :type container_tag: string
+
+    :returns: a tuple with the bounds of the geometry (minx, miny, maxx, maxy)
+        and the geometry as a GeoJSON-like dict
+    :rtype: tuple
+    """
+    import numpy
+
+    if isinstance(content, bytes):
+        content = io.BytesIO(content)
+
+    polygons = []
+    rings = None
+    ring_parts = None
+    is_multi = False
+    srs_name = None
+    srs_dimension = 2
+    # Whether the parser is inside the container and a geometry
+    in_container = container_tag is None
+    in_geometry = False
+
+    for event, element in ET.iterparse(content, events=("start", "end")):
+        tag = element.tag
+
+        if event == "start":
+            if tag == container_tag:
+                in_container = True
+            elif in_container and not in_geometry and (
+                tag in _MULTI_TAGS or tag in _POLYGON_TAGS
+            ):
+                in_geometry = True
+                is_multi = tag in _MULTI_TAGS
+            if in_geometry:
+                srs_name = element.get("srsName", srs_name)
+                srs_dimension = int(element.get("srsDimension", srs_dimension))
+                if tag in _POLYGON_TAGS:
+                    rings = []
+                elif tag in _RING_TAGS:
+                    ring_parts = []
+            continue
+
+        if not in_geometry:
+            if tag == container_tag:
+                in_container = False
+            continue
+
+        if tag in _POS_TAGS and ring_parts is not None and element.text:
+            dimension = int(element.get("srsDimension", srs_dimension))
+            coordinates = numpy.array(element.text.split(), dtype=float)
+            ring_parts.append(coordinates.reshape(-1, dimension)[:, :2])
+        elif tag in _RING_TAGS and rings is not None:
+            rings.append(numpy.concatenate(ring_parts))
+            ring_parts = None
+        elif tag in _POLYGON_TAGS:
+            polygons.append(rings)
+            rings = None
+            if not is_multi:
+                break
+        elif tag in _MULTI_TAGS:
+            break
+
+        element.clear()
+
+    if not polygons:
+        raise ValueError("No polygonal geometry found in the GML document")
+
+    if _is_lat_lon(srs_name):
+        polygons = [[ring[:, ::-1] for ring in polygon] for polygon in polygons]
+
+    exteriors = numpy.concatenate([polygon[0] for polygon in polygons])
+    minx, miny = exteriors.min(axis=0)
+    maxx, maxy = exteriors.max(axis=0)
+
+    coordinates = [[ring.tolist() for ring in polygon] for polygon in polygons]
+    if is_multi:
+        geometry = {"type": "MultiPolygon", "coordinates": coordinates}
+    else:
+        geometry = {"type": "Polygon", "coordinates": coordinates[0]}
+
+    return (float(minx), float(miny), float(maxx), float(maxy)), geometry
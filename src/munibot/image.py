@@ -1,16 +1,206 @@
 import io
 import time
-
-import numpy
-import rasterio
-import rasterio.mask
-import rasterio.plot
-from PIL import Image
+from collections import namedtuple
 
 from .config import config, get_logger
+from .instrumentation import count, instrumented
+from .timings import Timings
+
+# numpy, rasterio and PIL are imported in the functions that use them, so
+# commands that don't create images start faster
 
 MASK_OPACITY = 70
 
+# Images with more pixels than this are masked in windows of rows, to limit
+# the size of the temporary arrays
+DEFAULT_MASK_WINDOW_PIXELS = 1024 * 1024
+
+# Tolerance, in pixels of the base image, used to simplify the boundaries
+# before masking
+DEFAULT_SIMPLIFY_TOLERANCE = 0.5
+
+# Geometries with fewer vertices than this are not worth simplifying
+SIMPLIFY_MIN_VERTICES = 1000
+
+
+"""
+A decoded raster image, shared by the masking and compositing stages so the
+base image only needs to be parsed once.
+
+``array`` contains the pixel values with shape (bands, rows, cols),
+``transform`` is the affine transform of the image and ``nodata`` its
+NODATA value as defined in the file (None if not set).
+"""
+Raster = namedtuple("Raster", ["array", "transform", "nodata"])
+
+
+def read_raster(base_image):
+    """
+    Decodes the provided base image into memory.
+
+    :param base_image: A file-like object with the image
+    :type base_image: File-like object
+
+    :returns: the decoded image
+    :rtype: Raster
+    """
+    import rasterio
+
+    if isinstance(base_image, Raster):
+        return base_image
+
+    with rasterio.open(base_image) as base:
+        return Raster(base.read(), base.transform, base.nodata)
+
+
+def _to_shapely(geometry):
+
+    import numpy
+    import shapely
+    import shapely.geometry
+
+    # Building the rings from arrays is much faster than shapely's shape() for
+    # geometries with many vertices
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return shapely.geometry.shape(geometry)
+
+    return shapely.MultiPolygon(
+        [
+            shapely.Polygon(
+                numpy.asarray(rings[0], dtype=float),
+                [numpy.asarray(ring, dtype=float) for ring in rings[1:]],
+            )
+            for rings in polygons
+        ]
+    )
+
+
+def simplify_boundaries(boundaries, pixel_size, tolerance=None):
+    """
+    Returns the boundaries geometry simplified according to the resolution of
+    the base image, removing the vertices that would not change the mask.
+
+    Boundaries can have tens of thousands of vertices, much more detail than
+    an image of ``max_pixel_side`` pixels can show, and masking time grows with
+    the number of vertices. Geometries with few vertices, or with less than one
+    vertex per pixel of outline, are returned unchanged.
+
+    The geometry is simplified with the Douglas-Peucker algorithm. It does not
+    preserve the topology, but with sub-pixel tolerances the changes are not
+    visible in the mask, and it is several times faster than the topology
+    preserving version.
+
+    :param boundaries: a GeoJSON-like dict with the geometry of the boundaries
+    :type boundaries: dict
+    :param pixel_size: size of the base image pixels, in the units of the
+        boundaries coordinate reference system
+    :type pixel_size: float
+    :param tolerance: maximum distance, in pixels, between the simplified and
+        the original geometry. Defaults to the ``simplify_tolerance``
+        configuration option. If 0 the boundaries are returned unchanged.
+    :type tolerance: float
+
+    :returns: a GeoJSON-like dict with the simplified geometry
+    """
+    import shapely
+    import shapely.geometry
+
+    if tolerance is None:
+        tolerance = float(
+            config.get("image", {}).get(
+                "simplify_tolerance", DEFAULT_SIMPLIFY_TOLERANCE
+            )
+        )
+    if not tolerance:
+        return boundaries
+
+    geometry = _to_shapely(boundaries)
+    vertices = shapely.get_num_coordinates(geometry)
+    if vertices < SIMPLIFY_MIN_VERTICES:
+        return boundaries
+
+    # With less than one vertex per pixel of outline on average there is
+    # little to remove
+    if vertices * pixel_size < geometry.length:
+        return boundaries
+
+    simplified = geometry.simplify(tolerance * pixel_size, preserve_topology=False)
+    if simplified.is_empty:
+        return boundaries
+
+    count(
+        "image.vertices_removed", vertices - shapely.get_num_coordinates(simplified)
+    )
+
+    return shapely.geometry.mapping(simplified)
+
+
+def get_mask_band(base_image, boundaries, nodata_value=0, window_pixels=None):
+    """
+    Returns a single band image mask for the base_image provided in the shape
+    of the geometry of the boundaries provided: 255 for the pixels that
+    should be masked (outside the boundaries or NODATA) and 0 for the rest.
+
+    The geometry is rasterized once into the returned array. The NODATA
+    pixels are then checked in windows of rows, so images larger than
+    ``window_pixels`` pixels don't need temporary arrays of the size of the
+    whole image.
+
+    :param base_image: A file-like object with the image, or an already
+        decoded ``Raster``
+    :type base_image: File-like object or Raster
+    :param boundaries: a GeoJSON-like dict with the geometry of the boundaries
+    :type boundaries: dict
+    :param nodata_value: Numeric value that the base image has for NODATA values.
+        Defaults to 0.
+    :type nodata_value: int
+    :param window_pixels: Maximum number of pixels checked at once. Defaults
+        to the ``mask_window_pixels`` configuration option.
+    :type window_pixels: int
+
+    :returns: numpy array of ``uint8`` values with shape (rows, cols)
+    """
+    import numpy
+    import rasterio.features
+
+    raster = read_raster(base_image)
+
+    bands, height, width = raster.array.shape
+
+    if window_pixels is None:
+        window_pixels = int(
+            config.get("image", {}).get(
+                "mask_window_pixels", DEFAULT_MASK_WINDOW_PIXELS
+            )
+        )
+
+    # Pixels outside the boundaries get the NODATA value of the image, as
+    # rasterio.mask.mask would do, so they are masked if it matches
+    # nodata_value. Pixels inside are marked with 1 for now.
+    fill_value = raster.nodata if raster.nodata is not None else 0
+    mask = rasterio.features.rasterize(
+        [(boundaries, 1)],
+        out_shape=(height, width),
+        transform=raster.transform,
+        fill=255 if fill_value == nodata_value else 0,
+        dtype=numpy.uint8,
+    )
+
+    rows = max(1, window_pixels // width) if window_pixels else height
+    for row in range(0, height, rows):
+        window = mask[row : row + rows]
+        inside = window == 1
+        nodata = numpy.all(raster.array[:, row : row + rows] == nodata_value, axis=0)
+
+        window[inside] = 0
+        window[inside & nodata] = 255
+
+    return mask
+
 
 def get_mask(base_image, boundaries, nodata_value=0):
     """
@@ -20,72 +210,151 @@ def get_mask(base_image, boundaries, nodata_value=0):
     The base image and the boundaries geometry must share the same coordinate
     reference system.
 
-    :param base_image: A file-like object with the image
-    :type base_image: File-like object
+    :param base_image: A file-like object with the image, or an already
+        decoded ``Raster``
+    :type base_image: File-like object or Raster
     :param boundaries: a GeoJSON-like dict with the geometry of the boundaries
     :type boundaries: dict
     :param nodata_value: Numeric value that the base image has for NODATA values.
         Defaults to 0.
     :type nodata_value: int
 
-    :returns: numpy-like array that can be transformed into an image
+    :returns: numpy-like array that can be transformed into an image. It is a
+        read-only view of the ``get_mask_band`` result repeated for each band.
     """
-    with rasterio.open(base_image) as base:
-        out_raster, out_transform = rasterio.mask.mask(base, [boundaries])
+    import numpy
+
+    raster = read_raster(base_image)
 
-        out_raster_bool = out_raster == nodata_value
+    mask = get_mask_band(raster, boundaries, nodata_value)
 
-        out_raster_int = out_raster_bool.astype(numpy.uint8)
-        out_raster_int = out_raster_int * 255
+    return numpy.broadcast_to(
+        mask[:, :, numpy.newaxis], mask.shape + (raster.array.shape[0],)
+    )
 
-        out_image_array = rasterio.plot.reshape_as_image(out_raster_int)
 
-        return out_image_array
+def get_alpha(mask_array, alpha):
+    """
+    Returns the alpha channel to apply to the masked areas of the image.
+
+    Pixels that are white (255) in all bands of the mask get the provided
+    ``alpha`` value, the rest are fully transparent.
 
+    :param mask_array: numpy-like array as returned by ``get_mask`` or
+        ``get_mask_band``
+    :type mask_array: array
+    :param alpha: alpha value (0-255) for the masked pixels
+    :type alpha: int
 
-def process_image(base_image, mask_array, output_format="jpeg"):
+    :returns: a single band numpy array of ``uint8`` values
+    """
+    import numpy
+
+    if mask_array.ndim == 2:
+        masked = mask_array == 255
+    else:
+        masked = numpy.all(mask_array == 255, axis=-1)
+
+    return numpy.where(masked, numpy.uint8(alpha), numpy.uint8(0))
+
+
+def process_image(base_image, mask_array, output_format="jpeg", timings=None):
     """
     Create the final image including the aerial imagery background with the
     outside of the featured boundaries masked.
 
-    :param base_image: A file-like object with the image
-    :type base_image: File-like object
-    :param mask_array: numpy-like array that can be transformed into an image
+    :param base_image: A file-like object with the image, or an already
+        decoded ``Raster``
+    :type base_image: File-like object or Raster
+    :param mask_array: numpy-like array as returned by ``get_mask`` or
+        ``get_mask_band``
     :type mask_array: array
     :param output_format: Output image format. Defaults to "jpeg".
     :type output_format: string
+    :param timings: Optional, records the time spent compositing and encoding
+        the image
+    :type timings: Timings
 
     :returns: resulting image saved as JPG
     :rtype: file-like object
     """
+    import rasterio.plot
+    from PIL import Image
 
-    mask = Image.fromarray(mask_array)
-    mask_opacity = int(config["image"]["opacity"])
+    timings = timings or Timings()
 
+    mask_opacity = int(config["image"]["opacity"])
     alpha = int(mask_opacity * 255 / 100)
-    mask.putalpha(alpha)
 
-    pixels = mask.load()
+    raster = read_raster(base_image)
 
-    for x in range(mask.size[0]):
-        for y in range(mask.size[1]):
-            r, g, b, a = pixels[x, y]
-            if r == g == b == 255:
-                pixels[x, y] = (r, g, b, a)
-            else:
-                pixels[x, y] = (r, g, b, 0)
+    with timings.stage("composite"):
+        alpha_array = get_alpha(mask_array, alpha)
 
-    back = Image.open(base_image)
-    back.paste(mask, (0, 0), mask)
+        if raster.array.shape[0] == 1:
+            back = Image.fromarray(raster.array[0])
+        else:
+            back = Image.fromarray(rasterio.plot.reshape_as_image(raster.array))
+        back.paste("white", (0, 0) + back.size, Image.fromarray(alpha_array))
 
     out = io.BytesIO()
 
-    back.save(out, format=output_format)
+    with timings.stage("encode"):
+        back.save(out, format=output_format)
 
     return out
 
 
-def create_image(profile, id_, output=None):
+@instrumented("image.render_image")
+def render_image(
+    base_image, boundaries, nodata_value=0, output_format="jpeg", timings=None
+):
+    """
+    Renders the final image from the base image and the boundaries of the
+    feature.
+
+    This is the CPU-bound part of the image creation, that does not need the
+    profile, so it can be run in a separate process.
+
+    :param base_image: A file-like object with the image, or an already
+        decoded ``Raster``
+    :type base_image: File-like object or Raster
+    :param boundaries: a GeoJSON-like dict with the geometry of the boundaries
+    :type boundaries: dict
+    :param nodata_value: Numeric value that the base image has for NODATA values.
+        Defaults to 0.
+    :type nodata_value: int
+    :param output_format: Output image format. Defaults to "jpeg".
+    :type output_format: string
+    :param timings: Optional, records the time spent in each rendering stage
+    :type timings: Timings
+
+    :returns: resulting image
+    :rtype: file-like object
+    """
+    log = get_logger(__name__)
+
+    timings = timings or Timings()
+
+    with timings.stage("decode"):
+        raster = read_raster(base_image)
+    log.debug("Base image decoded")
+
+    count("image.pixels_processed", raster.array.shape[1] * raster.array.shape[2])
+
+    with timings.stage("simplify"):
+        pixel_size = min(abs(raster.transform.a), abs(raster.transform.e))
+        boundaries = simplify_boundaries(boundaries, pixel_size)
+
+    with timings.stage("mask"):
+        mask = get_mask_band(raster, boundaries, nodata_value)
+    log.debug("Image mask created")
+
+    return process_image(raster, mask, output_format, timings=timings)
+
+
+@instrumented("image.create_image")
+def create_image(profile, id_, output=None, timings=None):
     """
     Creates the image to post for the provided profile and id
 
@@ -97,6 +366,10 @@ def create_image(profile, id_, output=None):
         saved as a JPG file in that location. If not (the default) a file-like
         object will be returned instead.
     :type output: string
+    :param timings: Optional, records the time spent in each stage. If not
+        provided, the timings are written to the timings log (see
+        ``Timings.log``) once the image is created.
+    :type timings: Timings
 
     :returns: a file-like object with the generated image (or None
         if ``output`` is provided)
@@ -106,21 +379,27 @@ def create_image(profile, id_, output=None):
     log = get_logger(__name__)
     start = time.perf_counter()
 
-    extent, boundaries = profile.get_boundaries(id_)
+    log_timings = timings is None
+    if log_timings:
+        timings = Timings(profile.id, id_, "create")
+
+    with timings.stage("boundaries"):
+        extent, boundaries = profile.load_boundaries(id_)
     log.debug("Received boundaries from profile ({})".format(extent))
 
-    base_image = profile.get_base_image(extent)
+    with timings.stage("imagery"):
+        base_image = profile.get_base_image(extent)
     log.debug("Received base image from profile")
 
     nodata_value = getattr(profile, "image_nodata_value", 0)
-    mask = get_mask(base_image, boundaries, nodata_value)
-    log.debug("Image mask created")
-
-    final_image = process_image(base_image, mask)
+    final_image = render_image(base_image, boundaries, nodata_value, timings=timings)
 
     end = time.perf_counter()
     log.info(f"Created image {id_}.jpg in {end - start:0.4f} seconds")
 
+    if log_timings:
+        timings.log()
+
     if output:
         with open(output, "wb") as f:
             f.write(final_image.getbuffer())
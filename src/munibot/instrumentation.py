@@ -0,0 +1,178 @@
+import cProfile
+import functools
+import inspect
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Instruments currently receiving the spans and counters
+_instruments = []
+
+_lock = threading.Lock()
+
+
+class Instrument:
+    """
+    Base class for the objects that receive the spans and counters recorded
+    by munibot. Register them with ``add_instrument``.
+    """
+
+    def on_span(self, name, duration, attrs):
+        """
+        Called when a span finishes, with its name, duration in seconds and
+        the attributes passed to ``span``.
+        """
+
+    def on_count(self, name, value, attrs):
+        """
+        Called when a counter is increased.
+        """
+
+
+def add_instrument(instrument):
+    """
+    Starts sending the spans and counters to the provided ``Instrument``.
+    """
+    with _lock:
+        _instruments.append(instrument)
+
+
+def remove_instrument(instrument):
+    with _lock:
+        if instrument in _instruments:
+            _instruments.remove(instrument)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Context manager that measures the time spent in the block and sends it
+    to the registered instruments. It does nothing if there are none.
+    """
+    if not _instruments:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        for instrument in list(_instruments):
+            instrument.on_span(name, duration, attrs)
+
+
+def count(name, value=1, **attrs):
+    """
+    Increases the ``name`` counter (e.g. bytes downloaded, pixels processed or
+    cache hits) in the registered instruments.
+    """
+    for instrument in list(_instruments):
+        instrument.on_count(name, value, attrs)
+
+
+def instrumented(name, **attrs):
+    """
+    Decorator that records each call to the decorated function (or coroutine
+    function) as a span.
+    """
+
+    def decorator(func):
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attrs):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **attrs):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Collector(Instrument):
+    """
+    Instrument that aggregates the spans (number of calls, total and maximum
+    duration) and counters received.
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        # Set by profile_run, with the functions that took longer
+        self.profile_stats = None
+        self._lock = threading.Lock()
+
+    def on_span(self, name, duration, attrs):
+        with self._lock:
+            calls, total, maximum = self.spans.get(name, (0, 0, 0))
+            self.spans[name] = (
+                calls + 1,
+                total + duration,
+                max(maximum, duration),
+            )
+
+    def on_count(self, name, value, attrs):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """
+        Returns a text report with the spans, slowest first, the counters and
+        the profile stats if available.
+        """
+        lines = ["Spans:"]
+        for name, (calls, total, maximum) in sorted(
+            self.spans.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            lines.append(
+                f"  {name:<40} {calls:>5} calls {total:>9.4f}s total "
+                f"{maximum:>9.4f}s max"
+            )
+        lines.append("Counters:")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"  {name:<40} {value:>12}")
+        if self.profile_stats:
+            lines.extend(["", self.profile_stats])
+
+        return "\n".join(lines)
+
+
+@contextmanager
+def profile_run(output, sort="cumulative", limit=25):
+    """
+    Context manager that runs the block under ``cProfile`` with a
+    ``Collector`` registered.
+
+    The profile stats are saved to ``output`` (which can be loaded with
+    ``pstats`` or converted to a flame graph with tools like ``flameprof`` or
+    ``snakeviz``). Yields the collector, whose ``report`` also includes the
+    ``limit`` functions that took longer once the block finishes.
+    """
+    collector = Collector()
+    profiler = cProfile.Profile()
+
+    add_instrument(collector)
+    profiler.enable()
+    try:
+        yield collector
+    finally:
+        profiler.disable()
+        remove_instrument(collector)
+
+        profiler.dump_stats(output)
+
+        stats_out = io.StringIO()
+        pstats.Stats(profiler, stream=stats_out).sort_stats(sort).print_stats(limit)
+
+        collector.profile_stats = stats_out.getvalue().strip()
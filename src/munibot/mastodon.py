@@ -1,9 +1,22 @@
 import re
-import tempfile
-
-from mastodon import Mastodon
+import threading
+import time
 
+from . import outbox
 from .config import config, get_logger
+from .instrumentation import count, instrumented
+from .timings import Timings
+
+# Seconds to wait for the server to process an uploaded image
+MEDIA_PROCESSING_TIMEOUT = 60
+
+# Requests to the API needed to send a post (media upload, media processing
+# check and status)
+POST_REQUESTS = 3
+
+_clients = {}
+
+_lock = threading.Lock()
 
 
 def get_client(profile):
@@ -12,19 +25,107 @@ def get_client(profile):
     particular profile.
 
     The returned instance can be used to interact with the Mastodon API using the
-    profile bot account.
+    profile bot account. Instances are created once per process and profile, so
+    long running processes don't set up a new client (and check the server
+    version again) for every post.
     """
+    # Mastodon.py is slow to import, so it's only imported when posting
+    from mastodon import Mastodon
+
+    profile_config = config["profile:" + profile.id]
+
+    key = _get_client_key(profile)
+
+    with _lock:
+        if key not in _clients:
+            _clients[key] = Mastodon(
+                access_token=profile_config["mastodon_access_token"],
+                api_base_url=profile_config["mastodon_api_base_url"],
+            )
+
+        return _clients[key]
+
+
+def _get_client_key(profile):
+
     profile_config = config["profile:" + profile.id]
 
-    mastodon = Mastodon(
-        access_token=profile_config["mastodon_access_token"],
-        api_base_url=profile_config["mastodon_api_base_url"],
+    return (
+        profile.id,
+        profile_config["mastodon_access_token"],
+        profile_config["mastodon_api_base_url"],
     )
 
-    return mastodon
+
+def get_rate_limit_delay(profile, requests=POST_REQUESTS):
+    """
+    Returns the seconds to wait until the profile account can send
+    ``requests`` more requests to its Mastodon instance, according to the
+    rate limit headers of the last response received by its client.
+
+    Returns 0 if there is no need to wait, or if the client was not used yet.
+    """
+    with _lock:
+        client = next(
+            (c for key, c in _clients.items() if key[0] == profile.id), None
+        )
+
+    remaining = getattr(client, "ratelimit_remaining", None)
+    reset = getattr(client, "ratelimit_reset", None)
+    if not isinstance(remaining, int) or not isinstance(reset, (int, float)):
+        return 0
+
+    if remaining >= requests:
+        return 0
+
+    return max(0, reset - time.time())
+
+
+def clear_clients():
+    """
+    Removes all the Mastodon API instances kept in memory.
+    """
+    with _lock:
+        _clients.clear()
+
+
+def wait_for_media(mastodon, media, timeout=MEDIA_PROCESSING_TIMEOUT):
+    """
+    Waits until an uploaded media attachment has been processed by the server
+    and returns its updated version.
+
+    Servers process attachments asynchronously, returning them without a
+    ``url`` until they are ready. They are polled again at increasing
+    intervals, starting with a short one as images are generally processed
+    quickly.
+    """
+    delay = 0.25
+    deadline = time.monotonic() + timeout
+
+    while media.get("url") is None:
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(
+                f"Media {media['id']} not processed after {timeout} seconds"
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+        media = mastodon.media(media["id"])
+
+    return media
 
 
-def send_status(profile, id_, text, image, lon=None, lat=None):
+def get_idempotency_key(profile, id_):
+    """
+    Returns the idempotency key sent when posting the status of a feature.
+    Mastodon returns the status already created for a key instead of
+    creating a new one, for up to one hour.
+    """
+    return f"munibot-{profile.id}-{id_}"
+
+
+@instrumented("mastodon.send_status")
+def send_status(profile, id_, text, image, lon=None, lat=None, timings=None):
     """
     Publish a new status in the profile bot account.
 
@@ -33,6 +134,11 @@ def send_status(profile, id_, text, image, lon=None, lat=None):
     After sending the status it calls the ``after_status()`` method of the provided
     profile, passing the feature id and the new status status id.
 
+    If the outbox is enabled, each stage is recorded there. Calling it again
+    for a feature whose post failed resumes it from the last stage completed,
+    and features already posted are not posted again. Requests that fail
+    with transient errors are retried with an exponential backoff.
+
     :param profile: an instance of the profile class
     :type profile: object
     :param id_: the identifier of the feature
@@ -41,30 +147,91 @@ def send_status(profile, id_, text, image, lon=None, lat=None):
     :type text: string
     :param image: the image to include with the status
     :type image: file-like object
+    :param timings: Optional, records the time spent uploading the image and
+        posting the status. If not provided, the timings are written to the
+        timings log once the status is sent.
+    :type timings: Timings
     """
     log = get_logger(__name__)
 
+    log_timings = timings is None
+    if log_timings:
+        timings = Timings(profile.id, id_, "post")
+
+    # Each stage is recorded in the outbox, so if the post fails it can be
+    # resumed later without uploading the image again
+    entry = {}
+    if outbox.outbox_enabled():
+        entry = outbox.add_entry(profile.id, id_, text, image, lon, lat)
+        if entry["stage"] == outbox.DONE:
+            log.info(
+                f"Feature {id_} on profile {profile.id} already posted, "
+                f"status id: {entry['status_id']}"
+            )
+            return
+
+    def update(**values):
+        entry.update(values)
+        if outbox.outbox_enabled():
+            outbox.update_entry(profile.id, id_, **values)
+
     mastodon = get_client(profile)
 
-    alt_text = re.sub(r'https?://\S+', '', text)
-    alt_text = alt_text.strip()
-    alt_text = f"An aerial image of {alt_text}"
+    try:
+        if not entry.get("media_id"):
+            count("mastodon.bytes_uploaded", image.getbuffer().nbytes)
+            with timings.stage("upload"):
+                media = outbox.with_retries(_upload_image, mastodon, id_, text, image)
+            update(media_id=str(media["id"]), stage=outbox.UPLOADED)
+
+        if not entry.get("status_id"):
+            with timings.stage("post"):
+                status = outbox.with_retries(
+                    mastodon.status_post,
+                    # Add hashtag
+                    text + "\n\n#munibot",
+                    media_ids=[entry["media_id"]],
+                    sensitive=False,
+                    visibility="public",
+                    # The same key is sent when retrying, so if the status
+                    # was created but the response was lost it is not
+                    # posted twice
+                    idempotency_key=get_idempotency_key(profile, id_),
+                )
+            update(status_id=str(status["id"]), stage=outbox.POSTED)
+
+        # Call the after_status method if it exists, otherwise fall back
+        if hasattr(profile, "after_post"):
+            profile.after_post(id_, entry["status_id"])
+    except Exception as e:
+        if outbox.outbox_enabled():
+            outbox.record_failure(profile.id, id_, e)
+        raise
+
+    if outbox.outbox_enabled():
+        outbox.complete_entry(profile.id, id_)
 
-    with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
-        f.write(image.getbuffer())
-        media = mastodon.media_post(f.name, mime_type="image/jpeg", description=alt_text)
+    log.info(
+        f"Status sent for feature {id_} on profile {profile.id}, status id: {entry['status_id']}"
+    )
 
-    # Add hashtag
-    text += "\n\n#munibot"
+    if log_timings:
+        timings.log()
 
-    status = mastodon.status_post(
-        text, media_ids=[media["id"]], sensitive=False, visibility="public"
-    )
 
-    # Call the after_status method if it exists, otherwise fall back
-    if hasattr(profile, "after_post"):
-        profile.after_post(id_, status["id"])
+def _upload_image(mastodon, id_, text, image):
 
-    log.info(
-        f"Status sent for feature {id_} on profile {profile.id}, status id: {status['id']}"
+    alt_text = re.sub(r'https?://\S+', '', text)
+    alt_text = alt_text.strip()
+    alt_text = f"An aerial image of {alt_text}"
+
+    # Upload straight from the in-memory image
+    image.seek(0)
+    media = mastodon.media_post(
+        image,
+        mime_type="image/jpeg",
+        file_name=f"{id_}.jpg",
+        description=alt_text,
     )
+
+    return wait_for_media(mastodon, media)
@@ -1,27 +1,285 @@
 import argparse
-import json
+import asyncio
 import os
 import sys
 from urllib.parse import parse_qs, urlparse
 
+from .batch import (
+    DEFAULT_THREADS,
+    acreate_images,
+    create_images,
+    print_summary,
+    read_ids_file,
+)
+from .cache import boundaries_cache_enabled
+from .cache import get_boundaries as get_cached_boundaries
 from .config import config, load_config, load_profiles, get_logger
+from .db import get_query_plans, init_db
+from .dump import dump_posts, dump_profiles
 from .image import create_image
+from .instrumentation import profile_run
 from .mastodon import send_status
+from .outbox import (
+    FAILED,
+    RENDERED,
+    get_pending,
+    has_entry,
+    outbox_enabled,
+    read_image,
+    update_entry,
+)
+from .serve import DEFAULT_PREFETCH, get_interval, serve_profiles
+from .timings import Timings
 
-DUMP_FILE_TEMPLATE = """
-window.MunibotPosts = {}
-"""
+
+def prewarm(profile, ids=None, refresh=False):
+    """
+    Requests the boundaries of the provided features (or all the profile
+    features if not provided) and stores them in the boundaries cache.
+    """
+    log = get_logger(__name__)
+
+    if not boundaries_cache_enabled():
+        print("The boundaries cache is not enabled, check the [cache] section")
+        sys.exit(1)
+
+    if ids is None:
+        ids = profile.get_ids()
+
+    total = len(ids)
+    fetched = skipped = failed = 0
+    for index, id_ in enumerate(ids, 1):
+        if not refresh and get_cached_boundaries(profile.id, id_):
+            skipped += 1
+            continue
+        try:
+            profile.load_boundaries(id_, refresh=True)
+            fetched += 1
+        except Exception as e:
+            log.warning(f"Could not get boundaries for feature {id_}: {e}")
+            failed += 1
+        log.info(f"Prewarmed {index}/{total} features")
+
+    print(f"{fetched} cached, {skipped} already cached, {failed} failed")
+
+
+def init_database(profiles, create=True):
+    """
+    Creates or upgrades the tables and indexes of the munibot database needed
+    by the provided profiles, and prints the query plans of each profile.
+    """
+    for table, action in init_db(profiles, create=create).items():
+        print(f"Table {table}: {action}")
+
+    for profile in profiles:
+        if not profile.db_table:
+            continue
+        print(f"\nQuery plans for profile {profile.id}:")
+        for hooks, plan in get_query_plans(profile):
+            print(f"  {hooks}:")
+            for step in plan:
+                print(f"    {step}")
+
+
+def get_profile_list(profiles, names, all_profiles=False):
+    """
+    Returns instances of the profiles passed to the commands that accept
+    several of them, separated by commas in ``names``, or of all of them if
+    ``all_profiles`` is True. Exits if any of them is unknown.
+    """
+    if all_profiles:
+        names = list(profiles.keys())
+    else:
+        names = [name.strip() for name in names.split(",")]
+
+    unknown = [name for name in names if name not in profiles]
+    if unknown:
+        print(f"Unknown profile: {', '.join(unknown)}")
+        sys.exit(1)
+
+    return [profiles[name]() for name in names]
+
+
+def serve_profile_list(profiles, interval=None, prefetch=None):
+    """
+    Runs the serve command for the provided profiles, using their own
+    interval and prefetch options unless they are passed.
+    """
+    intervals = {}
+    for profile in profiles:
+        intervals[profile.id] = interval or get_interval(profile)
+        if not intervals[profile.id]:
+            print(
+                f"munibot: error: an interval is needed to run serve "
+                f"(profile {profile.id})"
+            )
+            sys.exit(1)
+
+    posts = serve_profiles(profiles, intervals, prefetch)
+
+    for profile_id, count in posts.items():
+        print(f"{profile_id}: {count} posts")
+
+
+def run_fake_server():
+    """
+    Runs the fake services server until interrupted, with the options of the
+    [fake_server] section.
+    """
+    log = get_logger(__name__)
+
+    from .fake_server import DEFAULT_PORT, FakeServer
+
+    fake_config = config.get("fake_server", {})
+
+    server = FakeServer(
+        host=fake_config.get("host", "127.0.0.1"),
+        port=int(fake_config.get("port", DEFAULT_PORT)),
+        latency=float(fake_config.get("latency", 0)),
+        latency_jitter=float(fake_config.get("latency_jitter", 0)),
+        failure_rate=float(fake_config.get("failure_rate", 0)),
+        raster=fake_config.get("raster"),
+        vertices=int(fake_config.get("vertices", 200)),
+    )
+
+    log.info(f"Fake server running on {server.url}")
+    log.info(f'Set "fake_server = {server.url}" in the [services] section to use it')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        log.info(f"Requests served: {server.stats}")
+
+
+def post_pending(profile):
+    """
+    Resumes the oldest post of the profile that failed and is due to be
+    retried, if any, using the image stored in the outbox.
+
+    Returns the id of the feature posted, or None if there were no pending
+    posts or the post failed again, so a new feature can be posted instead.
+    """
+    log = get_logger(__name__)
+
+    if not outbox_enabled():
+        return None
+
+    pending = get_pending(profile.id)
+    if not pending:
+        return None
+
+    entry = pending[0]
+    log.info(
+        f"Start: resuming status for feature {entry['id']} on profile {profile.id} "
+        f"(stage: {entry['stage']}, attempts: {entry['attempts']})"
+    )
+    # The image is only needed if it was not uploaded yet
+    image = None
+    if entry["stage"] == RENDERED:
+        try:
+            image = read_image(entry)
+        except OSError as e:
+            # It will not be there next time either
+            log.error(
+                f"Could not read the image of feature {entry['id']} on profile "
+                f"{profile.id}, giving up: {e}"
+            )
+            update_entry(profile.id, entry["id"], stage=FAILED, error=str(e))
+            return None
+
+    try:
+        send_status(
+            profile,
+            entry["id"],
+            entry["text"],
+            image,
+            entry["lon"],
+            entry["lat"],
+        )
+    except Exception as e:
+        log.error(
+            f"Could not resume status for feature {entry['id']} on profile "
+            f"{profile.id}: {e}"
+        )
+        return None
+
+    return entry["id"]
+
+
+def get_next_unsent_id(profile, max_tries=100):
+    """
+    Returns the id of the next feature to post on the profile, skipping the
+    ones that are already in the outbox: pending posts are resumed by
+    ``post_pending`` once their backoff is over, and failed ones are not
+    tried again.
+
+    Returns None if there are no more features to post.
+    """
+    log = get_logger(__name__)
+
+    for _ in range(max_tries):
+        id_ = profile.get_next_id()
+        if id_ is None or not outbox_enabled() or not has_entry(profile.id, id_):
+            return id_
+        log.debug(f"Skipping feature {id_} on profile {profile.id}: in the outbox")
+
+    return None
+
+
+def create_or_post(profile, id_, command, output_dir=None):
+    """
+    Creates the image of a feature, and posts it if ``command`` is "post".
+    """
+    log = get_logger(__name__)
+
+    if command == "create":
+        output = f"{id_}.jpg"
+        if output_dir:
+            output = os.path.join(output_dir, output)
+        log.info(f"Start: create image for feature {id_} on profile {profile.id}")
+        create_image(profile, id_, output)
+    elif command == "post":
+        if output_dir:
+            output = os.path.join(output_dir, f"{id_}.jpg")
+        else:
+            output = None
+
+        log.info(f"Start: sending status for feature {id_} on profile {profile.id}")
+        timings = Timings(profile.id, id_, "post")
+        text = profile.get_text(id_)
+        img = create_image(profile, id_, output, timings=timings)
+
+        send_status(profile, id_, text, img, timings=timings)
+        timings.log()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "command",
-        choices=["post", "create", "profiles", "dump"],
+        choices=[
+            "post",
+            "create",
+            "profiles",
+            "dump",
+            "prewarm",
+            "serve",
+            "db",
+            "fake-server",
+        ],
         help="""
 Action to perform. "post" sends out a post, "create" just generates the image locally.
 "profiles" lists all installed profiles and "dump" return a JS file that can be used in
-the map app.""",
+the map app. "prewarm" fills the boundaries cache for all features of a profile
+(or just the one passed with "--id"). "serve" keeps running and sends a post
+every "--interval" seconds, creating the next images in advance (for one or several
+profiles, each one with its own interval). "db init" creates
+the tables and indexes of the database for all profiles, "db upgrade" adds the missing
+columns and indexes to the existing ones. "fake-server" runs a local stand-in for the
+services used by the built-in profiles, configured in the [fake_server] section.""",
     )
     parser.add_argument(
         "profile",
@@ -51,12 +309,118 @@ the map app.""",
         default=None,
         help="""
     Output directory for the generated image (Only used with "create" and "post"). Defaults to the the current folder in "create" and None in "post" (don't save it) .
+    Also used as the output directory of the files when dumping many profiles.
+    """,
+    )
+
+    parser.add_argument(
+        "--ids-file",
+        help="""
+    Path to a text file with the identifiers of the features to create images of,
+    one per line (Only used with "create").
+    """,
+    )
+    parser.add_argument(
+        "--all-unposted",
+        action="store_true",
+        help="""
+    Create images of all the features that have not been posted yet (Only used with "create").
+    """,
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="""
+    Number of processes used to render images when creating many of them.
+    Defaults to the number of CPUs.
+    """,
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help=f"""
+    Number of threads used to request boundaries and base images when creating
+    many of them. Defaults to {DEFAULT_THREADS}. When dumping many profiles, number of
+    files written in parallel (one by default).
+    """,
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="""
+    Use an asyncio event loop and the profile async hooks to request the boundaries
+    and base images when creating many images.
+    """,
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=None,
+        help="""
+    Seconds between posts (Only used with "serve"). Defaults to the "interval"
+    option of the profile section, or the one of the [serve] section.
+    """,
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=None,
+        help=f"""
+    Number of images to create in advance (Only used with "serve"). Defaults to the
+    "prefetch" option of the profile section, the one of the [serve] section, or
+    {DEFAULT_PREFETCH}.
+    """,
+    )
+    parser.add_argument(
+        "--output-file",
+        help="""
+    File to write the dump to (Only used with "dump"). Defaults to the standard output.
+    """,
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="""
+    Dump all profiles (Only used with "dump" and "serve"). Several profiles can also
+    be passed separated by commas. Dump files are written to "--output-dir", as
+    <profile-name>.js.
+    """,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""
+    Only dump the posts sent since the last dump (Only used with "dump").
+    """,
+    )
+    parser.add_argument(
+        "--profile-run",
+        action="store_true",
+        help="""
+    Profile the creation of the image (Only used with "create" and "post"). Prints the
+    time spent in each stage and profile hook, counters like the bytes downloaded
+    and the slowest functions, and saves the cProfile stats to <id>.prof in the
+    output directory, which can be converted to a flame graph.
+    """,
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="""
+    Request the boundaries again even if they are already cached (Only used with "prewarm").
     """,
     )
 
     args = parser.parse_args()
 
-    if args.command != "profiles" and not args.profile:
+    if (
+        args.command not in ("profiles", "fake-server")
+        and not args.profile
+        and not args.all
+    ):
         print("munibot: error: the following arguments are required: profile")
         sys.exit(1)
 
@@ -66,8 +430,22 @@ the map app.""",
         print(str(e))
         sys.exit(1)
 
+    if args.command == "fake-server":
+        run_fake_server()
+        sys.exit()
+
     profiles = load_profiles()
 
+    if args.command == "db":
+        if args.profile not in ("init", "upgrade"):
+            print('munibot: error: use "munibot db init" or "munibot db upgrade"')
+            sys.exit(1)
+        init_database(
+            [profile() for profile in profiles.values()],
+            create=args.profile == "init",
+        )
+        sys.exit()
+
     if args.command == "profiles":
 
         if not profiles:
@@ -75,9 +453,33 @@ the map app.""",
             sys.exit()
         num = len(profiles.keys())
         print(f"{num} profile found:" if num == 1 else f"{num} profiles found:")
-        for name, profile in profiles.items():
-            print(f"{name} - {profile.desc}")
+        for name in profiles:
+            print(f"{name} - {profiles.get_desc(name)}")
+
+        sys.exit()
+
+    if args.command == "dump" and (args.all or "," in args.profile):
+        results = dump_profiles(
+            get_profile_list(profiles, args.profile, args.all),
+            output_dir=args.output_dir or ".",
+            incremental=args.incremental,
+            threads=args.threads,
+        )
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                print(f"{name}: failed ({result})")
+            else:
+                print(f"{name}: {result} posts")
+        sys.exit(
+            1 if any(isinstance(r, Exception) for r in results.values()) else 0
+        )
 
+    if args.command == "serve" and (args.all or "," in args.profile):
+        serve_profile_list(
+            get_profile_list(profiles, args.profile, args.all),
+            args.interval,
+            args.prefetch,
+        )
         sys.exit()
 
     if args.profile not in profiles:
@@ -86,50 +488,60 @@ the map app.""",
 
     profile = profiles[args.profile]()
 
-    if args.id:
-        id_ = args.id
-    else:
-        id_ = profile.get_next_id()
+    if args.command == "prewarm":
+        prewarm(profile, [args.id] if args.id else None, args.refresh)
+        sys.exit()
 
-    if id_ is None:
-        print("No more images to create!")
+    if args.command == "dump":
+        try:
+            dump_posts(profile, args.output_file, args.incremental)
+        except ValueError as e:
+            print(str(e))
+            sys.exit(1)
         sys.exit()
 
-    log = get_logger(__name__)
+    if args.command == "serve":
+        serve_profile_list([profile], args.interval, args.prefetch)
+        sys.exit()
 
-    if args.command == "create":
-        output = f"{id_}.jpg"
-        if args.output_dir:
-            output = os.path.join(args.output_dir, output)
-        log.info(f"Start: create image for feature {id_} on profile {args.profile}")
-        create_image(profile, id_, output)
-    elif args.command == "post":
-        if args.output_dir:
-            output = os.path.join(args.output_dir, f"{id_}.jpg")
+    if args.command == "create" and (args.ids_file or args.all_unposted):
+        if args.ids_file:
+            ids = read_ids_file(args.ids_file)
         else:
-            output = None
+            ids = profile.get_ids(unposted=True)
 
-        log.info(f"Start: sending status for feature {id_} on profile {args.profile}")
-        text = profile.get_text(id_)
-        img = create_image(profile, id_, output)
-
-        send_status(profile, id_, text, img)
-    elif args.command == "dump":
+        batch_options = {
+            "output_dir": args.output_dir or ".",
+            "processes": args.processes,
+            "threads": args.threads,
+        }
+        if args.use_async:
+            summary = asyncio.run(acreate_images(profile, ids, **batch_options))
+        else:
+            summary = create_images(profile, ids, **batch_options)
+        print_summary(summary)
+        sys.exit(1 if summary["failed"] else 0)
 
-        if not hasattr(profile, "posts_dump"):
-            print("Profile has no dump method")
-            sys.exit(1)
+    # Failed posts are sent before new ones
+    if args.command == "post" and not args.id and post_pending(profile):
+        sys.exit()
 
-        count, posts = profile.posts_dump()
+    if args.id:
+        id_ = args.id
+    elif args.command == "post":
+        id_ = get_next_unsent_id(profile)
+    else:
+        id_ = profile.get_next_id()
 
-        profile_config = config[f"profile:{profile.id}"]
+    if id_ is None:
+        print("No more images to create!")
+        sys.exit()
 
-        out = {
-            "mastodon": {
-                "host": profile_config["mastodon_api_base_url"],
-                "account": profile_config["mastodon_account_name"],
-                "posts": posts,
-                "total": count,
-                "posted": len(posts.keys())}
-        }
-        print(DUMP_FILE_TEMPLATE.format(json.dumps(out)))
+    if args.profile_run:
+        stats_path = os.path.join(args.output_dir or ".", f"{id_}.prof")
+        with profile_run(stats_path) as collector:
+            create_or_post(profile, id_, args.command, args.output_dir)
+        print(collector.report())
+        print(f"\nProfile stats saved to {stats_path}")
+    else:
+        create_or_post(profile, id_, args.command, args.output_dir)
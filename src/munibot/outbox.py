@@ -0,0 +1,321 @@
+import io
+import os
+import tempfile
+import time
+
+from .config import config, get_logger
+from .db import get_connection
+
+OUTBOX_TABLE = "munibot_outbox"
+
+# Stages of a post, in order. Each one is recorded once completed, so a failed
+# post can be resumed from the last one.
+RENDERED = "rendered"
+UPLOADED = "uploaded"
+POSTED = "posted"
+DONE = "done"
+# Given up after too many failed attempts
+FAILED = "failed"
+
+DEFAULT_RETRIES = 3
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+DEFAULT_BACKOFF = 2
+
+# Maximum seconds between attempts to resume a post
+MAX_BACKOFF = 60 * 60
+
+# Outbox databases where the table has been created already
+_initialized = set()
+
+
+def _get_outbox_config():
+
+    return config.get("outbox", {})
+
+
+def get_outbox_path():
+    """
+    Returns the path of the SQLite database used to record the posts in
+    progress.
+
+    This is the ``path`` option of the ``[outbox]`` section, falling back to
+    the main ``[db]`` database. Returns None if neither is defined.
+    """
+    return _get_outbox_config().get("path") or config.get("db", {}).get("path")
+
+
+def outbox_enabled():
+    """
+    Returns True if the outbox is enabled, which is the default if a database
+    is available. It can be disabled setting ``enabled=false`` in the
+    ``[outbox]`` section.
+    """
+    enabled = _get_outbox_config().get("enabled", "true")
+
+    return enabled.lower() in ("true", "yes", "on", "1") and bool(get_outbox_path())
+
+
+def get_outbox_dir(profile_id):
+    """
+    Returns the folder where the images of the posts in progress are stored
+    for a profile. It can be set with the ``dir`` option of the ``[outbox]``
+    section, which defaults to a folder in the system temp directory.
+    """
+    outbox_dir = _get_outbox_config().get("dir") or os.path.join(
+        tempfile.gettempdir(), "munibot-outbox"
+    )
+    path = os.path.join(outbox_dir, profile_id)
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+
+def get_backoff(attempt):
+    """
+    Returns the seconds to wait before the provided attempt (starting at 1)
+    to send a post, which double with each attempt. The base is the
+    ``backoff`` option of the ``[outbox]`` section.
+    """
+    backoff = float(_get_outbox_config().get("backoff", DEFAULT_BACKOFF))
+
+    return min(backoff * 2 ** (attempt - 1), MAX_BACKOFF)
+
+
+def get_retries():
+    """
+    Returns the number of times a failed request to the Mastodon API is
+    retried before giving up (``retries`` option of the ``[outbox]``
+    section).
+    """
+    return int(_get_outbox_config().get("retries", DEFAULT_RETRIES))
+
+
+def get_max_attempts():
+    """
+    Returns the number of failed attempts to send a post after which it is
+    given up and marked as failed (``max_attempts`` option of the
+    ``[outbox]`` section).
+    """
+    return int(_get_outbox_config().get("max_attempts", DEFAULT_MAX_ATTEMPTS))
+
+
+def _get_db():
+
+    path = get_outbox_path()
+    db = get_connection(path)
+
+    if path in _initialized:
+        return db
+
+    db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {OUTBOX_TABLE} (
+            profile TEXT NOT NULL,
+            id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            lon REAL,
+            lat REAL,
+            image TEXT,
+            media_id TEXT,
+            status_id TEXT,
+            stage TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (profile, id)
+        )
+        """
+    )
+    db.commit()
+    _initialized.add(path)
+
+    return db
+
+
+def _to_entry(cursor, row):
+
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def get_entry(profile_id, id_):
+    """
+    Returns the outbox entry of a feature as a dict, or None if it was never
+    added.
+    """
+    db = _get_db()
+
+    cursor = db.execute(
+        f"SELECT * FROM {OUTBOX_TABLE} WHERE profile = ? AND id = ?",
+        (profile_id, str(id_)),
+    )
+    row = cursor.fetchone()
+
+    return _to_entry(cursor, row) if row else None
+
+
+def has_entry(profile_id, id_):
+    """
+    Returns True if a feature was added to the outbox, whether its post is
+    still pending, completed or failed.
+    """
+    return get_entry(profile_id, id_) is not None
+
+
+def add_entry(profile_id, id_, text, image, lon=None, lat=None):
+    """
+    Adds a feature about to be posted to the outbox, storing its image in the
+    outbox folder.
+
+    If the feature is already in the outbox the existing entry is returned,
+    so posts that failed half way are resumed from the last stage completed
+    (or not sent again, if they were completed).
+    """
+    entry = get_entry(profile_id, id_)
+    if entry:
+        return entry
+
+    image_path = os.path.join(get_outbox_dir(profile_id), f"{id_}.jpg")
+    tmp_path = f"{image_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(image.getbuffer())
+    os.replace(tmp_path, image_path)
+
+    now = time.time()
+
+    db = _get_db()
+    db.execute(
+        f"""
+        INSERT INTO {OUTBOX_TABLE}
+            (profile, id, text, lon, lat, image, stage, created, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (profile_id, str(id_), text, lon, lat, image_path, RENDERED, now, now),
+    )
+    db.commit()
+
+    return get_entry(profile_id, id_)
+
+
+def update_entry(profile_id, id_, **values):
+    """
+    Updates the provided columns of the outbox entry of a feature.
+    """
+    values["updated"] = time.time()
+    columns = ", ".join(f"{column} = ?" for column in values)
+
+    db = _get_db()
+    db.execute(
+        f"UPDATE {OUTBOX_TABLE} SET {columns} WHERE profile = ? AND id = ?",
+        (*values.values(), profile_id, str(id_)),
+    )
+    db.commit()
+
+
+def complete_entry(profile_id, id_):
+    """
+    Marks the outbox entry of a feature as done and removes its image. The
+    entry is kept, so the feature is not posted again.
+    """
+    entry = get_entry(profile_id, id_)
+    if entry and entry["image"]:
+        try:
+            os.remove(entry["image"])
+        except FileNotFoundError:
+            pass
+
+    update_entry(profile_id, id_, stage=DONE, image=None, error=None)
+
+
+def record_failure(profile_id, id_, error):
+    """
+    Records a failed attempt to send a post, scheduling the next one after an
+    exponential backoff. After ``get_max_attempts()`` attempts the entry is
+    marked as failed and it is not retried anymore.
+    """
+    entry = get_entry(profile_id, id_)
+    if not entry:
+        return
+
+    attempts = entry["attempts"] + 1
+    values = {
+        "attempts": attempts,
+        "next_attempt": time.time() + get_backoff(attempts),
+        "error": str(error),
+    }
+    if attempts >= get_max_attempts():
+        get_logger(__name__).error(
+            f"Giving up posting feature {id_} on profile {profile_id} "
+            f"after {attempts} attempts: {error}"
+        )
+        values["stage"] = FAILED
+
+    update_entry(profile_id, id_, **values)
+
+
+def get_pending(profile_id, due=True):
+    """
+    Returns the outbox entries of a profile that were not completed nor
+    failed, oldest first. If ``due`` is True, only the ones whose next
+    attempt is due.
+    """
+    db = _get_db()
+
+    sql = f"SELECT * FROM {OUTBOX_TABLE} WHERE profile = ? AND stage NOT IN (?, ?)"
+    params = [profile_id, DONE, FAILED]
+    if due:
+        sql += " AND next_attempt <= ?"
+        params.append(time.time())
+    sql += " ORDER BY created"
+
+    cursor = db.execute(sql, params)
+
+    return [_to_entry(cursor, row) for row in cursor]
+
+
+def read_image(entry):
+    """
+    Returns the image stored for an outbox entry.
+
+    :rtype: file-like object
+    """
+    with open(entry["image"], "rb") as f:
+        return io.BytesIO(f.read())
+
+
+def is_transient(error):
+    """
+    Returns True for errors that are likely to go away if the request is
+    sent again, like connection errors, timeouts and server errors.
+    """
+    from mastodon import MastodonNetworkError, MastodonServerError
+
+    return isinstance(error, (MastodonNetworkError, MastodonServerError))
+
+
+def with_retries(func, *args, **kwargs):
+    """
+    Calls ``func`` with the provided arguments, calling it again after an
+    exponential backoff if it fails with a transient error, up to
+    ``get_retries()`` times.
+    """
+    log = get_logger(__name__)
+
+    retries = get_retries()
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            attempt += 1
+            if attempt > retries or not is_transient(e):
+                raise
+            backoff = get_backoff(attempt)
+            log.warning(
+                f"Request failed ({e}), retrying in {backoff:0.1f} seconds "
+                f"({attempt}/{retries})"
+            )
+            time.sleep(backoff)
@@ -1,9 +1,50 @@
+import asyncio
+import functools
+import inspect
 import io
 
 import shapely.geometry
-from owslib.wms import WebMapService
 
+from munibot import cache, db, services
 from munibot.config import config
+from munibot.instrumentation import span
+
+"""
+Profile hooks that are recorded as ``profile.<hook>`` spans (see
+``munibot.instrumentation``), in the base class and all subclasses.
+"""
+INSTRUMENTED_HOOKS = (
+    "get_boundaries",
+    "get_base_image",
+    "get_text",
+    "get_next_id",
+    "get_lon_lat",
+    "after_post",
+    "get_ids",
+    "get_next_ids",
+    "get_posts",
+    "aget_boundaries",
+    "aget_base_image",
+)
+
+
+def _instrument_hook(name, func):
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            with span(f"profile.{name}", profile=self.id):
+                return await func(self, *args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with span(f"profile.{name}", profile=self.id):
+            return func(self, *args, **kwargs)
+
+    return wrapper
 
 
 class BaseProfile:
@@ -34,6 +75,34 @@ class BaseProfile:
     """
     image_nodata_value = 0
 
+    """
+    Table of the munibot database that contains the features of this profile,
+    and the columns with the feature id and the id of the post (NULL if not
+    posted yet). ``db_filter`` is an optional SQL condition to select the
+    features of the profile if the table contains others.
+
+    If defined, they provide default implementations of ``get_next_id``,
+    ``get_next_ids`` and ``get_ids``.
+    """
+    db_table = None
+    db_id_column = None
+    db_posted_column = None
+    db_filter = None
+
+    """
+    Other columns of ``db_table`` used by the profile, as a dict of column
+    names and SQLite types, and the columns that should be indexed. They are
+    used by ``munibot db`` to create or upgrade the munibot database.
+    """
+    db_columns = {}
+    db_indexes = []
+
+    """
+    Column of ``db_table`` used to identify the features in the posts dump
+    used by the map app, if different from ``db_id_column``.
+    """
+    db_dump_column = None
+
     # Mandatory hooks
 
     """
@@ -73,11 +142,19 @@ class BaseProfile:
 
     This is used if the ``munibot post`` command is called withot providing
     an id.
+
+    If the ``db_*`` properties are defined, the id is picked at random
+    among the features not posted yet.
     """
 
     def get_next_id(self):
 
-        raise NotImplementedError
+        if not self.db_table:
+            raise NotImplementedError
+
+        ids = self.get_next_ids(1)
+
+        return ids[0] if ids else None
 
     # Optional hooks
 
@@ -101,8 +178,153 @@ class BaseProfile:
 
         pass
 
+    """
+    Returns a list with the ids of all the features of this profile. If
+    ``unposted`` is True, only the ones that have not been posted yet are
+    returned.
+
+    Used by the commands that work on many features, like ``munibot prewarm``.
+    """
+
+    def get_ids(self, unposted=False):
+
+        if not self.db_table:
+            raise NotImplementedError
+
+        return db.get_ids(
+            self.db_table,
+            self.db_id_column,
+            self.db_posted_column,
+            where=self.db_filter,
+            unposted=unposted,
+        )
+
+    """
+    Returns a list with the ids of the next ``count`` features that should be
+    posted, without repetitions. It can return less if there are no more
+    features to post.
+
+    Used by the commands that prepare many posts in advance, like
+    ``munibot serve``. By default it uses the random sampler if the ``db_*``
+    properties are defined, otherwise it calls ``get_next_id`` repeatedly.
+    """
+
+    def get_next_ids(self, count):
+
+        if self.db_table:
+            return db.sample_ids(
+                self.id,
+                self.db_table,
+                self.db_id_column,
+                self.db_posted_column,
+                where=self.db_filter,
+                count=count,
+            )
+
+        ids = []
+        # get_next_id might return the same id more than once
+        for _ in range(count * 10):
+            if len(ids) == count:
+                break
+            id_ = self.get_next_id()
+            if id_ is None:
+                break
+            if id_ not in ids:
+                ids.append(id_)
+
+        return ids
+
+    """
+    Returns an iterator with the posts sent, as tuples with the feature id
+    used in the map app and the post id. If ``since`` (a post id) is
+    provided, only the posts sent after that one are returned.
+
+    Used by ``munibot dump``. By default the posts are read from the munibot
+    database as the iterator is consumed, if the ``db_*`` properties are
+    defined.
+    """
+
+    def get_posts(self, since=None):
+
+        if not self.db_table:
+            raise NotImplementedError
+
+        return db.iter_posts(
+            self.db_table,
+            self.db_dump_column or self.db_id_column,
+            self.db_posted_column,
+            where=self.db_filter,
+            since=since,
+        )
+
+    """
+    Returns a tuple with the total number of features of the profile and the
+    number of them that have been posted.
+    """
+
+    def get_counts(self):
+
+        if not self.db_table:
+            raise NotImplementedError
+
+        return db.count_posts(
+            self.db_table, self.db_posted_column, where=self.db_filter
+        )
+
+    """
+    Returns a tuple with the total number of features and a dict with the
+    ids of the posts sent, keyed by feature id.
+
+    ``munibot dump`` uses ``get_posts`` instead if available, as it does not
+    need to keep all the posts in memory.
+    """
+
+    def posts_dump(self):
+
+        total, _ = self.get_counts()
+
+        return total, dict(self.get_posts())
+
+    # Async hooks
+
+    """
+    Async version of ``get_boundaries``.
+
+    By default it runs ``get_boundaries`` in a separate thread. Profiles can
+    override it to perform the requests asynchronously.
+    """
+
+    async def aget_boundaries(self, id_):
+
+        return await self._run_in_thread(self.get_boundaries, id_)
+
+    """
+    Async version of ``get_base_image``.
+
+    By default it runs ``get_base_image`` in a separate thread. Profiles can
+    override it to perform the requests asynchronously.
+    """
+
+    async def aget_base_image(self, extent):
+
+        return await self._run_in_thread(self.get_base_image, extent)
+
     # Internal
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instrument_hooks()
+
+    @classmethod
+    def _instrument_hooks(cls):
+
+        # Only the hooks defined in this class, the inherited ones are
+        # already instrumented
+        for name in INSTRUMENTED_HOOKS:
+            func = cls.__dict__.get(name)
+            if callable(func):
+                setattr(cls, name, _instrument_hook(name, func))
+
     def __init__(self):
         if not self.id or not self.desc:
             class_name = self.__class__.__name__
@@ -110,8 +332,69 @@ class BaseProfile:
                 f'Profile class {class_name} must define the "id" and "desc" properties'
             )
 
+    """
+    Connection to the munibot database, shared by all profiles in the same
+    thread.
+    """
+
+    @property
+    def db(self):
+
+        return db.get_connection()
+
+    async def _run_in_thread(self, func, *args):
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
     # Utilities
 
+    """
+    Returns the extent and geometry of the boundaries of a feature, like
+    ``get_boundaries``, but using the local boundaries cache if enabled.
+
+    If ``refresh`` is True, the boundaries are always requested and the cache
+    updated.
+    """
+
+    def load_boundaries(self, id_, refresh=False):
+
+        if not cache.boundaries_cache_enabled():
+            return self.get_boundaries(id_)
+
+        if not refresh:
+            cached = cache.get_boundaries(self.id, id_)
+            if cached:
+                return cached
+
+        extent, geometry = self.get_boundaries(id_)
+
+        cache.set_boundaries(self.id, id_, extent, geometry)
+
+        return extent, geometry
+
+    """
+    Async version of ``load_boundaries``, that uses ``aget_boundaries`` to
+    request the boundaries if they are not cached.
+    """
+
+    async def aload_boundaries(self, id_, refresh=False):
+
+        if not cache.boundaries_cache_enabled():
+            return await self.aget_boundaries(id_)
+
+        if not refresh:
+            cached = cache.get_boundaries(self.id, id_)
+            if cached:
+                return cached
+
+        extent, geometry = await self.aget_boundaries(id_)
+
+        cache.set_boundaries(self.id, id_, extent, geometry)
+
+        return extent, geometry
+
     """
     Returns the vertical and horizontal distance of the provided bounding box.
     """
@@ -152,7 +435,11 @@ class BaseProfile:
     """
     Helper function to request a WMS image.
 
-    Returns a file-like object with the requested image.
+    Returns a file-like object with the requested image. If the images cache
+    is enabled, images are only requested once for the same parameters.
+
+    The service capabilities are only requested the first time a service is
+    used in the process.
     """
 
     def get_wms_image(
@@ -168,16 +455,41 @@ class BaseProfile:
         **kwargs,
     ):
 
-        wms = WebMapService(url, version=version, headers=headers)
+        size = self.get_image_size(bbox)
+
+        if cache.images_cache_enabled():
+            key = cache.get_image_key(
+                url,
+                layer,
+                crs,
+                bbox,
+                size,
+                format,
+                version=version,
+                styles=styles,
+                **kwargs,
+            )
+            cached = cache.get_image(key)
+            if cached:
+                return io.BytesIO(cached)
+
+        wms = services.get_wms(url, version=version, headers=headers)
 
-        img = wms.getmap(
+        data = services.getmap(
+            wms,
             layers=[layer],
             srs=crs,
             styles=styles,
             bbox=bbox,
-            size=self.get_image_size(bbox),
+            size=size,
             format=format,
             **kwargs,
         )
 
-        return io.BytesIO(img.read())
+        if cache.images_cache_enabled():
+            cache.set_image(key, data)
+
+        return io.BytesIO(data)
+
+
+BaseProfile._instrument_hooks()
@@ -1,8 +1,5 @@
-import sqlite3
 import urllib
 
-from munibot.config import config
-
 from .es import MuniBotEs
 
 
@@ -14,6 +11,18 @@ class MuniBotCat(MuniBotEs):
 
     image_nodata_value = 0
 
+    db_posted_column = "mastodon_cat"
+
+    db_filter = "codcomuni = '09'"
+
+    db_columns = {
+        **MuniBotEs.db_columns,
+        "namecomar": "TEXT",
+        "codcomuni": "TEXT",
+    }
+
+    db_indexes = ["cod_ine", "codcomuni"]
+
     def get_base_image(self, extent):
 
         bbox = self.extend_bbox(extent)
@@ -28,25 +37,9 @@ class MuniBotCat(MuniBotEs):
 
         return self.get_wms_image(**wms_options)
 
-    def get_next_id(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        id_ = db.execute(
-            """
-            SELECT natcode
-            FROM es
-            WHERE mastodon_cat IS NULL
-                AND codcomuni = '09'
-            ORDER BY RANDOM()
-            LIMIT 1"""
-        )
-
-        return id_.fetchone()[0]
-
     def get_text(self, id_):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         data = db.execute(
             """
@@ -67,7 +60,7 @@ class MuniBotCat(MuniBotEs):
 
     def after_post(self, id_, status_id):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         db.execute(
             """
@@ -82,20 +75,3 @@ class MuniBotCat(MuniBotEs):
         )
 
         db.commit()
-
-    def posts_dump(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        sql = """
-            SELECT cod_ine, mastodon_cat
-            FROM es
-            WHERE mastodon_cat IS NOT NULL
-            """
-        posts_query = db.execute(sql)
-
-        posts = {row[0]: row[1] for row in posts_query.fetchall()}
-
-        count = db.execute("SELECT COUNT(*) FROM es WHERE codcomuni = '09'").fetchone()[0]
-
-        return count, posts
@@ -1,15 +1,11 @@
-import io
 import urllib
-import sqlite3
-import xml.etree.ElementTree as ET
-
-import fiona
-from owslib.wfs import WebFeatureService
-
-from munibot.config import config
 
+from munibot import services
+from munibot.gml import parse_geometry
 from munibot.profiles import BaseProfile
 
+AU_NS = "http://inspire.ec.europa.eu/schemas/au/4.0"
+
 
 class MuniBotEs(BaseProfile):
 
@@ -19,39 +15,37 @@ class MuniBotEs(BaseProfile):
 
     image_nodata_value = 0
 
+    db_table = "es"
+
+    db_id_column = "natcode"
+
+    db_posted_column = "mastodon_es"
+
+    db_columns = {
+        "cod_ine": "TEXT",
+        "nameunit": "TEXT",
+        "nameprov": "TEXT",
+        "lon": "REAL",
+        "lat": "REAL",
+    }
+
+    db_indexes = ["cod_ine"]
+
+    db_dump_column = "cod_ine"
+
     def get_boundaries(self, id_):
 
         admin_wfs = "https://contenido.ign.es/wfs-inspire/unidades-administrativas"
 
-        wfs = WebFeatureService(admin_wfs, version="2.0.0")
+        wfs = services.get_wfs(admin_wfs, version="2.0.0")
 
-        response = wfs.getfeature(
-            storedQueryID="urn:ogc:def:query:OGC-WFS::GetFeatureById",
-            storedQueryParams={"ID": "AU_ADMINISTRATIVEUNIT_{}".format(id_)},
+        response = services.getfeature(
+            wfs,
+            STOREDQUERY_ID="urn:ogc:def:query:OGC-WFS::GetFeatureById",
+            ID="AU_ADMINISTRATIVEUNIT_{}".format(id_),
         )
 
-        root = ET.fromstring(response.read())
-        ns = {"au": "http://inspire.ec.europa.eu/schemas/au/4.0"}
-
-        gml_geometry_element = [e for e in root.find("au:geometry", ns)][0]
-        gml_geometry = ET.tostring(gml_geometry_element)
-
-        gml = """
-        <gml:FeatureCollection xmlns:gml="http://www.opengis.net/gml/3.2">
-            <gml:featureMember>
-              <gml:geometry>
-                {geometry}
-              </gml:geometry>
-            </gml:featureMember>
-        </gml:FeatureCollection>
-        """.format(
-            geometry=gml_geometry.decode("utf8")
-        ).strip()
-
-        gml_f = io.BytesIO(gml.encode("utf8"))
-        with fiona.open(gml_f, "r") as src:
-            geometry = [f["geometry"] for f in src][0]
-            return src.bounds, geometry
+        return parse_geometry(response, container_tag=f"{{{AU_NS}}}geometry")
 
     def get_base_image(self, extent):
 
@@ -69,7 +63,7 @@ class MuniBotEs(BaseProfile):
 
     def get_text(self, id_):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         data = db.execute(
             """
@@ -88,24 +82,9 @@ class MuniBotEs(BaseProfile):
 
         return f"{name_muni} ({name_prov})\n\n\n{wiki_link}"
 
-    def get_next_id(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        id_ = db.execute(
-            """
-            SELECT natcode
-            FROM es
-            WHERE mastodon_es IS NULL
-            ORDER BY RANDOM()
-            LIMIT 1"""
-        )
-
-        return id_.fetchone()[0]
-
     def get_lon_lat(self, id_):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         data = db.execute(
             """
@@ -122,7 +101,7 @@ class MuniBotEs(BaseProfile):
 
     def after_post(self, id_, status_id):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         db.execute(
             """
@@ -137,20 +116,3 @@ class MuniBotEs(BaseProfile):
         )
 
         db.commit()
-
-    def posts_dump(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        sql = """
-            SELECT cod_ine, mastodon_es
-            FROM es
-            WHERE mastodon_es IS NOT NULL
-            """
-        posts_query = db.execute(sql)
-
-        posts = {row[0]: row[1] for row in posts_query.fetchall()}
-
-        count = db.execute("SELECT COUNT(*) FROM es").fetchone()[0]
-
-        return count, posts
@@ -1,8 +1,6 @@
-import sqlite3
 import urllib
 
-import requests
-from munibot.config import config
+from munibot import services
 from munibot.profiles.base import BaseProfile
 
 
@@ -26,6 +24,19 @@ class CommuneBotFr(BaseProfile):
 
     image_nodata_value = 255
 
+    db_table = "fr"
+
+    db_id_column = "insee"
+
+    db_posted_column = "mastodon_fr"
+
+    db_columns = {
+        "nom": "TEXT",
+        "nom_departement": "TEXT",
+        "lon": "REAL",
+        "lat": "REAL",
+    }
+
     # Mandatory hooks
 
     """
@@ -42,7 +53,7 @@ class CommuneBotFr(BaseProfile):
 
         params = {"code_insee": id_}
 
-        r = requests.get(cadastre_url, params=params)
+        r = services.get_session().get(cadastre_url, params=params)
 
         feature_collection = r.json()
 
@@ -106,7 +117,7 @@ class CommuneBotFr(BaseProfile):
 
     def get_text(self, id_):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         data = db.execute(
             """
@@ -127,28 +138,6 @@ class CommuneBotFr(BaseProfile):
 
         raise NotImplementedError
 
-    """
-    Returns the id of the next feature that should be posted.
-
-    This is used if the ``munibot post`` command is called withot providing
-    an id.
-    """
-
-    def get_next_id(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        id_ = db.execute(
-            """
-            SELECT insee
-            FROM fr
-            WHERE mastodon_fr IS NULL
-            ORDER BY RANDOM()
-            LIMIT 1"""
-        )
-
-        return id_.fetchone()[0]
-
     # Optional hooks
 
     """
@@ -160,7 +149,7 @@ class CommuneBotFr(BaseProfile):
 
     def get_lon_lat(self, id_):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         data = db.execute(
             """
@@ -182,7 +171,7 @@ class CommuneBotFr(BaseProfile):
 
     def after_post(self, id_, status_id):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         db.execute(
             """
@@ -198,23 +187,6 @@ class CommuneBotFr(BaseProfile):
 
         db.commit()
 
-    def posts_dump(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        sql = """
-            SELECT insee, mastodon_fr
-            FROM fr
-            WHERE mastodon_fr IS NOT NULL
-            """
-        posts_query = db.execute(sql)
-
-        posts = {row[0]: row[1] for row in posts_query.fetchall()}
-
-        count = db.execute("SELECT COUNT(*) FROM fr").fetchone()[0]
-
-        return count, posts
-
     # Internal methods
 
     def _get_crs(self, bbox):
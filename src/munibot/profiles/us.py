@@ -1,16 +1,19 @@
-import os
-import pathlib
-import sqlite3
-import tempfile
+import asyncio
+import io
 from urllib.parse import urlencode
 
-from osgeo import gdal, osr
+import numpy
 import requests
-from munibot.config import config
+from PIL import Image
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+
+from munibot import services
 from munibot.profiles.base import BaseProfile
 
 
-_TEMP_FILE_NAME = "countybot_us_tmp_file.tiff"
+_COUNTIES_URL = "https://cartowfs.nationalmap.gov/arcgis/rest/services/govunits/MapServer/35/query"
 
 
 class CountyBotUS(BaseProfile):
@@ -31,6 +34,17 @@ class CountyBotUS(BaseProfile):
     """
     desc = "US Counties Bot (Orthoimagery The National Map)"
 
+    db_table = "us"
+
+    db_id_column = "geoid"
+
+    db_posted_column = "mastodon_us"
+
+    db_columns = {
+        "fullname": "TEXT",
+        "wikilink": "TEXT",
+    }
+
     # Mandatory hooks
 
     """
@@ -43,12 +57,35 @@ class CountyBotUS(BaseProfile):
 
     def get_boundaries(self, id_):
 
-        base_url = "https://cartowfs.nationalmap.gov/arcgis/rest/services/govunits/MapServer/35/query"
+        return self._query_extent(id_), self._query_geometry(id_)
+
+    """
+    Async version of ``get_boundaries``, the geometry and extent queries are
+    sent at the same time.
+    """
+
+    async def aget_boundaries(self, id_):
+
+        geom, bbox = await asyncio.gather(
+            self._run_in_thread(self._query_geometry, id_),
+            self._run_in_thread(self._query_extent, id_),
+        )
+
+        return bbox, geom
+
+    def _query(self, id_, params):
+
         common_params = {
             "where": f"STCO_FIPSCODE='{id_}'",
             "f": "geojson",
         }
 
+        return services.get_session().get(
+            _COUNTIES_URL, params=urlencode({**common_params, **params})
+        )
+
+    def _query_geometry(self, id_):
+
         geom_params = {
             "geometryType": "esriGeometryPolygon",
             "outFields": "STCO_FIPSCODE",
@@ -56,7 +93,7 @@ class CountyBotUS(BaseProfile):
             "geometryPrecision": "6",
         }
 
-        r = requests.get(base_url, params=urlencode({**common_params, **geom_params}))
+        r = self._query(id_, geom_params)
 
         try:
             feature_collection = r.json()
@@ -70,13 +107,15 @@ class CountyBotUS(BaseProfile):
                 f"Error while querying geometry for county {id_}: {r.json()}"
             )
 
-        geom = feature_collection["features"][0]["geometry"]
+        return feature_collection["features"][0]["geometry"]
+
+    def _query_extent(self, id_):
 
         extent_params = {
             "returnExtentOnly": "true",
         }
 
-        r = requests.get(base_url, params=urlencode({**common_params, **extent_params}))
+        r = self._query(id_, extent_params)
 
         extent = r.json()
         if "error" in extent:
@@ -84,9 +123,7 @@ class CountyBotUS(BaseProfile):
                 f"Error while querying extent for county {id_}: {r.json()}"
             )
 
-        bbox = extent["extent"]["bbox"]
-
-        return bbox, geom
+        return extent["extent"]["bbox"]
 
     """
     Returns a base image for the given extent (minx, miny, maxx, maxy).
@@ -116,59 +153,47 @@ class CountyBotUS(BaseProfile):
 
         width, height = self.get_image_size(bbox)
 
-        tmp_file_path = os.path.join(tempfile.gettempdir(), _TEMP_FILE_NAME)
-
-        pathlib.Path(tmp_file_path).unlink(missing_ok=True)
-
-        tmp_f = open(tmp_file_path, "w+b")
-
-        self._geocode(tmp_f, img, bbox, width)
-
-        return tmp_f
+        return self._geocode(img, bbox, width)
 
     """
     Returns the text that needs to be included in the post for this particular
     feature.
     """
 
-    def _geocode(self, tmp_f_out, img, bounds, width=1500, crs=4326):
+    def _geocode(self, img, bounds, width=1500, crs=4326):
 
-        with tempfile.NamedTemporaryFile() as tmp_f_in:
+        minx = bounds[0]
+        maxy = bounds[3]
 
-            tmp_f_in.write(img.read())
+        scalex = (bounds[2] - bounds[0]) / width
 
-            # Open source dataset
-            gdal.UseExceptions()
-            src_ds = gdal.Open(tmp_f_in.name)
-            driver = gdal.GetDriverByName("GTiff")
+        transform = Affine(scalex, 0, minx, 0, -scalex, maxy)
 
-            # Open destination dataset
-            dst_ds = driver.CreateCopy(tmp_f_out.name, src_ds, 0)
+        # The WMS image has no location, so it is read with PIL rather than
+        # opened as a dataset, which makes rasterio warn (and warning filters
+        # can't be changed safely while other threads create images)
+        array = numpy.asarray(Image.open(img))
+        if array.ndim == 2:
+            array = array[:, :, numpy.newaxis]
+        rows, cols, count = array.shape
 
-            minx = bounds[0]
-            maxy = bounds[3]
+        with MemoryFile() as dst_file:
+            with dst_file.open(
+                driver="GTiff",
+                width=cols,
+                height=rows,
+                count=count,
+                dtype=array.dtype,
+                crs=CRS.from_epsg(crs),
+                transform=transform,
+            ) as dst:
+                dst.write(array.transpose(2, 0, 1))
 
-            scalex = (bounds[2] - bounds[0]) / width
-
-            gt = [minx, scalex, 0, maxy, 0, -scalex]
-
-            # Set location
-            dst_ds.SetGeoTransform(gt)
-
-            # Get raster projection
-            srs = osr.SpatialReference()
-            srs.ImportFromEPSG(crs)
-            dest_wkt = srs.ExportToWkt()
-
-            # Set projection
-            dst_ds.SetProjection(dest_wkt)
-
-            # Close file
-            src_ds = None
+            return io.BytesIO(dst_file.read())
 
     def get_text(self, id_):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         data = db.execute(
             """
@@ -183,28 +208,6 @@ class CountyBotUS(BaseProfile):
 
         return f"{county_name}\n\n\n{wiki_link}"
 
-    """
-    Returns the id of the next feature that should be posted.
-
-    This is used if the ``munibot post`` command is called withot providing
-    an id.
-    """
-
-    def get_next_id(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        id_ = db.execute(
-            """
-            SELECT geoid
-            FROM us
-            WHERE mastodon_us IS NULL
-            ORDER BY RANDOM()
-            LIMIT 1"""
-        )
-
-        return id_.fetchone()[0]
-
     # Optional hooks
 
     """
@@ -225,7 +228,7 @@ class CountyBotUS(BaseProfile):
 
     def after_post(self, id_, status_id):
 
-        db = sqlite3.connect(config["db"]["path"])
+        db = self.db
 
         db.execute(
             """
@@ -240,20 +243,3 @@ class CountyBotUS(BaseProfile):
         )
 
         db.commit()
-
-    def posts_dump(self):
-
-        db = sqlite3.connect(config["db"]["path"])
-
-        sql = """
-            SELECT GEOID, mastodon_us
-            FROM us
-            WHERE mastodon_us IS NOT NULL
-            """
-        posts_query = db.execute(sql)
-
-        posts = {row[0]: row[1] for row in posts_query.fetchall()}
-
-        count = db.execute("SELECT COUNT(*) FROM us").fetchone()[0]
-
-        return count, posts
@@ -0,0 +1,354 @@
+import io
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+
+from . import outbox
+from .config import config, get_logger
+from .image import create_image
+from .mastodon import get_rate_limit_delay, send_status
+
+DEFAULT_PREFETCH = 3
+
+
+def get_staging_dir(profile):
+    """
+    Returns the folder where the images ready to be posted are stored for a
+    profile. It can be set with the ``staging_dir`` option of the ``[serve]``
+    section, which defaults to a folder in the system temp directory.
+    """
+    staging_dir = config.get("serve", {}).get("staging_dir") or os.path.join(
+        tempfile.gettempdir(), "munibot-staging"
+    )
+    path = os.path.join(staging_dir, profile.id)
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+
+def get_staged(profile):
+    """
+    Returns the features that are ready to be posted for a profile, oldest
+    first. Each one is a dict with the ``id``, ``text``, ``lon``, ``lat`` and
+    ``image`` (path to the image file) keys.
+    """
+    staging_dir = get_staging_dir(profile)
+
+    staged = []
+    for file_name in os.listdir(staging_dir):
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(staging_dir, file_name)) as f:
+            staged.append(json.load(f))
+
+    return sorted(staged, key=lambda item: item["created"])
+
+
+def stage(profile, id_):
+    """
+    Creates the image and gets the text of a feature and stores them in the
+    staging folder, so they can be posted later.
+    """
+    staging_dir = get_staging_dir(profile)
+    image_path = os.path.join(staging_dir, f"{id_}.jpg")
+
+    text = profile.get_text(id_)
+    lon, lat = profile.get_lon_lat(id_)
+    create_image(profile, id_, image_path)
+
+    item = {
+        "id": id_,
+        "text": text,
+        "lon": lon,
+        "lat": lat,
+        "image": image_path,
+        "created": time.time(),
+    }
+
+    # The metadata file is written last and moved atomically, so features are
+    # only seen as staged when the image is complete
+    tmp_path = os.path.join(staging_dir, f"{id_}.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(item, f)
+    os.replace(tmp_path, os.path.join(staging_dir, f"{id_}.json"))
+
+    return item
+
+
+def unstage(profile, item):
+    """
+    Removes a feature from the staging folder.
+    """
+    staging_dir = get_staging_dir(profile)
+    for path in (item["image"], os.path.join(staging_dir, f"{item['id']}.json")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _get_next_ids(profile, count, exclude):
+
+    # Features already staged are still not posted, so they might be returned
+    # again once the queue is filled again. The ones in the outbox are being
+    # posted already, or failed.
+    ids = profile.get_next_ids(count)
+    if outbox.outbox_enabled():
+        ids = [id_ for id_ in ids if not outbox.has_entry(profile.id, id_)]
+
+    return [id_ for id_ in ids if id_ not in exclude]
+
+
+def fill_staging(profile, prefetch=DEFAULT_PREFETCH):
+    """
+    Stages new features until there are ``prefetch`` of them ready to be
+    posted for the profile.
+
+    Returns the number of features staged.
+    """
+    log = get_logger(__name__)
+
+    staged_ids = {item["id"] for item in get_staged(profile)}
+    missing = prefetch - len(staged_ids)
+    if missing <= 0:
+        return 0
+
+    count = 0
+    for id_ in _get_next_ids(profile, missing, staged_ids):
+        try:
+            stage(profile, id_)
+            count += 1
+            log.info(f"Staged feature {id_} on profile {profile.id}")
+        except Exception as e:
+            log.warning(
+                f"Could not stage feature {id_} on profile {profile.id}: {e}"
+            )
+
+    return count
+
+
+def post_next(profile):
+    """
+    Posts the oldest staged feature of the profile. If there are none, a new
+    one is created first.
+
+    Returns the id of the feature posted, or None if there were no more
+    features to post.
+    """
+    log = get_logger(__name__)
+
+    staged = get_staged(profile)
+    if staged:
+        item = staged[0]
+    else:
+        log.warning(f"No staged features for profile {profile.id}, creating one")
+        ids = _get_next_ids(profile, 1, set())
+        if not ids:
+            return None
+        item = stage(profile, ids[0])
+
+    with open(item["image"], "rb") as f:
+        image = io.BytesIO(f.read())
+
+    try:
+        send_status(
+            profile, item["id"], item["text"], image, item["lon"], item["lat"]
+        )
+    except Exception:
+        # Stop retrying features that failed too many times
+        if outbox.outbox_enabled():
+            entry = outbox.get_entry(profile.id, item["id"])
+            if entry and entry["stage"] == outbox.FAILED:
+                unstage(profile, item)
+        raise
+
+    unstage(profile, item)
+
+    return item["id"]
+
+
+class Stager(threading.Thread):
+    """
+    Background thread that keeps the staging folder of a profile filled, so
+    images are ready before it's time to post them.
+    """
+
+    def __init__(self, profile, prefetch=DEFAULT_PREFETCH):
+        super().__init__(daemon=True, name=f"munibot-stager-{profile.id}")
+        self.profile = profile
+        self.prefetch = prefetch
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        log = get_logger(__name__)
+        while not self.stopped.is_set():
+            try:
+                fill_staging(self.profile, self.prefetch)
+            except Exception as e:
+                log.error(
+                    f"Error staging features on profile {self.profile.id}: {e}"
+                )
+            self.wake_up.wait()
+            self.wake_up.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake_up.set()
+
+
+def get_interval(profile):
+    """
+    Returns the seconds between posts of a profile: the ``interval`` option of
+    its ``[profile:<id>]`` section, falling back to the one of the ``[serve]``
+    section. Returns 0 if neither is set.
+    """
+    interval = config.get(f"profile:{profile.id}", {}).get("interval") or config.get(
+        "serve", {}
+    ).get("interval", 0)
+
+    return int(interval)
+
+
+def get_prefetch(profile):
+    """
+    Returns the number of images to create in advance for a profile: the
+    ``prefetch`` option of its ``[profile:<id>]`` section, falling back to the
+    one of the ``[serve]`` section or ``DEFAULT_PREFETCH``.
+    """
+    prefetch = config.get(f"profile:{profile.id}", {}).get("prefetch") or config.get(
+        "serve", {}
+    ).get("prefetch", DEFAULT_PREFETCH)
+
+    return int(prefetch)
+
+
+class Poster(threading.Thread):
+    """
+    Thread that posts the staged features of a profile every ``interval``
+    seconds, waking up its ``Stager`` after each post.
+
+    Posts are delayed if the rate limit of the account's Mastodon instance
+    is close to being reached.
+    """
+
+    def __init__(self, profile, interval, stager, stopped, max_posts=None):
+        super().__init__(daemon=True, name=f"munibot-poster-{profile.id}")
+        self.profile = profile
+        self.interval = interval
+        self.stager = stager
+        self.stopped = stopped
+        self.max_posts = max_posts
+        self.posts = 0
+
+    def run(self):
+        log = get_logger(__name__)
+        profile = self.profile
+
+        next_post = time.monotonic() + self.interval
+        while not self.stopped.is_set():
+            if self.stopped.wait(max(0, next_post - time.monotonic())):
+                break
+            next_post += self.interval
+
+            delay = get_rate_limit_delay(profile)
+            if delay:
+                log.info(
+                    f"Rate limit reached on profile {profile.id}, "
+                    f"waiting {delay:0.0f} seconds"
+                )
+                if self.stopped.wait(delay):
+                    break
+
+            start = time.perf_counter()
+            try:
+                id_ = post_next(profile)
+            except Exception as e:
+                log.error(f"Error posting on profile {profile.id}: {e}")
+                continue
+            finally:
+                self.stager.wake_up.set()
+
+            if id_ is None:
+                log.info(f"No more features to post on profile {profile.id}")
+                break
+
+            log.info(
+                f"Posted feature {id_} on profile {profile.id} "
+                f"in {time.perf_counter() - start:0.2f} seconds"
+            )
+
+            self.posts += 1
+            if self.max_posts and self.posts >= self.max_posts:
+                break
+
+
+def serve_profiles(profiles, intervals, prefetch=None, max_posts=None):
+    """
+    Runs munibot as a long-running process, posting new features of several
+    profiles, each one every ``intervals[profile.id]`` seconds.
+
+    Each profile has its own threads to create the images in advance (up to
+    ``prefetch``, by default the one returned by ``get_prefetch``) and to
+    post them, so a slow service or Mastodon instance used by one profile
+    doesn't delay the posts of the others.
+
+    :param max_posts: stop each profile after this number of posts (by
+        default runs until the process is stopped or there are no more
+        features to post)
+
+    :returns: a dict with the number of posts sent by each profile
+    """
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        stopped.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)
+
+    stagers = []
+    posters = []
+    for profile in profiles:
+        stager = Stager(
+            profile, prefetch if prefetch is not None else get_prefetch(profile)
+        )
+        stagers.append(stager)
+        posters.append(
+            Poster(profile, intervals[profile.id], stager, stopped, max_posts)
+        )
+
+    for thread in stagers + posters:
+        thread.start()
+
+    try:
+        for poster in posters:
+            while poster.is_alive():
+                poster.join(1)
+    except KeyboardInterrupt:
+        stopped.set()
+    finally:
+        stopped.set()
+        for stager in stagers:
+            stager.stop()
+
+    return {poster.profile.id: poster.posts for poster in posters}
+
+
+def serve(profile, interval, prefetch=DEFAULT_PREFETCH, max_posts=None):
+    """
+    Runs munibot as a long-running process, posting a new feature of the
+    profile every ``interval`` seconds.
+
+    Up to ``prefetch`` features are created in advance in a background thread,
+    so at posting time only the upload to Mastodon is left.
+
+    :param max_posts: stop after this number of posts (by default runs until
+        the process is stopped or there are no more features to post)
+    """
+    posts = serve_profiles([profile], {profile.id: interval}, prefetch, max_posts)
+
+    return posts[profile.id]
@@ -0,0 +1,277 @@
+import hashlib
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+import requests
+from owslib.crs import Crs
+from owslib.util import ServiceException
+from owslib.wfs import WebFeatureService
+from owslib.wms import WebMapService
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import config
+from .instrumentation import count
+
+DEFAULT_CAPABILITIES_TTL = 24 * 60 * 60
+
+_session = None
+
+
+class Session(requests.Session):
+    """
+    Session that sends all requests to the fake server set in the
+    ``fake_server`` option of the ``[services]`` section, if any, keeping the
+    original host as the first part of the path (see ``munibot.fake_server``).
+    """
+
+    def request(self, method, url, *args, **kwargs):
+
+        fake_server = config.get("services", {}).get("fake_server")
+        if fake_server and not url.startswith(fake_server):
+            parts = urlsplit(url)
+            url = f"{fake_server.rstrip('/')}/{parts.netloc}{parts.path}"
+            if parts.query:
+                url += f"?{parts.query}"
+
+        return super().request(method, url, *args, **kwargs)
+
+
+_services = {}
+
+_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the HTTP session shared by all profiles.
+
+    The session keeps connections alive between requests to the same host and
+    retries failed requests a few times on connection errors and gateway
+    errors.
+    """
+    global _session
+
+    with _lock:
+        if _session is None:
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=("GET",),
+            )
+            adapter = HTTPAdapter(
+                pool_connections=10, pool_maxsize=20, max_retries=retry
+            )
+
+            _session = Session()
+            _session.headers["User-Agent"] = "munibot"
+            _session.hooks["response"].append(_count_response)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+
+        return _session
+
+
+def _count_response(response, *args, **kwargs):
+
+    count("http.requests")
+    count("http.bytes_downloaded", len(response.content))
+
+
+def _get_capabilities_path(service, url, version):
+
+    capabilities_dir = config.get("cache", {}).get("capabilities_dir")
+    if not capabilities_dir:
+        return None
+
+    key = hashlib.sha256(f"{service} {version} {url}".encode("utf8")).hexdigest()
+
+    return os.path.join(capabilities_dir, f"{key}.xml")
+
+
+def _get_capabilities(service, url, version, headers=None):
+    """
+    Returns the capabilities document of an OGC service, from the capabilities
+    cache on disk if enabled (``capabilities_dir`` option of the ``[cache]``
+    section) or from the service itself.
+    """
+    path = _get_capabilities_path(service, url, version)
+    ttl = int(
+        config.get("cache", {}).get("capabilities_ttl", DEFAULT_CAPABILITIES_TTL)
+    )
+
+    if path and os.path.exists(path):
+        if not ttl or time.time() - os.path.getmtime(path) < ttl:
+            count("cache.capabilities.hit")
+            with open(path, "rb") as f:
+                return f.read()
+
+    response = get_session().get(
+        url,
+        params={"service": service, "request": "GetCapabilities", "version": version},
+        headers=headers,
+        timeout=30,
+    )
+    response.raise_for_status()
+
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(response.content)
+
+    return response.content
+
+
+def _get_service(service, url, version, headers=None):
+
+    key = (service, url, version, tuple(sorted((headers or {}).items())))
+
+    with _lock:
+        if key in _services:
+            return _services[key]
+
+    xml = _get_capabilities(service, url, version, headers)
+
+    if service == "WMS":
+        instance = WebMapService(url, version=version, xml=xml, headers=headers)
+    else:
+        instance = WebFeatureService(url, version=version, xml=xml, headers=headers)
+
+    with _lock:
+        return _services.setdefault(key, instance)
+
+
+def get_wms(url, version="1.3.0", headers=None):
+    """
+    Returns an owslib ``WebMapService`` instance for the provided endpoint.
+
+    Instances are created once per process, so the capabilities are only
+    requested and parsed the first time.
+    """
+    return _get_service("WMS", url, version, headers)
+
+
+def get_wfs(url, version="2.0.0", headers=None):
+    """
+    Returns an owslib ``WebFeatureService`` instance for the provided endpoint.
+
+    Instances are created once per process, so the capabilities are only
+    requested and parsed the first time.
+    """
+    return _get_service("WFS", url, version, headers)
+
+
+def clear_services():
+    """
+    Removes all the service instances kept in memory.
+    """
+    with _lock:
+        _services.clear()
+
+
+def _get_operation_url(service, operation):
+
+    try:
+        return next(
+            m["url"]
+            for m in service.getOperationByName(operation).methods
+            if m["type"].lower() == "get"
+        )
+    except (KeyError, StopIteration):
+        return service.url
+
+
+def _check_service_exception(response):
+
+    response.raise_for_status()
+
+    content_type = response.headers.get("Content-Type", "").split(";")[0]
+    if content_type in ("text/xml", "application/xml", "application/vnd.ogc.se_xml"):
+        root = ET.fromstring(response.content)
+        if "Exception" in root.tag:
+            raise ServiceException(
+                "\n".join(t.strip() for t in root.itertext() if t.strip())
+            )
+
+
+def getmap(
+    wms,
+    layers,
+    srs,
+    bbox,
+    size,
+    format,
+    styles=None,
+    transparent=False,
+    bgcolor="#FFFFFF",
+    exceptions="XML",
+    **kwargs,
+):
+    """
+    Performs a GetMap request to the provided ``WebMapService`` using the
+    shared HTTP session, and returns the image bytes.
+
+    Parameters are the same as owslib's ``WebMapService.getmap()``.
+    """
+    if wms.version == "1.3.0":
+        srs_param = "crs"
+        if Crs(srs).axisorder == "yx":
+            bbox = (bbox[1], bbox[0], bbox[3], bbox[2])
+    else:
+        srs_param = "srs"
+
+    params = {
+        "service": "WMS",
+        "version": wms.version,
+        "request": "GetMap",
+        "layers": ",".join(layers),
+        "styles": ",".join(styles) if styles else "",
+        srs_param: srs,
+        "bbox": ",".join(str(c) for c in bbox),
+        "width": str(size[0]),
+        "height": str(size[1]),
+        "format": format,
+        "transparent": str(transparent).upper(),
+        "exceptions": exceptions,
+        **kwargs,
+    }
+    if bgcolor:
+        params["bgcolor"] = "0x" + bgcolor[1:7]
+
+    response = get_session().get(
+        _get_operation_url(wms, "GetMap"),
+        params=params,
+        headers=wms.headers,
+        timeout=wms.timeout,
+    )
+    _check_service_exception(response)
+
+    return response.content
+
+
+def getfeature(wfs, **params):
+    """
+    Performs a GetFeature request to the provided ``WebFeatureService`` using
+    the shared HTTP session, and returns the response bytes.
+
+    ``params`` are added to the request query string as they are, e.g.
+    ``STOREDQUERY_ID`` and ``ID`` for stored queries.
+    """
+    response = get_session().get(
+        _get_operation_url(wfs, "GetFeature"),
+        params={
+            "service": "WFS",
+            "version": wfs.version,
+            "request": "GetFeature",
+            **params,
+        },
+        headers=wfs.headers,
+        timeout=wfs.timeout,
+    )
+    _check_service_exception(response)
+
+    return response.content
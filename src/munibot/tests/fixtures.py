@@ -1,10 +1,17 @@
+import json
 import os
 import pathlib
+import platform
+import sqlite3
+import subprocess
 
 import fiona
 import pytest
 
+from munibot.config import config
 from munibot.config import load_config as main_load_config
+from munibot.db import _create_queue, close_connections
+from munibot.mastodon import clear_clients
 from munibot.profiles.base import BaseProfile
 
 
@@ -16,9 +23,149 @@ def load_config():
     main_load_config(test_ini_path)
 
 
+@pytest.fixture
+def mastodon_clients():
+    clear_clients()
+    yield
+    clear_clients()
+
+
+@pytest.fixture
+def cache_config(load_config, tmp_path):
+    config["cache"] = {"path": str(tmp_path / "cache.sqlite")}
+    yield config["cache"]
+    config.pop("cache", None)
+
+
 path = pathlib.Path(__file__).parent.absolute()
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--munibot-bench",
+        action="store_true",
+        default=False,
+        help="Run the benchmark tests (skipped by default)",
+    )
+    parser.addoption(
+        "--munibot-bench-save",
+        default=None,
+        help="Save the benchmark results to this JSON file",
+    )
+    parser.addoption(
+        "--munibot-bench-compare",
+        default=None,
+        help="Compare the benchmark results with the ones saved in this JSON file",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "munibot_bench: slow timing tests, only run with --munibot-bench"
+    )
+    config._munibot_benchmarks = []
+    config._munibot_benchmark_results = {}
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--munibot-bench"):
+        return
+    skip = pytest.mark.skip(reason="Benchmarks only run with --munibot-bench")
+    for item in items:
+        if "munibot_bench" in item.keywords:
+            item.add_marker(skip)
+
+
+def _get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare_benchmarks(terminalreporter, results, compare_path):
+    with open(compare_path) as f:
+        previous = json.load(f)
+
+    terminalreporter.section(
+        f"munibot benchmarks compared with {previous.get('commit') or compare_path}"
+    )
+    for name, metrics in sorted(results.items()):
+        old = previous["results"].get(name)
+        if not old:
+            terminalreporter.write_line(f"{name}: new")
+            continue
+        changes = []
+        for metric in ("seconds", "peak_mb"):
+            if old.get(metric) and metric in metrics:
+                changes.append(
+                    f"{metric} {old[metric]:0.4f} -> {metrics[metric]:0.4f} "
+                    f"({(metrics[metric] - old[metric]) / old[metric]:+0.0%})"
+                )
+        terminalreporter.write_line(f"{name}: {', '.join(changes)}")
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    lines = getattr(config, "_munibot_benchmarks", None)
+    results = getattr(config, "_munibot_benchmark_results", None)
+    if lines:
+        terminalreporter.section("munibot benchmarks")
+        for line in lines:
+            terminalreporter.write_line(line)
+
+    if not results:
+        return
+
+    compare_path = config.getoption("--munibot-bench-compare")
+    if compare_path:
+        _compare_benchmarks(terminalreporter, results, compare_path)
+
+    save_path = config.getoption("--munibot-bench-save")
+    if save_path:
+        with open(save_path, "w") as f:
+            json.dump(
+                {
+                    "commit": _get_commit(),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        terminalreporter.write_line(f"Benchmark results saved to {save_path}")
+
+
+@pytest.fixture
+def benchmark_report(request):
+    """
+    Returns a function that adds a line to the benchmark summary shown at the
+    end of the test session.
+    """
+    return request.config._munibot_benchmarks.append
+
+
+@pytest.fixture
+def benchmark_record(request):
+    """
+    Returns a function that stores the metrics of a benchmark (e.g.
+    ``seconds`` or ``peak_mb``) under a name, so they can be saved with
+    ``--munibot-bench-save`` and compared with ``--munibot-bench-compare``.
+    """
+
+    def record(name, **metrics):
+        request.config._munibot_benchmark_results[name] = metrics
+
+    return record
+
+
 def _test_image_path():
     """
     A 100 x 50 pixel GeoTIFF image, with 0 as NODATA value
@@ -34,6 +181,25 @@ def _test_boundaries_path():
     return os.path.join(path, "test.geojson")
 
 
+@pytest.fixture
+def wms_capabilities():
+    """
+    A minimal WMS 1.3.0 capabilities document, with an "ortho" layer
+    """
+    with open(os.path.join(path, "wms_capabilities.xml"), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def ign_feature():
+    """
+    A GetFeatureById response of the IGN administrative units WFS, with a
+    municipality made of two polygons, one of them with a hole
+    """
+    with open(os.path.join(path, "ign_getfeaturebyid.xml"), "rb") as f:
+        return f.read()
+
+
 @pytest.fixture
 def test_image_path():
     return _test_image_path()
@@ -73,3 +239,58 @@ class MuniBotTest(BaseProfile):
 @pytest.fixture
 def test_profile():
     return MuniBotTest()
+
+
+@pytest.fixture
+def test_profile_class():
+    return MuniBotTest
+
+
+@pytest.fixture
+def test_db(load_config, tmp_path):
+    """
+    A munibot database with a few rows in the tables used by the built-in
+    profiles
+    """
+    db_path = str(tmp_path / "munibot.sqlite")
+    config["db"] = {"path": db_path}
+
+    db = sqlite3.connect(db_path)
+    db.executescript(
+        """
+        CREATE TABLE es (
+            natcode TEXT, cod_ine TEXT, nameunit TEXT, nameprov TEXT,
+            namecomar TEXT, codcomuni TEXT, lon REAL, lat REAL,
+            mastodon_es TEXT, mastodon_cat TEXT
+        );
+        INSERT INTO es VALUES
+            ('34094343001', '43001', 'Abella de la Conca', 'Lleida', 'Pallars Jussà',
+             '09', 1.09, 42.16, NULL, NULL),
+            ('34014040001', '40001', 'Abades', 'Segovia', NULL,
+             '07', -4.26, 40.91, 'status_1', NULL),
+            ('34014040002', '40002', 'Adrada de Pirón', 'Segovia', NULL,
+             '07', -3.98, 41.05, NULL, NULL);
+        CREATE TABLE fr (
+            insee TEXT, nom TEXT, nom_departement TEXT, lon REAL, lat REAL,
+            mastodon_fr TEXT
+        );
+        INSERT INTO fr VALUES
+            ('01001', 'L''Abergement-Clémenciat', 'Ain', 4.92, 46.15, NULL),
+            ('01002', 'L''Abergement-de-Varey', 'Ain', 5.42, 46.0, 'status_2');
+        CREATE TABLE us (
+            geoid TEXT, fullname TEXT, wikilink TEXT, mastodon_us TEXT
+        );
+        INSERT INTO us VALUES
+            ('01001', 'Autauga County, Alabama',
+             'https://en.wikipedia.org/wiki/Autauga_County,_Alabama', NULL);
+        """
+    )
+    # Created by munibot db init
+    _create_queue(db)
+    db.commit()
+    db.close()
+
+    yield db_path
+
+    close_connections()
+    config.pop("db", None)
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from munibot import batch
+from munibot.batch import acreate_images, create_images, read_ids_file
+
+
+def test_read_ids_file(tmp_path):
+
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("abc\n\n# a comment\n def \n")
+
+    assert read_ids_file(ids_file) == ["abc", "def"]
+
+
+@pytest.mark.usefixtures("load_config")
+def test_create_images(test_profile, tmp_path):
+
+    summary = create_images(
+        test_profile, ["a", "b", "c"], output_dir=tmp_path, processes=2, threads=2
+    )
+
+    assert summary["total"] == 3
+    assert summary["created"] == 3
+    assert summary["failed"] == 0
+
+    for id_ in ("a", "b", "c"):
+        image = Image.open(tmp_path / f"{id_}.jpg")
+        assert image.size == (100, 50)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_create_images_failures(test_profile, tmp_path):
+
+    get_boundaries = test_profile.get_boundaries
+
+    def failing_get_boundaries(id_):
+        if id_ == "b":
+            raise ValueError("No geometry returned")
+        return get_boundaries(id_)
+
+    test_profile.get_boundaries = failing_get_boundaries
+
+    summary = create_images(
+        test_profile, ["a", "b"], output_dir=tmp_path, processes=1, threads=1
+    )
+
+    assert summary["created"] == 1
+    assert summary["failed"] == 1
+    assert (tmp_path / "a.jpg").exists()
+    assert not (tmp_path / "b.jpg").exists()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_acreate_images(test_profile, tmp_path):
+
+    summary = asyncio.run(
+        acreate_images(
+            test_profile, ["a", "b", "c"], output_dir=tmp_path, processes=2, threads=2
+        )
+    )
+
+    assert summary["created"] == 3
+    assert summary["failed"] == 0
+
+    for id_ in ("a", "b", "c"):
+        image = Image.open(tmp_path / f"{id_}.jpg")
+        assert image.size == (100, 50)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_acreate_images_uses_async_hooks(test_profile, tmp_path):
+
+    calls = []
+
+    async def aget_base_image(extent):
+        calls.append(extent)
+        return test_profile.get_base_image(extent)
+
+    test_profile.aget_base_image = aget_base_image
+
+    summary = asyncio.run(
+        acreate_images(test_profile, ["a"], output_dir=tmp_path, processes=1)
+    )
+
+    assert summary["created"] == 1
+    assert len(calls) == 1
+
+
+@pytest.mark.usefixtures("load_config")
+@pytest.mark.parametrize("use_async", [False, True])
+def test_create_images_bounded(test_profile, tmp_path, use_async):
+
+    lock = threading.Lock()
+    in_progress = [0]
+    max_in_progress = [0]
+
+    def started():
+        with lock:
+            in_progress[0] += 1
+            max_in_progress[0] = max(max_in_progress[0], in_progress[0])
+
+    fetch = batch._fetch
+
+    def _fetch(profile, id_):
+        started()
+        return fetch(profile, id_)
+
+    aload_boundaries = test_profile.aload_boundaries
+
+    async def aload(id_):
+        started()
+        return await aload_boundaries(id_)
+
+    test_profile.aload_boundaries = aload
+
+    def _render(*args):
+        # Rendering is slower than fetching
+        time.sleep(0.01)
+        with lock:
+            in_progress[0] -= 1
+        return 0.01, {}
+
+    ids = [str(i) for i in range(20)]
+    with mock.patch.object(batch, "_fetch", _fetch), mock.patch.object(
+        batch, "_render", _render
+    ), mock.patch.object(
+        batch, "_get_render_pool", lambda processes: ThreadPoolExecutor(1)
+    ):
+        if use_async:
+            summary = asyncio.run(
+                acreate_images(
+                    test_profile, ids, output_dir=tmp_path, processes=1, threads=1
+                )
+            )
+        else:
+            summary = create_images(
+                test_profile, ids, output_dir=tmp_path, processes=1, threads=1
+            )
+
+    assert summary["created"] == 20
+    assert max_in_progress[0] <= 2
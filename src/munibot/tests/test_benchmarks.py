@@ -0,0 +1,425 @@
+import io
+import math
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy
+import pytest
+import rasterio
+import rasterio.transform
+from PIL import Image
+
+from munibot.image import (
+    get_mask,
+    get_mask_band,
+    process_image,
+    read_raster,
+    render_image,
+    simplify_boundaries,
+)
+from munibot.timings import Timings
+
+# Maximum time to import the CLI module and list the profiles, in seconds
+STARTUP_TARGET = 0.5
+
+
+def _legacy_process_image(base_image, mask_array, output_format="jpeg"):
+    """
+    Pixel by pixel implementation of ``process_image`` used before it was
+    vectorized, kept as a reference for correctness and timings.
+    """
+    mask = Image.fromarray(mask_array)
+    mask.putalpha(int(70 * 255 / 100))
+
+    pixels = mask.load()
+
+    for x in range(mask.size[0]):
+        for y in range(mask.size[1]):
+            r, g, b, a = pixels[x, y]
+            if r == g == b == 255:
+                pixels[x, y] = (r, g, b, a)
+            else:
+                pixels[x, y] = (r, g, b, 0)
+
+    back = Image.open(base_image)
+    back.paste(mask, (0, 0), mask)
+
+    out = io.BytesIO()
+
+    back.save(out, format=output_format)
+
+    return out
+
+
+def _synthetic_image(width, height):
+    """
+    Returns a random RGB GeoTIFF (as a file-like object) covering the
+    (0, 0, width / height, 1) extent, so pixels are square.
+    """
+    rng = numpy.random.default_rng(0)
+    base_array = rng.integers(0, 256, (3, height, width), dtype=numpy.uint8)
+    with rasterio.MemoryFile() as memfile:
+        with memfile.open(
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=3,
+            dtype="uint8",
+            crs="EPSG:4326",
+            transform=rasterio.transform.from_bounds(
+                0, 0, width / height, 1, width, height
+            ),
+        ) as dst:
+            dst.write(base_array)
+        return io.BytesIO(memfile.read())
+
+
+def _ring(center, radius, vertices, rng, noise=0.15):
+    """
+    Returns a closed ring with a jagged outline around ``center``, as a list
+    of coordinates. The radius varies randomly but the ring is star-shaped,
+    so it never intersects itself.
+    """
+    angles = numpy.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    radii = radius * (1 + noise * (rng.random(vertices) - 0.5))
+    ring = numpy.column_stack(
+        [
+            center[0] + radii * numpy.cos(angles),
+            center[1] + radii * numpy.sin(angles),
+        ]
+    ).tolist()
+
+    return ring + [ring[0]]
+
+
+def _synthetic_boundaries(width, height, vertices=5000, islands=20, holes=5):
+    """
+    Returns a GeoJSON-like MultiPolygon in the extent of ``_synthetic_image``,
+    similar to a real municipality: a main polygon with ``vertices`` vertices
+    and ``holes`` enclaves, plus ``islands`` small polygons around it.
+    """
+    rng = numpy.random.default_rng(1)
+    center = (width / height / 2, 0.5)
+
+    main = [_ring(center, 0.35, vertices, rng)]
+    for index in range(holes):
+        angle = 2 * math.pi * index / holes
+        hole_center = (
+            center[0] + 0.15 * math.cos(angle),
+            center[1] + 0.15 * math.sin(angle),
+        )
+        # Holes must be oriented the other way
+        main.append(_ring(hole_center, 0.03, 100, rng)[::-1])
+
+    polygons = [main]
+    for index in range(islands):
+        angle = 2 * math.pi * index / islands
+        island_center = (
+            center[0] + 0.44 * math.cos(angle),
+            center[1] + 0.44 * math.sin(angle),
+        )
+        polygons.append([_ring(island_center, 0.02, 200, rng)])
+
+    return {"type": "MultiPolygon", "coordinates": polygons}
+
+
+def _smooth_boundaries(width, height, vertices=50000):
+    """
+    Returns a GeoJSON-like Polygon in the extent of ``_synthetic_image`` with
+    a smooth outline densely sampled with ``vertices`` vertices, like the
+    boundaries returned by the services.
+    """
+    rng = numpy.random.default_rng(1)
+    center = (width / height / 2, 0.5)
+
+    angles = numpy.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    radii = 0.35 * (
+        1
+        + 0.1 * numpy.sin(7 * angles)
+        + 0.05 * numpy.sin(23 * angles + 1)
+        + 0.02 * numpy.sin(101 * angles)
+        + 0.0005 * rng.standard_normal(vertices)
+    )
+    ring = numpy.column_stack(
+        [
+            center[0] + radii * numpy.cos(angles),
+            center[1] + radii * numpy.sin(angles),
+        ]
+    ).tolist()
+
+    return {"type": "Polygon", "coordinates": [ring + [ring[0]]]}
+
+
+def _synthetic_inputs(width, height):
+    """
+    Returns a random RGB base image (as a GeoTIFF file-like object) and a mask
+    array that masks everything outside an ellipse centered on the image.
+    """
+    base_image = _synthetic_image(width, height)
+
+    y, x = numpy.ogrid[:height, :width]
+    outside = ((x - width / 2) / (width / 2)) ** 2 + (
+        (y - height / 2) / (height / 2)
+    ) ** 2 > 1
+    mask_array = numpy.repeat(
+        (outside * 255).astype(numpy.uint8)[:, :, numpy.newaxis], 3, axis=2
+    )
+
+    return base_image, mask_array
+
+
+def _time(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _measure(func, *args, repeat=3):
+    """
+    Returns the best time (in seconds) of ``repeat`` calls and the peak
+    memory (in MB) allocated during a call.
+
+    Inputs that are file-like objects are rewound before each call.
+    """
+
+    def call():
+        for arg in args:
+            if hasattr(arg, "seek"):
+                arg.seek(0)
+        return func(*args)
+
+    best = min(_time(call)[1] for _ in range(repeat))
+
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak / 1024 / 1024
+
+
+@pytest.mark.usefixtures("load_config")
+def test_process_image_matches_legacy_implementation():
+
+    base_image, mask_array = _synthetic_inputs(120, 80)
+
+    new = process_image(base_image, mask_array, output_format="tiff")
+    base_image.seek(0)
+    legacy = _legacy_process_image(base_image, mask_array, output_format="tiff")
+
+    assert numpy.array_equal(
+        numpy.asarray(Image.open(new)), numpy.asarray(Image.open(legacy))
+    )
+
+
+@pytest.mark.munibot_bench
+@pytest.mark.usefixtures("load_config")
+@pytest.mark.parametrize("max_pixel_side", [250, 500, 1000, 1500])
+def test_benchmark_process_image(max_pixel_side, benchmark_report):
+
+    width, height = max_pixel_side, max_pixel_side * 2 // 3
+    megapixels = width * height / 1e6
+
+    base_image, mask_array = _synthetic_inputs(width, height)
+
+    _, legacy_time = _time(_legacy_process_image, base_image, mask_array)
+    base_image.seek(0)
+    _, new_time = _time(process_image, base_image, mask_array)
+
+    benchmark_report(
+        f"process_image {width}x{height}: "
+        f"legacy {legacy_time / megapixels:0.4f} s/MP, "
+        f"vectorized {new_time / megapixels:0.4f} s/MP "
+        f"({legacy_time / new_time:0.1f}x)"
+    )
+
+    assert new_time < legacy_time
+
+
+def _startup_time():
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import munibot.munibot; from munibot.config import load_profiles; "
+            "profiles = load_profiles(); [profiles.get_desc(p) for p in profiles]",
+        ],
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+@pytest.mark.munibot_bench
+def test_benchmark_startup(benchmark_report):
+
+    # The first run warms up the file system and bytecode caches
+    _startup_time()
+    startup_time = min(_startup_time() for _ in range(3))
+
+    benchmark_report(
+        f"CLI startup: {startup_time:0.3f}s (target {STARTUP_TARGET:0.3f}s)"
+    )
+
+    assert startup_time < STARTUP_TARGET
+
+
+# Size of the side of the images in the pipeline benchmarks, same as the
+# default max_pixel_side option
+PIPELINE_SIZE = (1500, 1000)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_synthetic_boundaries():
+
+    width, height = 150, 100
+    raster = read_raster(_synthetic_image(width, height))
+    boundaries = _synthetic_boundaries(width, height, vertices=500)
+
+    mask = get_mask(raster, boundaries)
+    masked = numpy.all(mask == 255, axis=-1)
+
+    # Center of the main polygon
+    assert not masked[50, 75]
+    # Outside corner
+    assert masked[0, 0]
+    # First hole (0.15 to the right of the center, in a 100 px tall image)
+    assert masked[50, 90]
+    # First island (0.44 to the right of the center)
+    assert not masked[50, 119]
+    # Left edge
+    assert masked[:, :10].all()
+    assert (~masked).sum() > 0.2 * width * height
+
+
+@pytest.mark.munibot_bench
+@pytest.mark.usefixtures("load_config")
+@pytest.mark.parametrize("vertices", [1000, 10000, 50000])
+def test_benchmark_get_mask(vertices, benchmark_report, benchmark_record):
+
+    width, height = PIPELINE_SIZE
+    raster = read_raster(_synthetic_image(width, height))
+    boundaries = _synthetic_boundaries(width, height, vertices=vertices)
+    megapixels = width * height / 1e6
+
+    seconds, peak_mb = _measure(get_mask, raster, boundaries)
+
+    name = f"get_mask[{width}x{height}, {vertices} vertices]"
+    benchmark_record(
+        name,
+        seconds=seconds,
+        megapixels_per_second=megapixels / seconds,
+        peak_mb=peak_mb,
+    )
+    benchmark_report(
+        f"{name}: {seconds:0.4f}s, {megapixels / seconds:0.1f} MP/s, "
+        f"peak {peak_mb:0.1f} MB"
+    )
+
+
+@pytest.mark.munibot_bench
+@pytest.mark.usefixtures("load_config")
+@pytest.mark.parametrize("output_format", ["jpeg", "png"])
+def test_benchmark_composite_and_encode(
+    output_format, benchmark_report, benchmark_record
+):
+
+    width, height = PIPELINE_SIZE
+    raster = read_raster(_synthetic_image(width, height))
+    mask = get_mask(raster, _synthetic_boundaries(width, height))
+    megapixels = width * height / 1e6
+
+    timings = []
+
+    def process():
+        timings.append(Timings())
+        return process_image(raster, mask, output_format, timings=timings[-1])
+
+    seconds, peak_mb = _measure(process)
+    composite = min(t.stages["composite"] for t in timings)
+    encode = min(t.stages["encode"] for t in timings)
+
+    for stage, stage_seconds in (("composite", composite), ("encode", encode)):
+        benchmark_record(
+            f"{stage}[{width}x{height}, {output_format}]",
+            seconds=stage_seconds,
+            megapixels_per_second=megapixels / stage_seconds,
+        )
+    benchmark_record(
+        f"process_image[{width}x{height}, {output_format}]",
+        seconds=seconds,
+        peak_mb=peak_mb,
+    )
+    benchmark_report(
+        f"process_image {width}x{height} {output_format}: composite "
+        f"{composite:0.4f}s, encode {encode:0.4f}s "
+        f"({megapixels / encode:0.1f} MP/s), peak {peak_mb:0.1f} MB"
+    )
+
+
+@pytest.mark.munibot_bench
+@pytest.mark.usefixtures("load_config")
+def test_benchmark_render_image(benchmark_report, benchmark_record):
+
+    width, height = PIPELINE_SIZE
+    base_image = _synthetic_image(width, height)
+    boundaries = _synthetic_boundaries(width, height)
+
+    seconds, peak_mb = _measure(render_image, base_image, boundaries)
+
+    name = f"render_image[{width}x{height}]"
+    benchmark_record(
+        name, seconds=seconds, images_per_minute=60 / seconds, peak_mb=peak_mb
+    )
+    benchmark_report(
+        f"{name}: {seconds:0.4f}s ({60 / seconds:0.0f} images/min), "
+        f"peak {peak_mb:0.1f} MB"
+    )
+
+
+@pytest.mark.usefixtures("load_config")
+@pytest.mark.parametrize("boundaries_func", [_smooth_boundaries, _synthetic_boundaries])
+def test_simplified_mask_is_near_identical(boundaries_func):
+
+    width, height = PIPELINE_SIZE
+    raster = read_raster(_synthetic_image(width, height))
+    boundaries = boundaries_func(width, height, vertices=50000)
+    pixel_size = raster.transform.a
+
+    simplified = simplify_boundaries(boundaries, pixel_size)
+
+    mask = get_mask_band(raster, boundaries)
+    simplified_mask = get_mask_band(raster, simplified)
+
+    # Only pixels on the edges can change
+    assert (mask != simplified_mask).sum() < 0.005 * width * height
+
+
+@pytest.mark.munibot_bench
+@pytest.mark.usefixtures("load_config")
+@pytest.mark.parametrize("vertices", [10000, 50000, 200000])
+def test_benchmark_simplify_boundaries(vertices, benchmark_report, benchmark_record):
+
+    width, height = PIPELINE_SIZE
+    raster = read_raster(_synthetic_image(width, height))
+    boundaries = _smooth_boundaries(width, height, vertices=vertices)
+    pixel_size = raster.transform.a
+
+    def simplify_and_mask():
+        return get_mask_band(raster, simplify_boundaries(boundaries, pixel_size))
+
+    original_time, _ = _measure(get_mask_band, raster, boundaries)
+    simplified_time, _ = _measure(simplify_and_mask)
+
+    name = f"simplify_and_mask[{width}x{height}, {vertices} vertices]"
+    benchmark_record(name, seconds=simplified_time)
+    benchmark_report(
+        f"{name}: {simplified_time:0.4f}s, without simplifying "
+        f"{original_time:0.4f}s ({original_time / simplified_time:0.1f}x)"
+    )
+
+    assert simplified_time < original_time
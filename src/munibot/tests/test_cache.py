@@ -0,0 +1,172 @@
+import asyncio
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from munibot import cache
+
+
+GEOMETRY = {
+    "type": "Polygon",
+    "coordinates": [[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]]],
+}
+
+
+@pytest.mark.usefixtures("load_config")
+def test_boundaries_cache_disabled_without_db():
+
+    assert not cache.boundaries_cache_enabled()
+
+
+def test_boundaries_cache_disabled_in_config(cache_config):
+
+    cache_config["boundaries"] = "false"
+
+    assert not cache.boundaries_cache_enabled()
+
+
+def test_set_and_get_boundaries(cache_config):
+
+    assert cache.get_boundaries("test", "1234") is None
+
+    cache.set_boundaries("test", "1234", (0, 0, 1, 1), GEOMETRY)
+
+    extent, geometry = cache.get_boundaries("test", "1234")
+
+    assert extent == (0, 0, 1, 1)
+    assert geometry == GEOMETRY
+
+    assert cache.get_boundaries("other", "1234") is None
+
+
+def test_boundaries_ttl(cache_config):
+
+    cache_config["boundaries_ttl"] = "60"
+
+    cache.set_boundaries("test", "1234", (0, 0, 1, 1), GEOMETRY)
+
+    assert cache.get_boundaries("test", "1234")
+
+    with mock.patch("munibot.cache.time.time", return_value=time.time() + 120):
+        assert cache.get_boundaries("test", "1234") is None
+
+
+def test_clear_boundaries(cache_config):
+
+    cache.set_boundaries("test", "1", (0, 0, 1, 1), GEOMETRY)
+    cache.set_boundaries("test", "2", (0, 0, 1, 1), GEOMETRY)
+
+    cache.clear_boundaries("test", "1")
+
+    assert cache.get_boundaries("test", "1") is None
+    assert cache.get_boundaries("test", "2")
+
+    cache.clear_boundaries("test")
+
+    assert cache.get_boundaries("test", "2") is None
+
+
+def test_load_boundaries_uses_cache(cache_config, test_profile):
+
+    with mock.patch.object(
+        test_profile, "get_boundaries", wraps=test_profile.get_boundaries
+    ) as m:
+        first = test_profile.load_boundaries("1234")
+        second = test_profile.load_boundaries("1234")
+
+    assert m.call_count == 1
+    assert first[0] == second[0]
+    assert second[1]["type"] == "Polygon"
+
+    with mock.patch.object(
+        test_profile, "get_boundaries", wraps=test_profile.get_boundaries
+    ) as m:
+        test_profile.load_boundaries("1234", refresh=True)
+
+    assert m.call_count == 1
+
+
+def test_images_cache_disabled_by_default(cache_config):
+
+    assert not cache.images_cache_enabled()
+
+
+def test_image_key():
+
+    params = ("http://wms", "ortho", "EPSG:4258", (0, 0, 1, 1), (1500, 750))
+
+    key = cache.get_image_key(*params, "image/tiff")
+
+    assert key == cache.get_image_key(*params, "image/tiff")
+    assert key != cache.get_image_key(*params, "image/jpeg")
+    assert key != cache.get_image_key(*params, "image/tiff", version="1.1.1")
+
+
+def test_set_and_get_image(cache_config, tmp_path):
+
+    cache_config["images_dir"] = str(tmp_path / "images")
+
+    assert cache.get_image("abc") is None
+
+    cache.set_image("abc", b"image data")
+
+    assert cache.get_image("abc") == b"image data"
+
+
+def test_images_lru_eviction(cache_config, tmp_path):
+
+    images_dir = tmp_path / "images"
+    cache_config["images_dir"] = str(images_dir)
+    # 2.5 KB
+    cache_config["images_max_size"] = str(2.5 / 1024)
+
+    cache.set_image("a", b"x" * 1024)
+    cache.set_image("b", b"x" * 1024)
+
+    # "a" was stored first but it is used after "b"
+    past = time.time() - 100
+    os.utime(images_dir / "a", (past, past))
+    os.utime(images_dir / "b", (past + 1, past + 1))
+    cache.get_image("a")
+
+    cache.set_image("c", b"x" * 1024)
+
+    assert cache.get_image("a")
+    assert cache.get_image("b") is None
+    assert cache.get_image("c")
+
+
+def test_get_wms_image_uses_cache(cache_config, tmp_path, test_profile):
+
+    cache_config["images_dir"] = str(tmp_path / "images")
+
+    options = {
+        "url": "http://wms",
+        "layer": "ortho",
+        "crs": "EPSG:4258",
+        "bbox": (0, 0, 2, 1),
+    }
+
+    with mock.patch("munibot.profiles.base.services.get_wms"):
+        with mock.patch(
+            "munibot.profiles.base.services.getmap", return_value=b"wms image"
+        ) as m:
+            first = test_profile.get_wms_image(**options)
+            second = test_profile.get_wms_image(**options)
+
+    assert m.call_count == 1
+    assert first.read() == second.read() == b"wms image"
+
+
+def test_aload_boundaries_uses_cache(cache_config, test_profile):
+
+    with mock.patch.object(
+        test_profile, "get_boundaries", wraps=test_profile.get_boundaries
+    ) as m:
+        first = asyncio.run(test_profile.aload_boundaries("1234"))
+        second = asyncio.run(test_profile.aload_boundaries("1234"))
+
+    assert m.call_count == 1
+    assert first[0] == second[0]
@@ -19,6 +19,12 @@ class MockProfile:
     def get_lon_lat(self, id_):
         return 1.2781, 41.1202
 
+    def get_ids(self, unposted=False):
+        return ["abc", "def", "ghi"]
+
+    def load_boundaries(self, id_, refresh=False):
+        return (0, 0, 1, 1), {}
+
 
 class MockProfileEs(MockProfile):
     id = "es"
@@ -105,7 +111,9 @@ def test_post():
             with mock.patch(
                 "munibot.munibot.create_image", return_value="created_image"
             ) as m:
-                with mock.patch("munibot.munibot.send_status") as m:
+                with mock.patch(
+                    "munibot.munibot.outbox_enabled", return_value=False
+                ), mock.patch("munibot.munibot.send_status") as m:
                     main()
 
     assert isinstance(m.call_args[0][0], MockProfileCat)
@@ -114,3 +122,146 @@ def test_post():
 
     assert m.call_args[0][2] == "Test text cat"
     assert m.call_args[0][3] == "created_image"
+
+
+def test_post_resumes_pending():
+
+    command = ["munibot", "post", "cat"]
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch("munibot.munibot.create_image") as m_create:
+                with mock.patch(
+                    "munibot.munibot.post_pending", return_value="xyz"
+                ) as m, pytest.raises(SystemExit):
+                    main()
+
+    assert isinstance(m.call_args[0][0], MockProfileCat)
+    m_create.assert_not_called()
+
+
+def test_serve_many_profiles():
+
+    command = ["munibot", "serve", "cat,es", "--interval", "60"]
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch(
+                "munibot.munibot.serve_profiles",
+                return_value={"cat": 0, "es": 0},
+            ) as m, pytest.raises(SystemExit):
+                main()
+
+    profiles, intervals, prefetch = m.call_args[0]
+    assert [profile.id for profile in profiles] == ["cat", "es"]
+    assert intervals == {"cat": 60, "es": 60}
+
+
+def test_prewarm():
+
+    command = ["munibot", "prewarm", "es"]
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch(
+                "munibot.munibot.boundaries_cache_enabled", return_value=True
+            ), mock.patch(
+                "munibot.munibot.get_cached_boundaries",
+                side_effect=lambda profile_id, id_: id_ == "def",
+            ):
+                with mock.patch.object(
+                    MockProfileEs, "load_boundaries", autospec=True
+                ) as m:
+                    with pytest.raises(SystemExit):
+                        main()
+
+    assert [c[0][1] for c in m.call_args_list] == ["abc", "ghi"]
+    assert all(c[1]["refresh"] for c in m.call_args_list)
+
+
+def test_prewarm_cache_disabled():
+
+    command = ["munibot", "prewarm", "es"]
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch(
+                "munibot.munibot.boundaries_cache_enabled", return_value=False
+            ):
+                with pytest.raises(SystemExit) as m:
+                    main()
+
+    assert m.value.code == 1
+
+
+def test_create_batch_ids_file(tmp_path):
+
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("abc\ndef\n")
+
+    command = [
+        "munibot",
+        "create",
+        "es",
+        "--ids-file",
+        str(ids_file),
+        "--processes",
+        "2",
+    ]
+    summary = {"failed": 0}
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch(
+                "munibot.munibot.create_images", return_value=summary
+            ) as m, mock.patch("munibot.munibot.print_summary"):
+                with pytest.raises(SystemExit) as e:
+                    main()
+
+    assert e.value.code == 0
+    assert isinstance(m.call_args[0][0], MockProfileEs)
+    assert m.call_args[0][1] == ["abc", "def"]
+    assert m.call_args[1]["processes"] == 2
+
+
+def test_create_batch_all_unposted():
+
+    command = ["munibot", "create", "cat", "--all-unposted"]
+    summary = {"failed": 1}
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch(
+                "munibot.munibot.create_images", return_value=summary
+            ) as m, mock.patch("munibot.munibot.print_summary"):
+                with pytest.raises(SystemExit) as e:
+                    main()
+
+    assert e.value.code == 1
+    assert m.call_args[0][1] == ["abc", "def", "ghi"]
+
+
+@pytest.mark.parametrize(
+    "args,expected", [(["--all"], ["es", "cat"]), (["cat,es"], ["cat", "es"])]
+)
+def test_dump_many_profiles(args, expected):
+
+    command = ["munibot", "dump"] + args + ["-o", "/tmp/"]
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch(
+                "munibot.munibot.dump_profiles", return_value={"es": 1}
+            ) as m:
+                with pytest.raises(SystemExit) as e:
+                    main()
+
+    assert e.value.code == 0
+    assert [profile.id for profile in m.call_args[0][0]] == expected
+    assert m.call_args[1]["output_dir"] == "/tmp/"
+
+
+def test_create_profile_run(tmp_path, capsys):
+
+    command = ["munibot", "create", "es", "--profile-run", "-o", str(tmp_path)]
+    with mock.patch.object(sys, "argv", command):
+        with mock.patch("munibot.munibot.load_profiles", return_value=mock_profiles):
+            with mock.patch("munibot.munibot.create_image") as m:
+                main()
+
+    assert m.call_args[0][1] == "abc"
+    assert (tmp_path / "abc.prof").exists()
+    assert "Spans:" in capsys.readouterr().out
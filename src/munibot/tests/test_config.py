@@ -1,7 +1,10 @@
+import subprocess
+import sys
+
 import pytest
 
 from munibot.profiles.base import BaseProfile
-from munibot.config import config, load_config, load_profiles
+from munibot.config import BUILTIN_PROFILES, config, load_config, load_profiles
 
 
 @pytest.mark.usefixtures("load_config")
@@ -31,3 +34,31 @@ def test_load_profiles():
 
     for name, profile_cls in profiles.items():
         assert issubclass(profile_cls, BaseProfile)
+
+
+def test_load_profiles_descriptions():
+
+    profiles = load_profiles()
+
+    for name in BUILTIN_PROFILES:
+        assert profiles.get_desc(name) == profiles[name].desc
+
+
+def test_load_profiles_is_lazy():
+
+    # Run in a new interpreter, as other tests import the profiles
+    code = """
+import sys
+import munibot.munibot
+from munibot.config import load_profiles
+profiles = load_profiles()
+[profiles.get_desc(name) for name in profiles]
+assert "es" in profiles
+heavy = ("fiona", "mastodon", "numpy", "owslib", "rasterio", "shapely")
+print(",".join(sorted(m for m in sys.modules if m.split(".")[0] in heavy)))
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == ""
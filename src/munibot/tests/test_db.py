@@ -0,0 +1,294 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from munibot.config import config
+from munibot.db import (
+    close_connections,
+    count_posts,
+    get_connection,
+    get_query_plans,
+    init_db,
+    sample_ids,
+)
+from munibot.profiles.cat import MuniBotCat
+from munibot.profiles.es import MuniBotEs
+from munibot.profiles.fr import CommuneBotFr
+from munibot.profiles.us import CountyBotUS
+
+
+def test_connection_reused_in_same_thread(tmp_path):
+
+    path = str(tmp_path / "test.sqlite")
+
+    assert get_connection(path) is get_connection(path)
+
+
+def test_connection_per_thread(tmp_path):
+
+    path = str(tmp_path / "test.sqlite")
+    connections = []
+
+    thread = threading.Thread(target=lambda: connections.append(get_connection(path)))
+    thread.start()
+    thread.join()
+
+    assert connections[0] is not get_connection(path)
+
+
+def test_connection_wal_mode(tmp_path):
+
+    db = get_connection(str(tmp_path / "test.sqlite"))
+
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_close_connections(tmp_path):
+
+    path = str(tmp_path / "test.sqlite")
+    first = get_connection(path)
+
+    close_connections()
+
+    second = get_connection(path)
+
+    assert second is not first
+    assert second.execute("SELECT 1").fetchone() == (1,)
+
+
+def _posted(db_path, id_):
+    db = get_connection(db_path)
+    with db:
+        db.execute("UPDATE fr SET mastodon_fr = 'status' WHERE insee = ?", (id_,))
+
+
+@pytest.fixture
+def communes_db(test_db):
+    db = get_connection(test_db)
+    with db:
+        db.execute("DELETE FROM fr")
+        db.executemany(
+            "INSERT INTO fr (insee, nom) VALUES (?, ?)",
+            [(f"{i:05}", f"Commune {i}") for i in range(100)],
+        )
+    return test_db
+
+
+def test_sample_ids(communes_db):
+
+    ids = sample_ids("fr", "fr", "insee", "mastodon_fr", count=10)
+
+    assert len(ids) == len(set(ids)) == 10
+
+    # The ids returned are removed from the queue
+    next_ids = sample_ids("fr", "fr", "insee", "mastodon_fr", count=10)
+
+    assert len(next_ids) == 10
+    assert not set(ids) & set(next_ids)
+
+
+def test_sample_ids_skips_failed(communes_db):
+
+    # A feature that is never posted does not block the following ones
+    failed = sample_ids("fr", "fr", "insee", "mastodon_fr", count=1)[0]
+
+    ids = [sample_ids("fr", "fr", "insee", "mastodon_fr")[0] for _ in range(99)]
+
+    assert failed not in ids
+    assert len(set(ids)) == 99
+
+    # It is returned again once the queue is filled again
+    for id_ in ids:
+        _posted(communes_db, id_)
+
+    assert sample_ids("fr", "fr", "insee", "mastodon_fr", count=10) == [failed]
+
+
+def test_sample_ids_all(communes_db):
+
+    ids = sample_ids("fr", "fr", "insee", "mastodon_fr", count=200)
+
+    assert sorted(ids) == [f"{i:05}" for i in range(100)]
+
+
+def test_sample_ids_refills_queue(communes_db):
+
+    for id_ in sample_ids("fr", "fr", "insee", "mastodon_fr", count=100)[:95]:
+        _posted(communes_db, id_)
+
+    db = get_connection(communes_db)
+    with db:
+        db.execute("INSERT INTO fr (insee, nom) VALUES ('99999', 'New commune')")
+
+    ids = sample_ids("fr", "fr", "insee", "mastodon_fr", count=6)
+
+    assert len(ids) == 6
+    assert "99999" in ids
+
+
+def test_sample_ids_filter(test_db):
+
+    ids = sample_ids(
+        "cat", "es", "natcode", "mastodon_cat", where="codcomuni = '09'", count=10
+    )
+
+    assert ids == ["34094343001"]
+
+
+def test_sample_ids_nothing_left(test_db):
+
+    assert sample_ids("us", "us", "geoid", "mastodon_us", count=1) == ["01001"]
+
+    db = get_connection(test_db)
+    with db:
+        db.execute("UPDATE us SET mastodon_us = 'status'")
+
+    assert sample_ids("us", "us", "geoid", "mastodon_us", count=1) == []
+
+
+def test_sample_ids_concurrent(communes_db):
+
+    def sample(_):
+        return [
+            sample_ids("fr", "fr", "insee", "mastodon_fr")[0] for _ in range(10)
+        ]
+
+    with ThreadPoolExecutor(4) as executor:
+        ids = [id_ for result in executor.map(sample, range(4)) for id_ in result]
+
+    # Each thread has its own connection, and none gets the same id
+    assert len(set(ids)) == 40
+
+
+def test_sample_ids_without_queue(test_db):
+
+    db = get_connection(test_db)
+    with db:
+        db.execute("DROP TABLE munibot_queue")
+
+    with pytest.raises(RuntimeError, match="munibot db init"):
+        sample_ids("us", "us", "geoid", "mastodon_us", count=1)
+
+
+def test_sample_ids_uses_indexes(communes_db):
+
+    init_db(_profiles())
+    sample_ids("fr", "fr", "insee", "mastodon_fr", count=1)
+
+    db = get_connection(communes_db)
+    plan = " ".join(
+        row[-1]
+        for row in db.execute(
+            """
+            EXPLAIN QUERY PLAN
+            SELECT q.position, q.id
+            FROM munibot_queue q
+            CROSS JOIN fr t ON t.insee = q.id
+            WHERE q.profile = 'fr' AND t.mastodon_fr IS NULL
+            ORDER BY q.position
+            LIMIT 1
+            """
+        )
+    )
+
+    assert "USE TEMP B-TREE" not in plan
+    assert "fr_mastodon_fr_unposted" in plan
+
+
+def _profiles():
+    return [MuniBotEs(), MuniBotCat(), CommuneBotFr(), CountyBotUS()]
+
+
+def _get_indexes(db, table):
+    return {row[1] for row in db.execute(f"PRAGMA index_list({table})")}
+
+
+def test_init_db(load_config, tmp_path):
+
+    config["db"] = {"path": str(tmp_path / "munibot.sqlite")}
+    try:
+        result = init_db(_profiles())
+
+        assert result == {"es": "created", "fr": "created", "us": "created"}
+
+        db = get_connection()
+        columns = [row[1] for row in db.execute("PRAGMA table_info(es)")]
+        assert columns[0] == "natcode"
+        assert "mastodon_es" in columns
+        assert "mastodon_cat" in columns
+        assert "codcomuni" in columns
+
+        assert {
+            "es_natcode",
+            "es_mastodon_es_unposted",
+            "es_mastodon_cat_unposted",
+            "es_mastodon_cat_posted",
+            "es_codcomuni",
+        } <= _get_indexes(db, "es")
+
+        # Running it again does nothing
+        assert init_db(_profiles()) == {
+            "es": "up to date",
+            "fr": "up to date",
+            "us": "up to date",
+        }
+    finally:
+        close_connections()
+        config.pop("db", None)
+
+
+def test_upgrade_db(test_db):
+
+    db = get_connection()
+    db.execute("ALTER TABLE fr RENAME TO fr_old")
+    db.execute("CREATE TABLE fr (insee TEXT, nom TEXT)")
+    db.execute("DROP TABLE us")
+
+    result = init_db(_profiles(), create=False)
+
+    assert result == {"es": "up to date", "fr": "upgraded", "us": "missing"}
+
+    columns = [row[1] for row in db.execute("PRAGMA table_info(fr)")]
+    assert columns == ["insee", "nom", "nom_departement", "lon", "lat", "mastodon_fr"]
+
+    assert "fr_mastodon_fr_unposted" in _get_indexes(db, "fr")
+
+    # ANALYZE was run
+    assert db.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0]
+
+
+def test_query_plans(test_db):
+
+    init_db(_profiles())
+
+    plans = dict(get_query_plans(MuniBotEs()))
+
+    assert "es_natcode" in " ".join(plans["get_text, get_lon_lat, after_post"])
+    assert "es_mastodon_es_unposted" in " ".join(plans["get_next_id, get_next_ids"])
+    assert "es_mastodon_es_posted" in " ".join(plans["get_posts"])
+    for plan in plans.values():
+        for step in plan:
+            assert not (step.startswith("SCAN es") and "INDEX" not in step)
+
+
+def test_count_posts(test_db):
+
+    assert count_posts("es", "mastodon_es") == (3, 1)
+    assert count_posts("es", "mastodon_cat", where="codcomuni = '09'") == (1, 0)
+
+
+def test_count_posts_from_statistics(test_db):
+
+    init_db(_profiles())
+
+    db = get_connection()
+    with db:
+        db.execute("INSERT INTO fr (insee, mastodon_fr) VALUES ('01004', 'status')")
+
+    # The total comes from the statistics, until ANALYZE is run again
+    assert count_posts("fr", "mastodon_fr") == (2, 2)
+
+    init_db(_profiles())
+
+    assert count_posts("fr", "mastodon_fr") == (3, 2)
@@ -0,0 +1,145 @@
+import io
+import json
+from unittest import mock
+
+import pytest
+
+from munibot.config import config
+from munibot.dump import DUMP_FILE_PREFIX, dump_posts, dump_profiles, write_dump
+from munibot.profiles.cat import MuniBotCat
+from munibot.profiles.es import MuniBotEs
+from munibot.profiles.fr import CommuneBotFr
+
+
+def _read_dump(path):
+    with open(path) as f:
+        content = f.read()
+
+    assert content.startswith(DUMP_FILE_PREFIX)
+
+    return json.loads(content[len(DUMP_FILE_PREFIX) :])["mastodon"]
+
+
+@pytest.fixture
+def es_config(test_db):
+    config["profile:es"] = {
+        "mastodon_api_base_url": "https://mastodon.example.com",
+        "mastodon_account_name": "munibot_es",
+    }
+    yield
+    config.pop("profile:es", None)
+
+
+def test_write_dump():
+
+    out = io.StringIO()
+
+    posts = iter([("a", "109000000000000002"), ("b", "109000000000000001")])
+    last_post = write_dump(out, "host", "account", posts, 10, 2)
+
+    assert last_post == 109000000000000002
+    assert json.loads(out.getvalue()[len(DUMP_FILE_PREFIX) :]) == {
+        "mastodon": {
+            "host": "host",
+            "account": "account",
+            "posts": {"a": "109000000000000002", "b": "109000000000000001"},
+            "total": 10,
+            "posted": 2,
+        }
+    }
+
+
+@pytest.mark.usefixtures("es_config")
+def test_dump_posts(tmp_path):
+
+    output = str(tmp_path / "posts.js")
+
+    assert dump_posts(MuniBotEs(), output) == 1
+
+    assert _read_dump(output) == {
+        "host": "https://mastodon.example.com",
+        "account": "munibot_es",
+        "posts": {"40001": "status_1"},
+        "total": 3,
+        "posted": 1,
+    }
+
+
+@pytest.mark.usefixtures("es_config")
+def test_dump_posts_incremental(tmp_path):
+
+    profile = MuniBotEs()
+    output = str(tmp_path / "posts.js")
+
+    profile.after_post("34014040002", "109000000000000001")
+
+    assert dump_posts(profile, output, incremental=True) == 2
+
+    profile.after_post("34094343001", "109000000000000002")
+
+    # Full dumps don't move the watermark
+    assert dump_posts(profile, str(tmp_path / "full.js")) == 3
+
+    assert dump_posts(profile, output, incremental=True) == 1
+
+    dump = _read_dump(output)
+    assert dump["posts"] == {"43001": "109000000000000002"}
+    assert dump["since"] == "109000000000000001"
+    assert dump["posted"] == 3
+
+    # Nothing new since the last dump
+    assert dump_posts(profile, output, incremental=True) == 0
+    assert _read_dump(output)["posts"] == {}
+
+
+@pytest.mark.parametrize("threads", [None, 2])
+def test_dump_profiles(test_db, tmp_path, threads):
+
+    with mock.patch.dict(config):
+        # Other tests might have loaded an ini file with a cat section
+        config.pop("profile:cat", None)
+        config["profile:es"] = config["profile:fr"] = {
+            "mastodon_api_base_url": "https://mastodon.example.com",
+            "mastodon_account_name": "munibot",
+        }
+        results = dump_profiles(
+            [MuniBotEs(), CommuneBotFr(), MuniBotCat()],
+            output_dir=str(tmp_path),
+            threads=threads,
+        )
+
+    assert results["es"] == 1
+    assert results["fr"] == 1
+    # No config for the cat profile
+    assert isinstance(results["cat"], KeyError)
+
+    assert _read_dump(tmp_path / "es.js")["posts"] == {"40001": "status_1"}
+    assert _read_dump(tmp_path / "fr.js")["posts"] == {"01002": "status_2"}
+    assert not (tmp_path / "cat.js").exists()
+
+
+@pytest.mark.usefixtures("es_config")
+def test_dump_profiles_incremental(tmp_path):
+
+    profile = MuniBotEs()
+    profile.after_post("34014040002", "109000000000000001")
+
+    assert dump_profiles([profile], output_dir=str(tmp_path)) == {"es": 2}
+    assert dump_profiles([profile], output_dir=str(tmp_path), incremental=True) == {
+        "es": 2
+    }
+
+    profile.after_post("34094343001", "109000000000000002")
+
+    assert dump_profiles([profile], output_dir=str(tmp_path), incremental=True) == {
+        "es": 1
+    }
+
+    # The full dump is kept, and the new posts are written to a separate file
+    assert _read_dump(tmp_path / "es.js")["posts"] == {
+        "40001": "status_1",
+        "40002": "109000000000000001",
+    }
+    assert _read_dump(tmp_path / "es.since-109000000000000001.js")["posts"] == {
+        "43001": "109000000000000002"
+    }
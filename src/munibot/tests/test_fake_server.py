@@ -0,0 +1,74 @@
+import time
+
+import pytest
+from PIL import Image
+
+from munibot import services
+from munibot.config import config, load_profiles
+from munibot.fake_server import FakeServer
+from munibot.image import create_image
+
+
+@pytest.fixture
+def fake_server(load_config, request):
+    options = getattr(request, "param", {})
+    services.clear_services()
+    with FakeServer(port=0, **options) as server:
+        config["services"] = {"fake_server": server.url}
+        yield server
+    config.pop("services", None)
+    services.clear_services()
+
+
+@pytest.mark.parametrize(
+    "profile_name,id_",
+    [("es", "34094343001"), ("cat", "34094308001"), ("fr", "01001"), ("us", "01001")],
+)
+def test_create_image_with_fake_server(fake_server, profile_name, id_):
+
+    profile = load_profiles()[profile_name]()
+
+    image = Image.open(create_image(profile, id_))
+
+    assert max(image.size) == 1500
+    assert fake_server.stats["requests"] > 0
+    assert fake_server.stats.get("not_found", 0) == 0
+
+
+def test_fake_server_boundaries_are_repeatable(fake_server):
+
+    profile = load_profiles()["fr"]()
+
+    assert profile.get_boundaries("01001") == profile.get_boundaries("01001")
+    assert profile.get_boundaries("01001") != profile.get_boundaries("01002")
+
+
+@pytest.mark.parametrize(
+    "fake_server", [{"failure_rate": 0.3, "seed": 1}], indirect=True
+)
+def test_fake_server_failures_are_retried(fake_server):
+
+    profile = load_profiles()["fr"]()
+
+    for id_ in ("01001", "01002", "01003"):
+        extent, boundaries = profile.get_boundaries(id_)
+        assert boundaries["type"] == "MultiPolygon"
+
+    assert fake_server.stats["failures"] > 0
+
+
+@pytest.mark.parametrize("fake_server", [{"latency": 0.2}], indirect=True)
+def test_fake_server_latency(fake_server):
+
+    start = time.perf_counter()
+    services.get_session().get(f"{fake_server.url}/_stats")
+    assert time.perf_counter() - start < 0.2
+
+    start = time.perf_counter()
+    response = services.get_session().get(
+        "https://apicarto.ign.fr/api/cadastre/commune", params={"code_insee": "01001"}
+    )
+    assert time.perf_counter() - start >= 0.2
+
+    assert response.json()["features"][0]["id"] == "01001"
+    assert fake_server.stats == {"requests": 1, "apicarto": 1}
@@ -0,0 +1,146 @@
+import io
+import time
+import xml.etree.ElementTree as ET
+from unittest import mock
+
+import fiona
+import pytest
+from numpy.testing import assert_allclose
+
+from munibot.gml import parse_geometry
+from munibot.profiles.es import AU_NS, MuniBotEs
+
+GML_TEMPLATE = """
+<gml:FeatureCollection xmlns:gml="http://www.opengis.net/gml/3.2">
+    <gml:featureMember>
+      <gml:geometry>
+        {geometry}
+      </gml:geometry>
+    </gml:featureMember>
+</gml:FeatureCollection>
+"""
+
+
+def _legacy_parse(response):
+    """
+    The previous implementation of MuniBotEs.get_boundaries, which reads the
+    geometry with fiona
+    """
+    root = ET.fromstring(response)
+    ns = {"au": AU_NS}
+
+    gml_geometry_element = [e for e in root.find("au:geometry", ns)][0]
+    gml_geometry = ET.tostring(gml_geometry_element)
+
+    gml = GML_TEMPLATE.format(geometry=gml_geometry.decode("utf8")).strip()
+
+    with fiona.open(io.BytesIO(gml.encode("utf8")), "r") as src:
+        geometry = [f["geometry"] for f in src][0]
+        return src.bounds, geometry
+
+
+def _polygon(srs_name, pos_list):
+    return f"""
+    <gml:Polygon xmlns:gml="http://www.opengis.net/gml/3.2" srsName="{srs_name}">
+      <gml:exterior>
+        <gml:LinearRing>
+          <gml:posList>{pos_list}</gml:posList>
+        </gml:LinearRing>
+      </gml:exterior>
+    </gml:Polygon>
+    """.encode(
+        "utf8"
+    )
+
+
+def test_parse_geometry_matches_fiona(ign_feature):
+
+    bounds, geometry = parse_geometry(ign_feature, f"{{{AU_NS}}}geometry")
+    legacy_bounds, legacy_geometry = _legacy_parse(ign_feature)
+
+    assert bounds == pytest.approx(legacy_bounds)
+    assert geometry["type"] == legacy_geometry["type"] == "MultiPolygon"
+
+    legacy_coordinates = legacy_geometry["coordinates"]
+    assert len(geometry["coordinates"]) == len(legacy_coordinates) == 2
+    for polygon, legacy_polygon in zip(geometry["coordinates"], legacy_coordinates):
+        assert len(polygon) == len(legacy_polygon)
+        for ring, legacy_ring in zip(polygon, legacy_polygon):
+            assert_allclose(ring, legacy_ring)
+
+
+def test_parse_geometry_longitude_first(ign_feature):
+
+    bounds, geometry = parse_geometry(ign_feature, f"{{{AU_NS}}}geometry")
+
+    # Abella de la Conca, in longitude, latitude order
+    assert 0.9 < bounds[0] < bounds[2] < 1.3
+    assert 42 < bounds[1] < bounds[3] < 42.3
+
+
+def test_parse_geometry_skips_other_containers(ign_feature):
+
+    # The point of the residence of authority is not a polygon, and the
+    # first polygon is the one in the au:geometry element
+    _, geometry = parse_geometry(ign_feature)
+
+    assert geometry["type"] == "MultiPolygon"
+
+
+def test_parse_geometry_polygon_axis_order():
+
+    pos_list = "41 2 41 3 42 3 41 2"
+
+    _, geometry = parse_geometry(_polygon("urn:ogc:def:crs:EPSG::4258", pos_list))
+    assert geometry == {
+        "type": "Polygon",
+        "coordinates": [[[2, 41], [3, 41], [3, 42], [2, 41]]],
+    }
+
+    # Short EPSG codes are longitude, latitude, as in GDAL
+    bounds, geometry = parse_geometry(_polygon("EPSG:4258", pos_list))
+    assert geometry["coordinates"][0][0] == [41, 2]
+    assert bounds == (41, 2, 42, 3)
+
+
+def test_parse_geometry_no_polygon():
+
+    with pytest.raises(ValueError):
+        parse_geometry(b'<gml:Point xmlns:gml="http://www.opengis.net/gml/3.2"/>')
+
+
+def test_es_get_boundaries(ign_feature):
+
+    profile = MuniBotEs()
+
+    with mock.patch("munibot.services.get_wfs"), mock.patch(
+        "munibot.services.getfeature", return_value=ign_feature
+    ) as m:
+        extent, geometry = profile.get_boundaries("34094343001")
+
+    assert m.call_args[1]["ID"] == "AU_ADMINISTRATIVEUNIT_34094343001"
+
+    assert extent == pytest.approx(_legacy_parse(ign_feature)[0])
+    assert geometry["type"] == "MultiPolygon"
+
+
+@pytest.mark.munibot_bench
+def test_benchmark_parse_geometry(ign_feature, benchmark_report):
+
+    def best(func, *args):
+        times = []
+        for _ in range(20):
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    legacy_time = best(_legacy_parse, ign_feature)
+    new_time = best(parse_geometry, ign_feature, f"{{{AU_NS}}}geometry")
+
+    benchmark_report(
+        f"es boundaries parsing: legacy {legacy_time * 1000:0.2f} ms, "
+        f"direct {new_time * 1000:0.2f} ms ({legacy_time / new_time:0.1f}x)"
+    )
+
+    assert new_time < legacy_time
@@ -1,9 +1,22 @@
+import math
+from unittest import mock
+
 import fiona
 import pytest
+import rasterio
+import shapely
+import shapely.geometry
 from numpy.testing import assert_array_equal
 from PIL import Image
 
-from munibot.image import create_image, get_mask, process_image
+from munibot.image import (
+    create_image,
+    get_mask,
+    get_mask_band,
+    process_image,
+    read_raster,
+    simplify_boundaries,
+)
 
 
 def test_get_mask(test_boundaries_path, test_image_path):
@@ -109,3 +122,91 @@ def test_create_image(test_profile):
     image = Image.open(image_io)
 
     assert image.size == (100, 50)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_process_image_with_decoded_raster(test_boundaries_path, test_image_path):
+    with fiona.open(test_boundaries_path, "r") as src:
+        boundaries = [f["geometry"] for f in src][0]
+
+    with open(test_image_path, "rb") as f:
+        from_file = process_image(f, get_mask(f, boundaries), output_format="tiff")
+
+    with open(test_image_path, "rb") as f:
+        raster = read_raster(f)
+    from_raster = process_image(
+        raster, get_mask(raster, boundaries), output_format="tiff"
+    )
+
+    assert from_file.getvalue() == from_raster.getvalue()
+
+
+def test_create_image_decodes_base_image_once(test_profile):
+
+    with mock.patch.object(rasterio, "open", wraps=rasterio.open) as m:
+        create_image(test_profile, "xyz")
+
+    assert m.call_count == 1
+
+
+@pytest.mark.usefixtures("load_config")
+def test_get_mask_band_windows(test_boundaries_path, test_image_path):
+    with fiona.open(test_boundaries_path, "r") as src:
+        boundaries = [f["geometry"] for f in src][0]
+
+    with open(test_image_path, "rb") as f:
+        raster = read_raster(f)
+
+    mask = get_mask_band(raster, boundaries, window_pixels=0)
+
+    assert mask.shape == (50, 100)
+    assert_array_equal(mask, get_mask(raster, boundaries)[:, :, 0])
+
+    # Windows of 3 and a half rows
+    assert_array_equal(get_mask_band(raster, boundaries, window_pixels=350), mask)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_process_image_with_mask_band(test_boundaries_path, test_image_path):
+    with fiona.open(test_boundaries_path, "r") as src:
+        boundaries = [f["geometry"] for f in src][0]
+
+    with open(test_image_path, "rb") as f:
+        raster = read_raster(f)
+
+    from_mask = process_image(
+        raster, get_mask(raster, boundaries), output_format="tiff"
+    )
+    from_band = process_image(
+        raster, get_mask_band(raster, boundaries), output_format="tiff"
+    )
+
+    assert from_mask.getvalue() == from_band.getvalue()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simplify_boundaries():
+
+    # A circle with 10000 vertices, a pixel size of 0.01 is ~600 px round
+    angles = [2 * math.pi * i / 10000 for i in range(10000)]
+    ring = [(math.cos(a), math.sin(a)) for a in angles]
+    boundaries = {"type": "Polygon", "coordinates": [ring + [ring[0]]]}
+
+    simplified = simplify_boundaries(boundaries, 0.01)
+
+    vertices = shapely.get_num_coordinates(shapely.geometry.shape(simplified))
+    assert 10 < vertices < 1000
+
+    # Less than one vertex per pixel
+    assert simplify_boundaries(boundaries, 0.0001) is boundaries
+
+    # Disabled
+    assert simplify_boundaries(boundaries, 0.01, tolerance=0) is boundaries
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simplify_boundaries_few_vertices(test_boundaries_path):
+    with fiona.open(test_boundaries_path, "r") as src:
+        boundaries = [f["geometry"] for f in src][0]
+
+    assert simplify_boundaries(boundaries, 0.01) is boundaries
@@ -0,0 +1,102 @@
+import asyncio
+import pstats
+
+import pytest
+
+from munibot.image import create_image
+from munibot.instrumentation import (
+    Collector,
+    add_instrument,
+    count,
+    instrumented,
+    profile_run,
+    remove_instrument,
+    span,
+)
+
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    add_instrument(collector)
+    yield collector
+    remove_instrument(collector)
+
+
+def test_span_and_count(collector):
+
+    with span("test.block"):
+        count("test.items", 3)
+    with span("test.block"):
+        count("test.items")
+
+    calls, total, maximum = collector.spans["test.block"]
+    assert calls == 2
+    assert total >= maximum >= 0
+    assert collector.counters == {"test.items": 4}
+
+
+def test_span_no_instruments():
+
+    # Nothing is recorded, and exceptions are not swallowed
+    with pytest.raises(ValueError):
+        with span("test.block"):
+            raise ValueError()
+
+
+def test_instrumented(collector):
+
+    @instrumented("test.func")
+    def func(value):
+        return value * 2
+
+    @instrumented("test.coroutine")
+    async def coroutine(value):
+        return value * 2
+
+    assert func(2) == 4
+    assert asyncio.run(coroutine(3)) == 6
+
+    assert collector.spans["test.func"][0] == 1
+    assert collector.spans["test.coroutine"][0] == 1
+
+
+@pytest.mark.usefixtures("load_config")
+def test_create_image_instrumented(test_profile, collector):
+
+    create_image(test_profile, "xyz")
+
+    for name in (
+        "image.create_image",
+        "image.render_image",
+        "profile.get_boundaries",
+        "profile.get_base_image",
+        "stage.mask",
+        "stage.composite",
+        "stage.encode",
+    ):
+        assert collector.spans[name][0] == 1, name
+
+    assert collector.counters["image.pixels_processed"] == 100 * 50
+
+
+@pytest.mark.usefixtures("load_config")
+def test_profile_run(test_profile, tmp_path):
+
+    output = str(tmp_path / "xyz.prof")
+
+    with profile_run(output) as collector:
+        create_image(test_profile, "xyz")
+
+    report = collector.report()
+    assert "image.create_image" in report
+    assert "image.pixels_processed" in report
+    assert "cumulative" in report
+
+    stats = pstats.Stats(output)
+    assert any("create_image" in function[2] for function in stats.stats)
+
+    # The collector is not registered anymore
+    with span("test.block"):
+        pass
+    assert "test.block" not in collector.spans
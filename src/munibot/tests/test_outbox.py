@@ -0,0 +1,192 @@
+import io
+import os
+from unittest import mock
+
+import pytest
+from mastodon import MastodonNetworkError, MastodonServiceUnavailableError
+
+from munibot import outbox
+from munibot.config import config
+from munibot.db import close_connections
+from munibot.mastodon import send_status
+
+pytestmark = pytest.mark.usefixtures("mastodon_clients")
+
+
+@pytest.fixture
+def outbox_config(load_config, tmp_path):
+    config["outbox"] = {
+        "path": str(tmp_path / "outbox.sqlite"),
+        "dir": str(tmp_path / "outbox"),
+        "backoff": "0",
+    }
+    yield config["outbox"]
+    close_connections()
+    config.pop("outbox", None)
+
+
+@pytest.fixture
+def api():
+    with mock.patch("mastodon.Mastodon") as m:
+        api = m.return_value
+        api.media_post.return_value = {
+            "id": "media_xyz",
+            "url": "https://example.com/media_xyz.jpg",
+        }
+        api.status_post.return_value = {"id": "status_xyz"}
+        yield api
+
+
+def test_outbox_disabled_without_db(load_config):
+
+    assert not outbox.outbox_enabled()
+
+
+def test_send_status_records_stages(outbox_config, api, test_profile):
+
+    test_profile.after_post = mock.Mock()
+
+    send_status(test_profile, "xyz", "Text", io.BytesIO(b"image"))
+
+    entry = outbox.get_entry("test", "xyz")
+    assert entry["stage"] == outbox.DONE
+    assert entry["media_id"] == "media_xyz"
+    assert entry["status_id"] == "status_xyz"
+    assert entry["image"] is None
+    assert os.listdir(os.path.join(outbox_config["dir"], "test")) == []
+
+    # Not posted again
+    send_status(test_profile, "xyz", "Text", io.BytesIO(b"image"))
+
+    assert api.media_post.call_count == 1
+    assert api.status_post.call_count == 1
+    test_profile.after_post.assert_called_once_with("xyz", "status_xyz")
+
+
+def test_send_status_resumes_after_failure(outbox_config, api, test_profile):
+
+    test_profile.after_post = mock.Mock(side_effect=[ValueError("Locked"), None])
+
+    with pytest.raises(ValueError):
+        send_status(test_profile, "xyz", "Text", io.BytesIO(b"image"))
+
+    entry = outbox.get_entry("test", "xyz")
+    assert entry["stage"] == outbox.POSTED
+    assert entry["attempts"] == 1
+    assert entry["error"] == "Locked"
+    assert [e["id"] for e in outbox.get_pending("test")] == ["xyz"]
+
+    send_status(test_profile, "xyz", "Text", outbox.read_image(entry))
+
+    # Only the after_post hook was called again
+    assert api.media_post.call_count == 1
+    assert api.status_post.call_count == 1
+    assert test_profile.after_post.call_count == 2
+    assert outbox.get_pending("test") == []
+
+
+def test_send_status_retries_transient_errors(outbox_config, api, test_profile):
+
+    api.status_post.side_effect = [
+        MastodonServiceUnavailableError("Unavailable"),
+        MastodonNetworkError("Timeout"),
+        {"id": "status_xyz"},
+    ]
+    test_profile.after_post = mock.Mock()
+
+    send_status(test_profile, "xyz", "Text", io.BytesIO(b"image"))
+
+    assert api.media_post.call_count == 1
+    assert api.status_post.call_count == 3
+    # The same idempotency key is sent on every attempt
+    keys = {c.kwargs["idempotency_key"] for c in api.status_post.call_args_list}
+    assert keys == {"munibot-test-xyz"}
+    assert outbox.get_entry("test", "xyz")["stage"] == outbox.DONE
+
+
+def test_with_retries_gives_up(outbox_config):
+
+    outbox_config["retries"] = "2"
+    func = mock.Mock(side_effect=MastodonNetworkError("Timeout"))
+
+    with pytest.raises(MastodonNetworkError):
+        outbox.with_retries(func)
+
+    assert func.call_count == 3
+
+    # Other errors are not retried
+    func = mock.Mock(side_effect=ValueError())
+    with pytest.raises(ValueError):
+        outbox.with_retries(func)
+
+    assert func.call_count == 1
+
+
+def test_get_pending_backoff(outbox_config):
+
+    outbox_config["backoff"] = "60"
+
+    outbox.add_entry("test", "xyz", "Text", io.BytesIO(b"image"))
+    outbox.record_failure("test", "xyz", "Error")
+
+    assert outbox.get_pending("test") == []
+    assert [e["id"] for e in outbox.get_pending("test", due=False)] == ["xyz"]
+    assert outbox.get_backoff(1) == 60
+    assert outbox.get_backoff(3) == 240
+
+
+def test_record_failure_gives_up(outbox_config):
+
+    outbox_config["max_attempts"] = "2"
+
+    outbox.add_entry("test", "xyz", "Text", io.BytesIO(b"image"))
+    outbox.record_failure("test", "xyz", "Error")
+
+    assert outbox.get_entry("test", "xyz")["stage"] == outbox.RENDERED
+    assert [e["id"] for e in outbox.get_pending("test")] == ["xyz"]
+
+    outbox.record_failure("test", "xyz", "Error")
+
+    assert outbox.get_entry("test", "xyz")["stage"] == outbox.FAILED
+    assert outbox.get_pending("test", due=False) == []
+    assert outbox.has_entry("test", "xyz")
+
+
+def test_post_pending_failure(outbox_config, api, test_profile):
+
+    from munibot.munibot import get_next_unsent_id, post_pending
+
+    outbox.add_entry("test", "xyz", "Text", io.BytesIO(b"image"))
+    api.status_post.side_effect = ValueError("Unprocessable")
+
+    # The error is recorded and a new feature can be posted
+    assert post_pending(test_profile) is None
+    assert outbox.get_entry("test", "xyz")["attempts"] == 1
+
+    # Features in the outbox are not rendered again
+    test_profile.get_next_id = mock.Mock(side_effect=["xyz", "abc"])
+
+    assert get_next_unsent_id(test_profile) == "abc"
+
+
+def test_post_pending_without_image(outbox_config, api, test_profile):
+
+    from munibot.munibot import post_pending
+
+    test_profile.after_post = mock.Mock(side_effect=[ValueError("Locked"), None])
+    with pytest.raises(ValueError):
+        send_status(test_profile, "xyz", "Text", io.BytesIO(b"image"))
+
+    # The image is not needed once uploaded
+    os.remove(os.path.join(outbox_config["dir"], "test", "xyz.jpg"))
+
+    assert post_pending(test_profile) == "xyz"
+    assert outbox.get_entry("test", "xyz")["stage"] == outbox.DONE
+
+    # If it is needed and missing, the entry is given up
+    outbox.add_entry("test", "abc", "Text", io.BytesIO(b"image"))
+    os.remove(os.path.join(outbox_config["dir"], "test", "abc.jpg"))
+
+    assert post_pending(test_profile) is None
+    assert outbox.get_entry("test", "abc")["stage"] == outbox.FAILED
+    assert outbox.get_pending("test") == []
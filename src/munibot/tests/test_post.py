@@ -1,9 +1,17 @@
+import time
 from unittest import mock
 
 import pytest
 
 from munibot.image import create_image
-from munibot.mastodon import get_client, send_status
+from munibot.mastodon import (
+    get_client,
+    get_rate_limit_delay,
+    send_status,
+    wait_for_media,
+)
+
+pytestmark = pytest.mark.usefixtures("mastodon_clients")
 
 
 @pytest.mark.usefixtures("load_config")
@@ -15,10 +23,46 @@ def test_get_client(test_profile):
     assert auth.api_base_url == "https://CHANGE_ME_URL"
 
 
+@pytest.mark.usefixtures("load_config")
+def test_get_client_is_cached(test_profile):
+
+    with mock.patch("mastodon.Mastodon") as m:
+        client = get_client(test_profile)
+        assert get_client(test_profile) is client
+
+    assert m.call_count == 1
+
+
+@pytest.mark.usefixtures("load_config")
+def test_get_rate_limit_delay(test_profile):
+
+    # No requests sent yet
+    assert get_rate_limit_delay(test_profile) == 0
+
+    with mock.patch("mastodon.Mastodon"):
+        client = get_client(test_profile)
+
+    client.ratelimit_remaining = 100
+    client.ratelimit_reset = time.time() + 30
+    assert get_rate_limit_delay(test_profile) == 0
+
+    client.ratelimit_remaining = 1
+    assert 29 < get_rate_limit_delay(test_profile) <= 30
+
+    # Already reset
+    client.ratelimit_reset = time.time() - 1
+    assert get_rate_limit_delay(test_profile) == 0
+
+
 class MockMastodonAPI:
-    def media_post(self, *args, **kwargs):
+    def __init__(self):
+        self.uploaded = None
+
+    def media_post(self, media_file, *args, **kwargs):
 
-        return {"id": "media_xyz"}
+        self.uploaded = media_file.read()
+
+        return {"id": "media_xyz", "url": "https://example.com/media_xyz.jpg"}
 
     def status_post(self, *args, **kwargs):
 
@@ -35,7 +79,37 @@ def test_send_post(test_profile):
 
     test_profile.after_post = mock.MagicMock()
 
-    with mock.patch("munibot.mastodon.Mastodon") as m:
-        m.return_value=MockMastodonAPI()
+    api = MockMastodonAPI()
+    with mock.patch("mastodon.Mastodon") as m:
+        m.return_value = api
         send_status(test_profile, id_, text, image, lon, lat)
     test_profile.after_post.assert_called_once_with("1234", "status_xyz")
+
+    # The image is uploaded from memory, from the start of the buffer
+    assert api.uploaded == image.getvalue()
+
+
+def test_wait_for_media():
+
+    api = mock.Mock()
+    api.media.side_effect = [
+        {"id": "media_xyz", "url": None},
+        {"id": "media_xyz", "url": "https://example.com/media_xyz.jpg"},
+    ]
+
+    with mock.patch("time.sleep") as sleep:
+        media = wait_for_media(api, {"id": "media_xyz", "url": None})
+
+    assert media["url"] == "https://example.com/media_xyz.jpg"
+    assert api.media.call_count == 2
+    assert [c.args[0] for c in sleep.call_args_list] == [0.25, 0.5]
+
+
+def test_wait_for_media_timeout():
+
+    api = mock.Mock()
+    api.media.return_value = {"id": "media_xyz", "url": None}
+
+    with mock.patch("time.sleep"):
+        with pytest.raises(TimeoutError):
+            wait_for_media(api, {"id": "media_xyz", "url": None}, timeout=1)
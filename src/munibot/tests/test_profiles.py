@@ -0,0 +1,168 @@
+import asyncio
+import io
+import threading
+import time
+from unittest import mock
+
+import numpy
+import pytest
+import rasterio
+from PIL import Image
+
+from munibot.profiles.cat import MuniBotCat
+from munibot.profiles.es import MuniBotEs
+from munibot.profiles.fr import CommuneBotFr
+from munibot.profiles.us import CountyBotUS
+
+
+def _wms_tiff(width, height):
+    """
+    A TIFF image without georeferencing, like the ones returned by the
+    National Map WMS
+    """
+    array = numpy.random.default_rng(0).integers(
+        0, 256, (height, width, 3), dtype=numpy.uint8
+    )
+    out = io.BytesIO()
+    Image.fromarray(array).save(out, format="tiff")
+    out.seek(0)
+    return out, array
+
+
+def test_us_geocode():
+
+    img, array = _wms_tiff(100, 50)
+    bounds = (-100.0, 40.0, -99.0, 40.5)
+
+    georeferenced = CountyBotUS()._geocode(img, bounds, width=100)
+
+    assert isinstance(georeferenced, io.BytesIO)
+
+    with rasterio.open(georeferenced) as src:
+        assert src.crs.to_epsg() == 4326
+        assert src.bounds == pytest.approx(bounds)
+        assert numpy.array_equal(src.read(), array.transpose(2, 0, 1))
+
+
+@pytest.mark.usefixtures("load_config")
+def test_us_get_base_image_concurrent():
+
+    profile = CountyBotUS()
+    extents = [(-100.0 + i, 40.0, -99.0 + i, 40.5) for i in range(4)]
+    results = {}
+
+    def get_wms_image(**kwargs):
+        width, height = profile.get_image_size(kwargs["bbox"])
+        return _wms_tiff(int(width), int(height))[0]
+
+    def get_base_image(extent):
+        results[extent] = profile.get_base_image(extent)
+
+    with mock.patch.object(profile, "get_wms_image", side_effect=get_wms_image):
+        threads = [
+            threading.Thread(target=get_base_image, args=(extent,))
+            for extent in extents
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for extent in extents:
+        with rasterio.open(results[extent]) as src:
+            assert src.bounds.left == pytest.approx(
+                profile.extend_bbox(extent)[0]
+            )
+
+
+def test_us_aget_boundaries_sends_queries_at_the_same_time():
+
+    profile = CountyBotUS()
+
+    def query_geometry(id_):
+        time.sleep(0.2)
+        return {"type": "Polygon", "coordinates": []}
+
+    def query_extent(id_):
+        time.sleep(0.2)
+        return [-100.0, 40.0, -99.0, 40.5]
+
+    profile._query_geometry = query_geometry
+    profile._query_extent = query_extent
+
+    start = time.perf_counter()
+    extent, geometry = asyncio.run(profile.aget_boundaries("01001"))
+    elapsed = time.perf_counter() - start
+
+    assert extent == [-100.0, 40.0, -99.0, 40.5]
+    assert geometry["type"] == "Polygon"
+    assert elapsed < 0.35
+
+
+def test_es_db_hooks(test_db):
+
+    profile = MuniBotEs()
+
+    assert profile.get_text("34014040002") == (
+        "Adrada de Pirón (Segovia)\n\n\n"
+        "https://es.wikipedia.org/wiki/Adrada_de_Pir%C3%B3n"
+    )
+    assert profile.get_lon_lat("34014040002") == (-3.98, 41.05)
+    assert sorted(profile.get_ids(unposted=True)) == ["34014040002", "34094343001"]
+
+    profile.after_post("34014040002", "status_3")
+
+    assert profile.get_ids(unposted=True) == ["34094343001"]
+
+    count, posts = profile.posts_dump()
+    assert count == 3
+    assert posts == {"40001": "status_1", "40002": "status_3"}
+
+
+def test_cat_db_hooks(test_db):
+
+    profile = MuniBotCat()
+
+    assert profile.get_next_id() == "34094343001"
+    assert profile.get_text("34094343001").startswith(
+        "Abella de la Conca (Pallars Jussà)"
+    )
+
+    profile.after_post("34094343001", "status_4")
+
+    count, posts = profile.posts_dump()
+    assert count == 1
+    assert posts == {"43001": "status_4"}
+
+
+def test_fr_db_hooks(test_db):
+
+    profile = CommuneBotFr()
+
+    assert profile.get_next_id() == "01001"
+    assert profile.get_text("01001").startswith("L'Abergement-Clémenciat (Ain)")
+    assert profile.get_lon_lat("01001") == (4.92, 46.15)
+
+    count, posts = profile.posts_dump()
+    assert count == 2
+    assert posts == {"01002": "status_2"}
+
+
+def test_us_db_hooks(test_db):
+
+    profile = CountyBotUS()
+
+    assert profile.get_next_id() == "01001"
+    assert profile.get_text("01001") == (
+        "Autauga County, Alabama\n\n\n"
+        "https://en.wikipedia.org/wiki/Autauga_County,_Alabama"
+    )
+
+    profile.after_post("01001", "status_5")
+
+    assert profile.get_ids(unposted=True) == []
+
+
+def test_profiles_share_connection(test_db):
+
+    assert MuniBotEs().db is CommuneBotFr().db
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from munibot import serve
+from munibot.config import config
+
+
+@pytest.fixture
+def serve_config(load_config, tmp_path):
+    config["serve"] = {"staging_dir": str(tmp_path / "staging")}
+    yield config["serve"]
+    config.pop("serve", None)
+
+
+def _with_sequence(profile):
+
+    ids = iter(str(i) for i in range(100))
+    lock = threading.Lock()
+
+    def get_next_id():
+        with lock:
+            return next(ids)
+
+    profile.get_next_id = get_next_id
+    return profile
+
+
+@pytest.fixture
+def sequence_profile(test_profile):
+    """
+    The test profile, returning a different id each time get_next_id is called
+    """
+    return _with_sequence(test_profile)
+
+
+def test_stage(serve_config, test_profile):
+
+    item = serve.stage(test_profile, "1234")
+
+    assert item["id"] == "1234"
+    assert item["text"] == "Test feature (post text)"
+    assert (item["lon"], item["lat"]) == (1.2781, 41.1202)
+    assert os.path.exists(item["image"])
+
+    assert serve.get_staged(test_profile) == [item]
+
+    serve.unstage(test_profile, item)
+
+    assert serve.get_staged(test_profile) == []
+    assert not os.path.exists(item["image"])
+
+
+def test_fill_staging(serve_config, sequence_profile):
+
+    assert serve.fill_staging(sequence_profile, prefetch=3) == 3
+
+    staged = serve.get_staged(sequence_profile)
+    assert [item["id"] for item in staged] == ["0", "1", "2"]
+
+    # Already full
+    assert serve.fill_staging(sequence_profile, prefetch=3) == 0
+
+    serve.unstage(sequence_profile, staged[0])
+
+    assert serve.fill_staging(sequence_profile, prefetch=3) == 1
+
+
+def test_fill_staging_skips_repeated_ids(serve_config, test_profile):
+
+    # The test profile always returns the same id
+    assert serve.fill_staging(test_profile, prefetch=3) == 1
+
+
+def test_post_next(serve_config, sequence_profile):
+
+    serve.fill_staging(sequence_profile, prefetch=2)
+
+    with mock.patch("munibot.serve.send_status") as m:
+        id_ = serve.post_next(sequence_profile)
+
+    assert id_ == "0"
+    assert m.call_args[0][1] == "0"
+    assert m.call_args[0][2] == "Test feature (post text)"
+    assert m.call_args[0][3].getvalue()[:2] == b"\xff\xd8"
+
+    assert [item["id"] for item in serve.get_staged(sequence_profile)] == ["1"]
+
+
+def test_post_next_nothing_staged(serve_config, sequence_profile):
+
+    with mock.patch("munibot.serve.send_status") as m:
+        id_ = serve.post_next(sequence_profile)
+
+    assert id_ == "0"
+    assert m.call_count == 1
+    assert serve.get_staged(sequence_profile) == []
+
+
+def test_serve(serve_config, sequence_profile):
+
+    with mock.patch("munibot.serve.send_status") as m:
+        posts = serve.serve(sequence_profile, interval=0.1, prefetch=2, max_posts=3)
+
+    assert posts == 3
+    assert len({c[0][1] for c in m.call_args_list}) == 3
+
+
+def test_get_interval(serve_config, test_profile):
+
+    assert serve.get_interval(test_profile) == 0
+
+    serve_config["interval"] = "3600"
+    assert serve.get_interval(test_profile) == 3600
+
+    config["profile:test"]["interval"] = "600"
+    try:
+        assert serve.get_interval(test_profile) == 600
+    finally:
+        config["profile:test"].pop("interval")
+
+
+def test_serve_profiles_slow_profile(serve_config, test_profile_class):
+
+    fast = _with_sequence(test_profile_class())
+    fast.id = "fast"
+
+    slow = _with_sequence(test_profile_class())
+    slow.id = "slow"
+    get_text = slow.get_text
+
+    def slow_get_text(id_):
+        time.sleep(0.5)
+        return get_text(id_)
+
+    slow.get_text = slow_get_text
+
+    posted = []
+
+    def send_status(profile, id_, *args):
+        posted.append(profile.id)
+
+    with mock.patch("munibot.serve.send_status", side_effect=send_status):
+        posts = serve.serve_profiles(
+            [slow, fast], {"slow": 0.1, "fast": 0.1}, prefetch=1, max_posts=3
+        )
+
+    assert posts == {"slow": 3, "fast": 3}
+    # Posts on the fast profile are not delayed by the slow one
+    assert posted[:3] == ["fast", "fast", "fast"]
+
+
+def test_serve_waits_for_rate_limit(serve_config, sequence_profile):
+
+    with mock.patch(
+        "munibot.serve.get_rate_limit_delay", side_effect=[0.3, 0]
+    ), mock.patch("munibot.serve.send_status"):
+        start = time.monotonic()
+        posts = serve.serve(sequence_profile, interval=0.01, prefetch=1, max_posts=2)
+
+    assert posts == 2
+    assert time.monotonic() - start >= 0.3
@@ -0,0 +1,113 @@
+from unittest import mock
+
+import pytest
+from owslib.util import ServiceException
+
+from munibot import services
+
+
+@pytest.fixture(autouse=True)
+def clear_services():
+    services.clear_services()
+    yield
+    services.clear_services()
+
+
+def _response(content, content_type="text/xml"):
+    return mock.Mock(content=content, headers={"Content-Type": content_type})
+
+
+def test_session_is_shared():
+
+    assert services.get_session() is services.get_session()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_get_wms_requests_capabilities_once(wms_capabilities):
+
+    with mock.patch.object(
+        services.get_session(), "get", return_value=_response(wms_capabilities)
+    ) as m:
+        wms = services.get_wms("http://wms.test/wms")
+        assert services.get_wms("http://wms.test/wms") is wms
+
+    assert m.call_count == 1
+    assert m.call_args[1]["params"]["request"] == "GetCapabilities"
+    assert "ortho" in wms.contents
+
+
+def test_capabilities_stored_on_disk(cache_config, tmp_path, wms_capabilities):
+
+    cache_config["capabilities_dir"] = str(tmp_path / "capabilities")
+
+    with mock.patch.object(
+        services.get_session(), "get", return_value=_response(wms_capabilities)
+    ) as m:
+        services.get_wms("http://wms.test/wms")
+
+        # e.g. a new process
+        services.clear_services()
+
+        wms = services.get_wms("http://wms.test/wms")
+
+    assert m.call_count == 1
+    assert "ortho" in wms.contents
+
+
+@pytest.mark.usefixtures("load_config")
+def test_getmap(wms_capabilities):
+
+    with mock.patch.object(
+        services.get_session(), "get", return_value=_response(wms_capabilities)
+    ):
+        wms = services.get_wms("http://wms.test/wms")
+
+    with mock.patch.object(
+        services.get_session(),
+        "get",
+        return_value=_response(b"image", content_type="image/tiff"),
+    ) as m:
+        image = services.getmap(
+            wms,
+            layers=["ortho"],
+            srs="EPSG:4258",
+            bbox=(1.0, 41.0, 2.0, 42.0),
+            size=(100, 100),
+            format="image/tiff",
+        )
+
+    assert image == b"image"
+    assert m.call_args[0][0] == "http://wms.test/getmap?"
+    params = m.call_args[1]["params"]
+    assert params["request"] == "GetMap"
+    assert params["layers"] == "ortho"
+    assert params["crs"] == "EPSG:4258"
+    # EPSG:4258 has latitude first
+    assert params["bbox"] == "41.0,1.0,42.0,2.0"
+
+
+@pytest.mark.usefixtures("load_config")
+def test_getmap_service_exception(wms_capabilities):
+
+    with mock.patch.object(
+        services.get_session(), "get", return_value=_response(wms_capabilities)
+    ):
+        wms = services.get_wms("http://wms.test/wms")
+
+    exception = b"""<?xml version="1.0"?>
+    <ServiceExceptionReport version="1.3.0" xmlns="http://www.opengis.net/ogc">
+      <ServiceException>Layer not found</ServiceException>
+    </ServiceExceptionReport>"""
+
+    with mock.patch.object(
+        services.get_session(), "get", return_value=_response(exception)
+    ):
+        with pytest.raises(ServiceException, match="Layer not found"):
+            services.getmap(
+                wms,
+                layers=["nope"],
+                srs="CRS:84",
+                bbox=(1.0, 41.0, 2.0, 42.0),
+                size=(100, 100),
+                format="image/tiff",
+            )
@@ -0,0 +1,115 @@
+import json
+import logging
+from unittest import mock
+
+import pytest
+
+from munibot.config import config, get_logger
+from munibot.image import create_image
+from munibot.mastodon import send_status
+from munibot.timings import Timings
+
+
+@pytest.fixture
+def timings_file(load_config, tmp_path):
+    path = tmp_path / "timings.jsonl"
+    config["logging"] = {"level": "WARNING", "timings_file": str(path)}
+    yield path
+    config.pop("logging", None)
+
+
+def _read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_timings_stages():
+
+    timings = Timings("test", "1234", "create")
+
+    with timings.stage("mask"):
+        pass
+    with timings.stage("mask"):
+        pass
+    timings.add("encode", 0.5)
+
+    assert set(timings.stages) == {"mask", "encode"}
+    assert timings.total >= 0.5
+
+    record = timings.to_dict()
+    assert record["profile"] == "test"
+    assert record["id"] == "1234"
+    assert record["action"] == "create"
+
+
+def test_timings_log_disabled(load_config, tmp_path):
+
+    # No timings_file option, nothing is written
+    Timings("test", "1234").log()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_create_image_timings(test_profile, timings_file):
+
+    create_image(test_profile, "xyz")
+
+    records = _read_records(timings_file)
+
+    assert len(records) == 1
+    assert records[0]["profile"] == "test"
+    assert records[0]["id"] == "xyz"
+    assert records[0]["action"] == "create"
+    assert set(records[0]["stages"]) == {
+        "boundaries",
+        "imagery",
+        "decode",
+        "simplify",
+        "mask",
+        "composite",
+        "encode",
+    }
+
+
+@pytest.mark.usefixtures("mastodon_clients")
+def test_post_timings(test_profile, timings_file):
+
+    timings = Timings(test_profile.id, "xyz", "post")
+    image = create_image(test_profile, "xyz", timings=timings)
+
+    with mock.patch("mastodon.Mastodon") as m:
+        m.return_value.media_post.return_value = {
+            "id": "media_xyz",
+            "url": "https://example.com/media_xyz.jpg",
+        }
+        m.return_value.status_post.return_value = {"id": "status_xyz"}
+        send_status(test_profile, "xyz", "Text", image, timings=timings)
+
+    # Nothing logged until the caller logs the full record
+    assert not timings_file.exists() or _read_records(timings_file) == []
+
+    timings.log()
+
+    records = _read_records(timings_file)
+    assert len(records) == 1
+    assert {"boundaries", "imagery", "upload", "post"} <= set(records[0]["stages"])
+
+
+def test_get_logger_adds_handler_once(load_config):
+
+    config["logging"] = {"level": "INFO"}
+    try:
+        for _ in range(5):
+            get_logger("munibot.image")
+            get_logger("munibot.batch")
+
+        assert len(logging.getLogger("munibot").handlers) == 1
+
+        config["logging"] = {"level": "DEBUG"}
+        get_logger("munibot.image")
+
+        handlers = logging.getLogger("munibot").handlers
+        assert len(handlers) == 1
+        assert handlers[0].level == logging.DEBUG
+    finally:
+        config.pop("logging", None)
@@ -0,0 +1,105 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from .config import config
+from .instrumentation import span
+
+TIMINGS_LOGGER = "munibot.timings"
+
+# Handler writing to the timings file, with the path it was created for
+_handler = None
+_handler_path = None
+
+
+def get_timings_logger():
+    """
+    Returns the logger that writes the timing records, one JSON object per
+    line, to the file set in the ``timings_file`` option of the ``[logging]``
+    section.
+
+    Returns None if the option is not set.
+    """
+    global _handler, _handler_path
+
+    path = config.get("logging", {}).get("timings_file")
+
+    logger = logging.getLogger(TIMINGS_LOGGER)
+    # Records are not meant for the regular log output
+    logger.propagate = False
+
+    if path != _handler_path:
+        if _handler:
+            logger.removeHandler(_handler)
+            _handler.close()
+            _handler = None
+        if path:
+            _handler = logging.FileHandler(path)
+            _handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(_handler)
+            logger.setLevel(logging.INFO)
+        _handler_path = path
+
+    return logger if path else None
+
+
+class Timings:
+    """
+    Collects the duration (in seconds) of the stages involved in creating or
+    posting the image of a feature, so they can be logged as a single
+    record.
+
+    The stages recorded by munibot are ``boundaries``, ``imagery``,
+    ``decode``, ``simplify``, ``mask``, ``composite``, ``encode``, ``upload``
+    and ``post``.
+    """
+
+    def __init__(self, profile_id=None, id_=None, action=None):
+        self.profile_id = profile_id
+        self.id = id_
+        self.action = action
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the time spent in the block to the ``name``
+        stage. The block is also recorded as a ``stage.<name>`` span.
+        """
+        start = time.perf_counter()
+        try:
+            with span(f"stage.{name}"):
+                yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, duration):
+        self.stages[name] = self.stages.get(name, 0) + duration
+
+    def update(self, stages):
+        for name, duration in stages.items():
+            self.add(name, duration)
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def to_dict(self):
+        return {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "profile": self.profile_id,
+            "id": self.id,
+            "action": self.action,
+            "stages": {name: round(value, 6) for name, value in self.stages.items()},
+            "total": round(self.total, 6),
+        }
+
+    def log(self):
+        """
+        Writes the record to the timings file, if enabled.
+        """
+        logger = get_timings_logger()
+        if logger:
+            logger.info(json.dumps(self.to_dict()))